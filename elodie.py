@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
+import math
 import os
 import re
 import sys
@@ -21,7 +22,7 @@ from elodie import log
 from elodie.compatibility import _decode
 from elodie.config import load_config
 from elodie.filesystem import FileSystem
-from elodie.localstorage import Db
+from elodie.localstorage import Db, VerifyState, get_checksums, verify_checksum
 from elodie.media.base import Base, get_all_subclasses
 from elodie.media.media import Media
 from elodie.media.text import Text
@@ -30,12 +31,22 @@ from elodie.media.photo import Photo
 from elodie.media.video import Video
 from elodie.plugins.plugins import Plugins
 from elodie.result import Result
-from elodie.external.pyexiftool import ExifTool
-from elodie.dependencies import get_exiftool
+from elodie.workers import ProcessPool, WorkerPool
+from elodie.external.pyexiftool import ExifTool, ExifToolTimeout
+from elodie.dependencies import get_exiftool, get_exiftool_timeout
 from elodie import constants
 
 FILESYSTEM = FileSystem()
 
+def log_exiftool_timeout(_file, error):
+    """Log that exiftool took too long for a file.
+
+    :param str _file: Path of the file.
+    :param ExifToolTimeout error: The timeout.
+    """
+    log.error('exiftool timed out on %s' % _file)
+    log.all('{"source":"%s", "error_msg":"%s"}' % (_file, error))
+
 def import_file(_file, destination, album_from_folder, trash, allow_duplicates):
     
     _file = _decode(_file)
@@ -61,11 +72,20 @@ def import_file(_file, destination, album_from_folder, trash, allow_duplicates):
         log.all('{"source":"%s", "error_msg":"Not a supported file"}' % _file)
         return
 
-    if album_from_folder:
-        media.set_album_from_folder()
+    try:
+        # Tags meant for the destination have to be held back before any
+        #  are set so the source is never written to.
+        if FILESYSTEM.write_to_destination():
+            media.defer_tags()
 
-    dest_path = FILESYSTEM.process_file(_file, destination,
-        media, allowDuplicate=allow_duplicates, move=False)
+        if album_from_folder:
+            media.set_album_from_folder()
+
+        dest_path = FILESYSTEM.process_file(_file, destination,
+            media, allowDuplicate=allow_duplicates, move=False)
+    except ExifToolTimeout as e:
+        log_exiftool_timeout(_file, e)
+        return
     if dest_path:
         log.all('%s -> %s' % (_file, dest_path))
     if trash:
@@ -101,11 +121,16 @@ def _batch(debug):
               help='Override the value in constants.py with True.')
 @click.option('--exclude-regex', default=set(), multiple=True,
               help='Regular expression for directories or files to exclude.')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of files to import at the same time.')
+@click.option('--rehash', default=False, is_flag=True,
+              help='Compute checksums from file contents even if cached.')
 @click.argument('paths', nargs=-1, type=click.Path())
-def _import(destination, source, file, album_from_folder, trash, allow_duplicates, debug, exclude_regex, paths):
+def _import(destination, source, file, album_from_folder, trash, allow_duplicates, debug, exclude_regex, workers, rehash, paths):
     """Import files or directories by reading their EXIF and organizing them accordingly.
     """
     constants.debug = debug
+    constants.rehash = rehash
     has_errors = False
     result = Result()
 
@@ -136,14 +161,50 @@ def _import(destination, source, file, album_from_folder, trash, allow_duplicate
             if not FILESYSTEM.should_exclude(path, exclude_regex_list, True):
                 files.add(path)
 
-    for current_file in files:
-        dest_path = import_file(current_file, destination, album_from_folder,
-                    trash, allow_duplicates)
-        result.append((current_file, dest_path))
-        has_errors = has_errors is True or not dest_path
+    def import_chunk(chunk):
+        # Read the metadata of the whole chunk with one exiftool call.
+        Media.prefetch_exiftool_attributes(chunk)
+        # Look up the chunk's locations before copying any of its files.
+        geolocation.prefetch_place_names(Media.get_prefetched_coordinates())
+        return [
+            import_file(current_file, destination, album_from_folder,
+                        trash, allow_duplicates)
+            for current_file in chunk
+        ]
+
+    # Keep every worker busy when there are only a few files.
+    files = list(files)
+    chunk_size = max(1, min(
+        constants.exiftool_batch_size,
+        -(-len(files) // workers)
+    ))
+    chunks = [
+        files[i:i + chunk_size] for i in range(0, len(files), chunk_size)
+    ]
+    if workers > 1:
+        # Load the dbs once before the workers share them.
+        Db()
+        dest_paths = WorkerPool(workers).map(import_chunk, chunks)
+    else:
+        dest_paths = map(import_chunk, chunks)
+
+    for chunk, chunk_dest_paths in zip(chunks, dest_paths):
+        for current_file, dest_path in zip(chunk, chunk_dest_paths):
+            result.append((current_file, dest_path))
+            has_errors = has_errors is True or not dest_path
 
     result.write()
 
+    lookup_stats = geolocation.get_lookup_stats()
+    if lookup_stats['requests'] > 0:
+        log.info('MapQuest: %d requests, %d retries, %d failures, %.3fs average and %.3fs maximum latency' % (
+            lookup_stats['requests'],
+            lookup_stats['retries'],
+            lookup_stats['failures'],
+            lookup_stats['latency'] / lookup_stats['requests'],
+            lookup_stats['max_latency']
+        ))
+
     if has_errors:
         sys.exit(1)
 
@@ -153,10 +214,15 @@ def _import(destination, source, file, album_from_folder, trash, allow_duplicate
               required=True, help='Source of your photo library.')
 @click.option('--debug', default=False, is_flag=True,
               help='Override the value in constants.py with True.')
-def _generate_db(source, debug):
+@click.option('--rehash', default=False, is_flag=True,
+              help='Compute checksums from file contents even if cached.')
+@click.option('--jobs', default=1, type=click.IntRange(min=1),
+              help='Number of processes to hash files with.')
+def _generate_db(source, debug, rehash, jobs):
     """Regenerate the hash.json database which contains all of the sha256 signatures of media files. The hash.json file is located at ~/.elodie/.
     """
     constants.debug = debug
+    constants.rehash = rehash
     result = Result()
     source = os.path.abspath(os.path.expanduser(source))
 
@@ -168,9 +234,16 @@ def _generate_db(source, debug):
     db.backup_hash_db()
     db.reset_hash_db()
 
-    for current_file in FILESYSTEM.get_all_files(source):
+    files = FILESYSTEM.get_all_files(source)
+    if jobs > 1:
+        checksums = ProcessPool(jobs).imap(get_checksums, files)
+    else:
+        checksums = map(get_checksums, files)
+
+    for current_file, checksum, partial_checksum in checksums:
         result.append((current_file, True))
-        db.add_hash(db.checksum(current_file), current_file)
+        db.add_partial_checksum(checksum, partial_checksum)
+        db.add_hash(checksum, current_file)
         log.progress()
     
     db.update_hash_db()
@@ -180,24 +253,54 @@ def _generate_db(source, debug):
 @click.command('verify')
 @click.option('--debug', default=False, is_flag=True,
               help='Override the value in constants.py with True.')
-def _verify(debug):
+@click.option('--jobs', default=1, type=click.IntRange(min=1),
+              help='Number of processes to hash files with.')
+@click.option('--since-last', default=False, is_flag=True,
+              help='Skip files which passed the last verify and haven\'t '
+                   'changed since.')
+@click.option('--sample', type=click.IntRange(1, 100),
+              help='Verify this percentage of files, starting with the '
+                   'ones verified longest ago.')
+def _verify(debug, jobs, since_last, sample):
     constants.debug = debug
     result = Result()
     db = Db()
-    for checksum, file_path in db.all():
-        if not os.path.isfile(file_path):
-            result.append((file_path, False))
-            log.progress('x')
-            continue
-
-        actual_checksum = db.checksum(file_path)
-        if checksum == actual_checksum:
-            result.append((file_path, True))
+    state = VerifyState(constants.verify_db)
+
+    entries = db.all()
+    if sample is not None:
+        entries = list(entries)
+        entries = state.least_recently_verified(
+            entries,
+            int(math.ceil(len(entries) * sample / 100.0))
+        )
+
+    if since_last:
+        stat_key = db.get_checksum_cache().stat_key
+        entries_changed = []
+        for checksum, file_path in entries:
+            if(os.path.isfile(file_path) and
+                    state.unchanged(checksum, file_path, stat_key(file_path))):
+                result.append((file_path, True))
+                log.progress()
+            else:
+                entries_changed.append((checksum, file_path))
+        entries = entries_changed
+
+    if jobs > 1:
+        verified = ProcessPool(jobs).imap(verify_checksum, entries)
+    else:
+        verified = map(verify_checksum, entries)
+
+    for checksum, file_path, ok, file_stat_key in verified:
+        state.set(checksum, file_path, ok, file_stat_key)
+        result.append((file_path, ok))
+        if ok:
             log.progress()
         else:
-            result.append((file_path, False))
             log.progress('x')
 
+    state.commit()
     log.progress('', True)
     result.write()
 
@@ -269,7 +372,16 @@ def _update(album, location, time, title, paths, debug):
         else:
             files.add(path)
 
-    for current_file in files:
+    files = list(files)
+    # Files whose tags are held back, with where to move them to.
+    updates = []
+    for index, current_file in enumerate(files):
+        # Read the metadata of the next files with one exiftool call.
+        if index % constants.exiftool_batch_size == 0:
+            Media.prefetch_exiftool_attributes(
+                files[index:index + constants.exiftool_batch_size]
+            )
+
         if not os.path.exists(current_file):
             has_errors = True
             result.append((current_file, False))
@@ -296,65 +408,112 @@ def _update(album, location, time, title, paths, debug):
         if not media:
             continue
 
-        updated = False
-        if location:
-            update_location(media, current_file, location)
-            updated = True
-        if time:
-            update_time(media, current_file, time)
-            updated = True
-        if album:
-            media.set_album(album)
-            updated = True
-
-        # Updating a title can be problematic when doing it 2+ times on a file.
-        # You would end up with img_001.jpg -> img_001-first-title.jpg ->
-        # img_001-first-title-second-title.jpg.
-        # To resolve that we have to track the prior title (if there was one.
-        # Then we massage the updated_media's metadata['base_name'] to remove
-        # the old title.
-        # Since FileSystem.get_file_name() relies on base_name it will properly
-        #  rename the file by updating the title instead of appending it.
-        remove_old_title_from_name = False
-        if title:
-            # We call get_metadata() to cache it before making any changes
-            metadata = media.get_metadata()
-            title_update_status = media.set_title(title)
-            original_title = metadata['title']
-            if title_update_status and original_title:
-                # @TODO: We should move this to a shared method since
-                # FileSystem.get_file_name() does it too.
-                original_title = re.sub(r'\W+', '-', original_title.lower())
-                original_base_name = metadata['base_name']
-                remove_old_title_from_name = True
-            updated = True
-
-        if updated:
+        try:
+            # Every tag is held back and written with one exiftool call since
+            #  each write rewrites the whole file. Text files are written to
+            #  straight away.
+            media.defer_tags()
+
+            updated = False
+            if location:
+                update_location(media, current_file, location)
+                updated = True
+            if time:
+                update_time(media, current_file, time)
+                updated = True
+            if album:
+                media.set_album(album)
+                updated = True
+
+            # Updating a title can be problematic when doing it 2+ times on a file.
+            # You would end up with img_001.jpg -> img_001-first-title.jpg ->
+            # img_001-first-title-second-title.jpg.
+            # To resolve that we have to track the prior title (if there was one.
+            # Then we massage the updated_media's metadata['base_name'] to remove
+            # the old title.
+            # Since FileSystem.get_file_name() relies on base_name it will properly
+            #  rename the file by updating the title instead of appending it.
+            remove_old_title_from_name = False
+            if title:
+                # We call get_metadata() to cache it before making any changes
+                metadata = media.get_metadata()
+                title_update_status = media.set_title(title)
+                original_title = metadata['title']
+                if title_update_status and original_title:
+                    # @TODO: We should move this to a shared method since
+                    # FileSystem.get_file_name() does it too.
+                    original_title = re.sub(r'\W+', '-', original_title.lower())
+                    original_base_name = metadata['base_name']
+                    remove_old_title_from_name = True
+                updated = True
+        except ExifToolTimeout as e:
+            has_errors = True
+            result.append((current_file, False))
+            log_exiftool_timeout(current_file, e)
+            continue
+
+        if not updated:
+            has_errors = False
+            result.append((current_file, False))
+            continue
+
+        base_name = None
+        if remove_old_title_from_name and len(original_title) > 0:
+            base_name = original_base_name.replace('-%s' % original_title, '')
+        updates.append((current_file, destination, media, base_name))
+
+    # Files which get the same tags are written together instead of one
+    #  exiftool call each.
+    statuses = Media.write_deferred_tags_batch(
+        [media for _, _, media, _ in updates]
+    )
+
+    directories = set()
+    for index, (current_file, destination, media, base_name) in enumerate(updates):
+        # Read the metadata of the next files with one exiftool call.
+        if index % constants.exiftool_batch_size == 0:
+            Media.prefetch_exiftool_attributes([
+                update[0] for update in
+                updates[index:index + constants.exiftool_batch_size]
+            ])
+
+        if statuses[index] is False:
+            has_errors = True
+            result.append((current_file, False))
+            log.error('Failed to update %s' % current_file)
+            log.all('{"source":"%s", "error_msg":"Failed to update %s"}' %
+                      (current_file, current_file))
+            continue
+
+        try:
             updated_media = Media.get_class_by_file(current_file,
                                                     get_all_subclasses())
             # See comments above on why we have to do this when titles
             # get updated.
-            if remove_old_title_from_name and len(original_title) > 0:
+            if base_name is not None:
                 updated_media.get_metadata()
-                updated_media.set_metadata_basename(
-                    original_base_name.replace('-%s' % original_title, ''))
+                updated_media.set_metadata_basename(base_name)
 
             dest_path = FILESYSTEM.process_file(current_file, destination,
                 updated_media, move=True, allowDuplicate=True)
-            log.info(u'%s -> %s' % (current_file, dest_path))
-            log.all('{"source":"%s", "destination":"%s"}' % (current_file,
-                                                               dest_path))
-            # If the folder we moved the file out of or its parent are empty
-            # we delete it.
-            FILESYSTEM.delete_directory_if_empty(os.path.dirname(current_file))
-            FILESYSTEM.delete_directory_if_empty(
-                os.path.dirname(os.path.dirname(current_file)))
-            result.append((current_file, dest_path))
-            # Trip has_errors to False if it's already False or dest_path is.
-            has_errors = has_errors is True or not dest_path
-        else:
-            has_errors = False
+        except ExifToolTimeout as e:
+            has_errors = True
             result.append((current_file, False))
+            log_exiftool_timeout(current_file, e)
+            continue
+        log.info(u'%s -> %s' % (current_file, dest_path))
+        log.all('{"source":"%s", "destination":"%s"}' % (current_file,
+                                                           dest_path))
+        directories.add(os.path.dirname(current_file))
+        directories.add(os.path.dirname(os.path.dirname(current_file)))
+        result.append((current_file, dest_path))
+        # Trip has_errors to False if it's already False or dest_path is.
+        has_errors = has_errors is True or not dest_path
+
+    # If the folders we moved files out of or their parents are empty we
+    #  delete them. Deeper ones go first so their parents can be empty.
+    for directory in sorted(directories, key=len, reverse=True):
+        FILESYSTEM.delete_directory_if_empty(directory)
 
     result.write()
     
@@ -380,5 +539,6 @@ if __name__ == '__main__':
        u'-config',
         u'"{}"'.format(constants.exiftool_config)
     ]
-    with ExifTool(executable_=get_exiftool(), addedargs=exiftool_addedargs) as et:
+    with ExifTool(executable_=get_exiftool(), addedargs=exiftool_addedargs,
+                  timeout=get_exiftool_timeout()) as et:
         main()
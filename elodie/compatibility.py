@@ -1,9 +1,18 @@
+import hashlib
+import io
 import os
 import shutil
 import sys
+import threading
 
 from elodie import constants
 
+#: Size of the buffer _copyfile() streams files through.
+COPY_BUFFER_SIZE = 8388608
+
+# Every thread gets its own buffer for _copyfile() which it keeps reusing.
+__copy_buffer__ = threading.local()
+
 
 def _decode(string, encoding=sys.getfilesystemencoding()):
     """Return a utf8 encoded unicode string.
@@ -31,43 +40,40 @@ def _bytes(string):
         return bytes(string)
 
 def _copyfile(src, dst):
-    # shutil.copy seems slow, changing to streaming according to
-    # http://stackoverflow.com/questions/22078621/python-how-to-copy-files-fast  # noqa
-    # Python 3 hangs using open/write method so we proceed with shutil.copy
-    #  and only perform the optimized write for Python 2.
-    if (constants.python_version == 3):
-        # Do not use copy2(), it will have an issue when copying to a
-        #  network/mounted drive.
-        # Using copy and manual set_date_from_filename gets the job done.
-        # The calling function is responsible for setting the time.
-        shutil.copy(src, dst)
-        return
-
-    try:
-        O_BINARY = os.O_BINARY
-    except:
-        O_BINARY = 0
-
-    READ_FLAGS = os.O_RDONLY | O_BINARY
-    WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | O_BINARY
-    TEN_MEGABYTES = 10485760
-    BUFFER_SIZE = min(TEN_MEGABYTES, os.path.getsize(src))
-
-    try:
-        fin = os.open(src, READ_FLAGS)
-        stat = os.fstat(fin)
-        fout = os.open(dst, WRITE_FLAGS, stat.st_mode)
-        for x in iter(lambda: os.read(fin, BUFFER_SIZE), ""):
-            os.write(fout, x)
-    finally:
-        try:
-            os.close(fin)
-        except:
-            pass
-        try:
-            os.close(fout)
-        except:
-            pass
+    """Copy `src` to `dst` and return the sha256 of the copied bytes.
+
+    The file is streamed once through a buffer which is reused for every
+    copy made by the same thread. Each chunk is hashed and written from
+    that buffer so no second read of `src` is needed to checksum it.
+
+    Like shutil.copy() the permission bits are copied but not the times.
+    The calling function is responsible for setting the time.
+
+    :param str src: Path of the file to copy.
+    :param str dst: Path to copy the file to.
+    :returns: str
+    """
+    buffer = getattr(__copy_buffer__, 'buffer', None)
+    if buffer is None:
+        buffer = __copy_buffer__.buffer = bytearray(COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    hasher = hashlib.sha256()
+    with io.open(src, 'rb', 0) as fin, io.open(dst, 'wb', 0) as fout:
+        while True:
+            length = fin.readinto(buffer)
+            if not length:
+                break
+            hasher.update(view[:length])
+            # Raw writes may be partial so keep going until it's all out.
+            written = 0
+            while written < length:
+                written += fout.write(view[written:length])
+
+    # Do not use copy2(), it will have an issue when copying to a
+    #  network/mounted drive.
+    shutil.copymode(src, dst)
+    return hasher.hexdigest()
 
 
 # If you want cross-platform overwriting of the destination, 
@@ -77,4 +83,7 @@ def _rename(src, dst):
     if (constants.python_version == 3):
         return os.replace(src, dst)
     else:
+        # os.rename() doesn't overwrite an existing file on Windows.
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
         return os.rename(src, dst)
@@ -1,21 +1,46 @@
 """Load config file as a singleton."""
+import os
+
 from configparser import RawConfigParser
-from os import path
 
 from elodie import constants
 
 config_file = '%s/config.ini' % constants.application_directory
 
 
+def config_stat_key():
+    """Return what identifies the current version of config.ini.
+
+    :returns: tuple of the path, modification time and size, the last two
+        are None if the file does not exist.
+    """
+    try:
+        stat = os.stat(config_file)
+    except OSError:
+        return (config_file, None, None)
+    # st_mtime_ns is only there on Python 3.
+    mtime_ns = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+    return (config_file, mtime_ns, stat.st_size)
+
+
 def load_config():
-    if hasattr(load_config, "config"):
-        return load_config.config
+    """Return the parsed config.ini.
 
-    if not path.exists(config_file):
-        return {}
+    The file is only read again when it changes on disk so callers can ask
+    for it once per file. Values derived from the config can be cached
+    for as long as the same object is returned.
+    """
+    stat_key = config_stat_key()
+    if(hasattr(load_config, "config") and
+            getattr(load_config, "stat_key", None) == stat_key):
+        return load_config.config
 
-    load_config.config = RawConfigParser()
-    load_config.config.read(config_file)
+    if stat_key[1] is None:
+        load_config.config = {}
+    else:
+        load_config.config = RawConfigParser()
+        load_config.config.read(config_file)
+    load_config.stat_key = stat_key
     return load_config.config
 
 def mock_config_ini(config_string):
@@ -19,15 +19,63 @@ if (
 #: File in which to store details about media Elodie has seen.
 hash_db = '{}/hash.json'.format(application_directory)
 
+#: Journal of hash_db entries which haven't been written to hash_db yet.
+hash_db_journal = '{}/hash.json.journal'.format(application_directory)
+
+#: SQLite version of hash_db, used when config.ini asks for it.
+hash_db_sqlite = '{}/hash.db'.format(application_directory)
+
+#: Index of the sizes and partial checksums of files in hash_db.
+hash_index = '{}/hash_index.db'.format(application_directory)
+
+#: File in which to cache checksums of files by their stat details.
+checksum_cache = '{}/checksums.db'.format(application_directory)
+
+#: File in which to cache metadata read by ExifTool.
+metadata_cache = '{}/metadata.db'.format(application_directory)
+
+#: Maximum number of files in metadata_cache.
+metadata_cache_size = 100000
+
+#: If True, checksums are always computed from the file contents.
+rehash = False
+
+#: File in which to store when files were last verified.
+verify_db = '{}/verify.db'.format(application_directory)
+
 #: File in which to store geolocation details about media Elodie has seen.
 location_db = '{}/location.json'.format(application_directory)
 
+#: Compiled index of the gazetteer used by the offline geolocation engine.
+gazetteer_index = '{}/gazetteer.idx'.format(application_directory)
+
+#: File in which to store where geolocation lookups found nothing.
+location_miss_db = '{}/location_misses.json'.format(application_directory)
+
+#: Seconds before a geolocation lookup which found nothing is tried again.
+location_miss_ttl = 7 * 24 * 60 * 60
+
+#: Number of new locations held in memory before location_db is written.
+location_db_flush_every = 50
+
+#: Seconds new locations are held in memory before location_db is written.
+location_db_flush_interval = 30
+
 #: Elodie installation directory.
 script_directory = path.dirname(path.dirname(path.abspath(__file__)))
 
 #: Path to Elodie's ExifTool config file.
 exiftool_config = path.join(script_directory, 'configs', 'ExifTool_config')
 
+#: Number of files to read metadata for in a single ExifTool call.
+exiftool_batch_size = 64
+
+#: Seconds a single ExifTool call may take before the process is restarted.
+exiftool_timeout = 60
+
+#: Read JPEG and TIFF based photos without ExifTool when possible.
+native_exif = True
+
 #: Path to MapQuest base URL
 mapquest_base_url = 'https://open.mapquestapi.com'
 if (
@@ -36,6 +84,18 @@ if (
     ):
     mapquest_base_url = environ['ELODIE_MAPQUEST_BASE_URL']
 
+#: Seconds to wait for MapQuest to connect and to respond.
+mapquest_timeout = 10
+
+#: Number of times a failed MapQuest request is retried.
+mapquest_retries = 3
+
+#: Maximum number of MapQuest requests per second.
+mapquest_requests_per_second = 5
+
+#: Number of place names looked up at the same time before an import.
+geocode_prefetch_workers = 4
+
 #: MapQuest key from environment
 mapquest_key = None
 if (
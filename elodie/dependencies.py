@@ -8,6 +8,10 @@ import os
 import sys
 from distutils.spawn import find_executable
 
+from elodie import constants
+from elodie import log
+from elodie.config import load_config
+
 
 #: Error to print when exiftool can't be found.
 EXIFTOOL_ERROR = u"""
@@ -34,6 +38,25 @@ def get_exiftool():
     return path
 
 
+def get_exiftool_timeout():
+    """Get the number of seconds a single exiftool call may take.
+
+    It can be set with `timeout` in the [ExifTool] section of config.ini.
+    A value of 0 waits forever.
+
+    :returns: float or None
+    """
+    timeout = constants.exiftool_timeout
+    config = load_config()
+    if 'ExifTool' in config and 'timeout' in config['ExifTool']:
+        try:
+            timeout = float(config['ExifTool']['timeout'])
+        except ValueError:
+            log.error('Invalid timeout in the [ExifTool] section of config.ini')
+
+    return timeout or None
+
+
 def verify_dependencies():
     """Verify that external dependencies are installed.
 
@@ -17,12 +17,17 @@ from elodie.config import load_config
 #from elodie.filesystem import FileSystem
 
 # +++ the extended folder_path handler
-from elodie.destination_path_config import Destination_path_pattern, Destination_actual_path
+from elodie.destination_path_config import load_full_path
 from elodie import constants
 
 config_file = '%s/config.ini' % constants.application_directory
 # --- the extended folder_path handler
 
+# Splits a location mask like %city-%state into ['%city-', '%state'].
+LOCATION_PARTS_REGEX = re.compile('(%[^%]+)')
+# Splits a location part like %city- into ('%city-', '%city', 'city').
+LOCATION_PART_REGEX = re.compile('((%([a-z]+))[^%]*)')
+
 class DestinationFolder(object):
     """A class for calculating the destination folder for a file."""
 
@@ -36,6 +41,8 @@ class DestinationFolder(object):
                          ),
         }
         self.cached_folder_path_definition = None
+        self.cached_folder_path_plan = None
+        self.cached_config = None
         self.default_parts = ['album', 'city', 'state', 'country']
 
 
@@ -68,13 +75,14 @@ class DestinationFolder(object):
 
         :returns: list
         """
-        # If we've done this already then return it immediately without
-        # incurring any extra work
-        if self.cached_folder_path_definition is not None:
-            return self.cached_folder_path_definition
-
         config = load_config()
 
+        # If we've done this already for this config.ini then return it
+        # immediately without incurring any extra work
+        if(self.cached_folder_path_definition is not None and
+                self.cached_config is config):
+            return self.cached_folder_path_definition
+
         # If Directory is in the config we assume full_path and its
         #  corresponding values (date, location) are also present
         config_directory = self.default_folder_path_definition
@@ -92,6 +100,7 @@ class DestinationFolder(object):
         if not path_parts or len(path_parts) == 0:
             return self.default_folder_path_definition
 
+        self.cached_config = config
         self.cached_folder_path_definition = []
         for part in path_parts:
             part = part.replace('%', '')
@@ -118,30 +127,37 @@ class DestinationFolder(object):
 
         return self.cached_folder_path_definition
 
-    def get_folder_path(self, metadata, path_parts=None):
-        """Given a media's metadata this function returns the folder path as a string.
+    def get_folder_path_plan(self):
+        """Returns the folder path definition compiled by
+        :meth:`compile_folder_path`.
 
-        :param metadata dict: Metadata dictionary.
-        :optional param path_parts list of tuples: Pre-defined path definition (for unit test)
-        :returns: str
+        The plan is compiled again only when the definition changes.
+
+        :returns: list
         """
+        path_parts = self.get_folder_path_definition()
+        if(self.cached_folder_path_plan is None or
+                self.cached_folder_path_plan[0] is not path_parts):
+            self.cached_folder_path_plan = (
+                path_parts,
+                self.compile_folder_path(path_parts)
+            )
 
-        # Stitch in the extended folder_path handler
-        config = Destination_path_pattern()
-        config_ini = os.path.join(os.getcwd(), 'elodie', 'tests', 'files', 'config_extended_1.ini')
-        config.read_config_file(config_file)
-        raw_full_path = config.get_raw_full_path()
-        if raw_full_path != '':
-            fpconfig = Destination_actual_path(raw_full_path, '') # Don't need the filepath as we'll fake the metadata
-            fpconfig._set_metadata(metadata)
-            full_path = fpconfig.get_full_path()
-            return full_path
-        # else extended folder_path handler is not specified in config.ini
+        return self.cached_folder_path_plan[1]
 
+    def compile_folder_path(self, path_parts):
+        """Turns a folder path definition into a render plan.
 
-        if not path_parts:
-            path_parts = self.get_folder_path_definition()
-        path = []
+        Each folder becomes a list of fallbacks in the form of
+        (render, final) tuples. `render` takes the metadata and returns the
+        folder name or None if the fallback doesn't apply. When `final` is
+        True the remaining fallbacks are skipped.
+
+        :param list path_parts: Definition from
+            :meth:`get_folder_path_definition`.
+        :returns: list
+        """
+        plan = []
         for path_part in path_parts:
             # We support fallback values so that
             #  'album|city|"Unknown Location"
@@ -149,34 +165,73 @@ class DestinationFolder(object):
             #  My Album - when an album exists
             #  Sunnyvale - when no album exists but a city exists
             #  Unknown Location - when neither an album nor location exist
+            fallbacks = []
             for this_part in path_part:
                 part, mask = this_part
                 if part in ('date', 'day', 'month', 'year'):
-                    path.append(
-                        time.strftime(mask, metadata['date_taken'])
-                    )
-                    break
+                    fallbacks.append((self._compile_date(mask), True))
                 elif part in ('location', 'hamlet', 'village', 'town', 'city', 'state', 'country'):
-                    place_name = geolocation.place_name(
-                        metadata['latitude'],
-                        metadata['longitude']
-                    )
-
-                    # TBD _x = self._parseFallbacks(metadata, mask)
-                    location_parts = re.findall('(%[^%]+)', mask)
-                    parsed_folder_name = self.parse_mask_for_location(
-                        mask,
-                        location_parts,
-                        place_name,
-                    )
-                    path.append(parsed_folder_name)
-                    break
+                    fallbacks.append((self._compile_location(mask), True))
                 elif part in ('album', 'camera_make', 'camera_model'):
-                    if metadata[part]:
-                        path.append(metadata[part])
-                        break
+                    fallbacks.append((self._compile_metadata(part), True))
                 elif part.startswith('"') and part.endswith('"'):
-                    path.append(part[1:-1])
+                    fallbacks.append((self._compile_text(part[1:-1]), False))
+            plan.append(fallbacks)
+
+        return plan
+
+    def _compile_date(self, mask):
+        return lambda metadata: time.strftime(mask, metadata['date_taken'])
+
+    def _compile_location(self, mask):
+        location_parts = LOCATION_PARTS_REGEX.findall(mask)
+
+        def render(metadata):
+            place_name = geolocation.place_name(
+                metadata['latitude'],
+                metadata['longitude']
+            )
+            return self.parse_mask_for_location(
+                mask,
+                location_parts,
+                place_name,
+            )
+        return render
+
+    def _compile_metadata(self, part):
+        return lambda metadata: metadata[part] or None
+
+    def _compile_text(self, text):
+        return lambda metadata: text
+
+    def get_folder_path(self, metadata, path_parts=None):
+        """Given a media's metadata this function returns the folder path as a string.
+
+        :param metadata dict: Metadata dictionary.
+        :optional param path_parts list of tuples: Pre-defined path definition (for unit test)
+        :returns: str
+        """
+
+        # Stitch in the extended folder_path handler
+        full_path = load_full_path(config_file)
+        if full_path is not None:
+            return full_path.render(metadata)
+        # else extended folder_path handler is not specified in config.ini
+
+        if path_parts:
+            plan = self.compile_folder_path(path_parts)
+        else:
+            plan = self.get_folder_path_plan()
+
+        path = []
+        for fallbacks in plan:
+            for render, final in fallbacks:
+                folder_name = render(metadata)
+                if folder_name is None:
+                    continue
+                path.append(folder_name)
+                if final:
+                    break
 
         return os.path.join(*path)
 
@@ -217,8 +272,7 @@ class DestinationFolder(object):
             # component_full = '%country-random'
             # component = '%country'
             # key = 'country
-            component_full, component, key = re.search(
-                '((%([a-z]+))[^%]*)',
+            component_full, component, key = LOCATION_PART_REGEX.search(
                 loc_part
             ).groups()
 
@@ -1,4 +1,5 @@
 from configparser import ConfigParser, ExtendedInterpolation
+import os
 import re
 import time
 
@@ -91,51 +92,106 @@ class Destination_actual_path():
         Then evaluate any <conditional terms> and return the first one
         that has a value (i.e. has no UNKNOWNs)
         """
-        # Extract atoms
-        atoms = re.findall(
-            '\%([^/|-]+)',      # separators are / | -
-            raw_full_path)
-        atom_dict = {}
-        for atom in atoms:
-            if atom in ('location', 'hamlet', 'village', 'town', 'city', 'state', 'country', 'county'):
-                if atom in self.metadata:
-                    atom_dict[atom] = self.metadata[atom]
-                else:
-                    if 'lat' in self.metadata:  # We have latitude but don't have this location type
-                        atom_dict[atom] = '€UNKNOWN LOCATION'   # € is a "magic char" for fallback processing
-                    else:
-                        atom_dict[atom] = '€NO GPS'   # € is a "magic char" for fallback processing
-            elif atom in ('camera_make', 'camera_model'):
-                if atom in self.metadata:
-                    atom_dict[atom] = self.metadata[atom]
-                else:
-                    atom_dict[atom] = '€NO CAMERA INFO'
-            elif atom.startswith('"'):
-                atom_dict[atom] = atom.strip('"') # Pass strings straight through unchanged
-            else:
-                try:
-                    atom_dict[atom] = time.strftime(r'%'+atom, self.metadata['date_taken'])
-                except:
-                    assert True, ('Unknown time format "%%%s"' % atom)
-        for atom in atoms:
-            #_fmt = '%%%s' % atom
-            raw_full_path = re.sub('%%%s' % atom, atom_dict[atom], raw_full_path)
-
-        # Now deal with fallbacks
-        # Split the path at each |
-        fallbacks = raw_full_path.split('|')
-        for i in range(0, len(fallbacks)-1):    # -1 so as not to strip the final fallback
-            fallback = fallbacks[i]
-            if '€' in fallback:
-                # strip the (LHS) fallback and its separator
-                raw_full_path = raw_full_path[len(fallback)+1:]
-            else: # this one is OK, strip the rest
-                raw_full_path = raw_full_path[:len(fallback)]
-                break
-        raw_full_path = re.sub('€', '', raw_full_path)
-
-        return raw_full_path.strip()
+        return Compiled_full_path(raw_full_path).render(self.metadata)
     def get_full_path(self):
         _return = self.__parse_full_path(self.raw_full_path)
         return _return
 
+
+
+# Extract atoms, separators are / | -
+ATOM_REGEX = re.compile(r'%([^/|-]+)')
+
+LOCATION_ATOMS = ('location', 'hamlet', 'village', 'town', 'city', 'state', 'country', 'county')
+CAMERA_ATOMS = ('camera_make', 'camera_model')
+
+# € is a "magic char" for fallback processing
+FALLBACK_CHAR = '€'
+
+def _literal(text):
+    return lambda metadata: text
+
+def _location_atom(atom):
+    def render(metadata):
+        if atom in metadata:
+            return metadata[atom]
+        if 'lat' in metadata:  # We have latitude but don't have this location type
+            return FALLBACK_CHAR + 'UNKNOWN LOCATION'
+        return FALLBACK_CHAR + 'NO GPS'
+    return render
+
+def _camera_atom(atom):
+    def render(metadata):
+        if atom in metadata:
+            return metadata[atom]
+        return FALLBACK_CHAR + 'NO CAMERA INFO'
+    return render
+
+def _time_atom(atom):
+    time_format = '%' + atom
+    return lambda metadata: time.strftime(time_format, metadata['date_taken'])
+
+def _compile_atom(atom):
+    if atom in LOCATION_ATOMS:
+        return _location_atom(atom)
+    elif atom in CAMERA_ATOMS:
+        return _camera_atom(atom)
+    elif atom.startswith('"'):
+        return _literal(atom.strip('"')) # Pass strings straight through unchanged
+    return _time_atom(atom)
+
+class Compiled_full_path():
+    """
+    A 'full_path' definition turned into a render plan.
+
+    Each <conditional term> is a list of callables which take the metadata
+    and return a piece of the path, so that rendering a path for a file
+    doesn't need to parse the definition again.
+    """
+    def __init__(self, raw_full_path):
+        self.raw_full_path = raw_full_path
+        self.fallbacks = []
+        for fallback in raw_full_path.split('|'):
+            plan = []
+            position = 0
+            for match in ATOM_REGEX.finditer(fallback):
+                if match.start() > position:
+                    plan.append(_literal(fallback[position:match.start()]))
+                plan.append(_compile_atom(match.group(1)))
+                position = match.end()
+            if position < len(fallback):
+                plan.append(_literal(fallback[position:]))
+            self.fallbacks.append(plan)
+    def render(self, metadata):
+        """ Return the first fallback which has a value for every atom """
+        for plan in self.fallbacks[:-1]:    # so as not to check the final fallback
+            path = ''.join([atom(metadata) for atom in plan])
+            if FALLBACK_CHAR not in path:
+                return path.strip()
+        path = ''.join([atom(metadata) for atom in self.fallbacks[-1]])
+        return path.replace(FALLBACK_CHAR, '').strip()
+
+def load_full_path(config_filepath):
+    """
+    Return the Compiled_full_path for the [Folder] section of config_filepath
+    or None if there is no 'full_path' definition.
+    The file is only read again when its modification time changes.
+    """
+    try:
+        stat = os.stat(config_filepath)
+        # st_mtime_ns is only there on Python 3.
+        mtime_ns = getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+        stat_key = (config_filepath, mtime_ns, stat.st_size)
+    except OSError:
+        stat_key = (config_filepath, None, None)
+
+    if load_full_path.cache is not None and load_full_path.cache[0] == stat_key:
+        return load_full_path.cache[1]
+
+    config = Destination_path_pattern()
+    config.read_config_file(config_filepath)
+    raw_full_path = config.get_raw_full_path()
+    compiled = Compiled_full_path(raw_full_path) if raw_full_path != '' else None
+    load_full_path.cache = (stat_key, compiled)
+    return compiled
+load_full_path.cache = None
@@ -0,0 +1,288 @@
+"""
+Read the metadata Elodie uses from JPEG and TIFF based photos without
+exiftool.
+
+Only the EXIF dates, camera make and model, GPS coordinates and the XMP
+title, album and original file name are read. They're returned with the
+same names and values as ``exiftool -j -G -n`` so
+:class:`~elodie.media.media.Media` can't tell the difference. Files which
+can't be decoded here are left for exiftool.
+
+The file is memory-mapped so only the pages holding the metadata, which is
+at the start of a JPEG, are read from disk.
+"""
+from __future__ import division
+
+import io
+import mmap
+import struct
+
+from xml.etree import ElementTree
+
+#: Marker of the APP1 segment holding EXIF in a JPEG.
+APP1 = 0xE1
+#: Markers after which a JPEG has no more metadata segments.
+END_OF_METADATA = (0xDA, 0xD9)
+#: Markers which stand alone without a length.
+STANDALONE = (0x01, 0xD8) + tuple(range(0xD0, 0xD8))
+
+EXIF_HEADER = b'Exif\0\0'
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\0'
+EXTENDED_XMP_HEADER = b'http://ns.adobe.com/xmp/extension/\0'
+
+#: Tags of IFD0 by their id.
+IFD0_TAGS = {
+    0x010F: 'EXIF:Make',
+    0x0110: 'EXIF:Model',
+    0x0132: 'EXIF:ModifyDate',
+}
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+XMP_PACKET = 0x02BC
+
+#: Tags of the EXIF IFD by their id.
+EXIF_IFD_TAGS = {
+    0x9003: 'EXIF:DateTimeOriginal',
+    0x9004: 'EXIF:CreateDate',
+}
+
+#: Tags of the GPS IFD by their id.
+GPS_IFD_TAGS = {
+    0x0001: 'EXIF:GPSLatitudeRef',
+    0x0002: 'EXIF:GPSLatitude',
+    0x0003: 'EXIF:GPSLongitudeRef',
+    0x0004: 'EXIF:GPSLongitude',
+}
+
+#: Size in bytes of the TIFF field types by their id.
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+ASCII = 2
+RATIONAL = 5
+
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+#: XMP properties by their qualified name.
+XMP_TAGS = {
+    '{http://purl.org/dc/elements/1.1/}title': 'XMP:Title',
+    '{https://github.com/jmathai/elodie/}Album': 'XMP:Album',
+    '{http://ns.adobe.com/xmp/1.0/DynamicMedia/}album': 'XMP:Album',
+    '{http://xmp.gettyimages.com/gift/1.0/}OriginalFilename':
+        'XMP:OriginalFileName',
+}
+
+
+def read(source):
+    """Read the metadata of a JPEG or TIFF based photo.
+
+    :param str source: Fully qualified path to the photo.
+    :returns: dict in the format of
+        :meth:`~elodie.external.pyexiftool.ExifTool.get_metadata` or None
+        if the file has to be read with exiftool.
+    """
+    try:
+        with io.open(source, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        return None
+
+    try:
+        if data[:2] == b'\xff\xd8':
+            metadata = read_jpeg(data)
+        elif data[:4] in (b'II*\0', b'MM\0*'):
+            metadata = read_tiff(data)
+        else:
+            metadata = None
+    except (IndexError, ValueError, struct.error, ElementTree.ParseError):
+        metadata = None
+    finally:
+        data.close()
+
+    if metadata is None:
+        return None
+
+    metadata['SourceFile'] = source
+    return metadata
+
+
+def read_jpeg(data):
+    """Read the metadata from the segments at the start of a JPEG.
+
+    :param data: The contents of the JPEG.
+    :returns: dict or None
+    """
+    metadata = {}
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset:offset + 1] != b'\xff':
+            return None
+        marker = ord(data[offset + 1:offset + 2])
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        if marker in STANDALONE:
+            offset += 2
+            continue
+        if marker in END_OF_METADATA:
+            break
+
+        length, = struct.unpack_from('>H', data, offset + 2)
+        if marker == APP1:
+            segment = data[offset + 4:offset + 2 + length]
+            if segment.startswith(EXIF_HEADER):
+                metadata.update(read_tiff(segment[len(EXIF_HEADER):]))
+            elif segment.startswith(XMP_HEADER):
+                metadata.update(read_xmp(segment[len(XMP_HEADER):]))
+            elif segment.startswith(EXTENDED_XMP_HEADER):
+                # Split over several segments, exiftool puts it together.
+                return None
+        offset += 2 + length
+
+    return metadata
+
+
+def read_tiff(data):
+    """Read the metadata from a TIFF structure.
+
+    :param data: The TIFF structure, from its byte order mark.
+    :returns: dict
+    """
+    if data[:2] == b'II':
+        order = '<'
+    elif data[:2] == b'MM':
+        order = '>'
+    else:
+        raise ValueError('Not a TIFF structure')
+
+    ifd0_offset, = struct.unpack_from(order + 'I', data, 4)
+    ifd0 = read_ifd(data, order, ifd0_offset)
+
+    metadata = {}
+    for tag, name in IFD0_TAGS.items():
+        if tag in ifd0:
+            metadata[name] = get_string(data, ifd0[tag])
+
+    if EXIF_IFD_POINTER in ifd0:
+        exif_ifd = read_ifd(data, order, get_long(data, order, ifd0[EXIF_IFD_POINTER]))
+        for tag, name in EXIF_IFD_TAGS.items():
+            if tag in exif_ifd:
+                metadata[name] = get_string(data, exif_ifd[tag])
+
+    if GPS_IFD_POINTER in ifd0:
+        gps_ifd = read_ifd(data, order, get_long(data, order, ifd0[GPS_IFD_POINTER]))
+        for tag, name in GPS_IFD_TAGS.items():
+            if tag not in gps_ifd:
+                continue
+            if gps_ifd[tag][0] == RATIONAL:
+                metadata[name] = get_degrees(data, order, gps_ifd[tag])
+            else:
+                metadata[name] = get_string(data, gps_ifd[tag])
+
+    if XMP_PACKET in ifd0:
+        field_type, count, offset = ifd0[XMP_PACKET]
+        metadata.update(read_xmp(data[offset:offset + count]))
+
+    # Empty values aren't returned by exiftool either.
+    return dict(
+        (name, value) for name, value in metadata.items() if value != ''
+    )
+
+
+def read_ifd(data, order, offset):
+    """Read the fields of an image file directory.
+
+    :returns: dict of (type, count, offset of the value) by tag id.
+    """
+    count, = struct.unpack_from(order + 'H', data, offset)
+    fields = {}
+    for index in range(count):
+        entry = offset + 2 + index * 12
+        tag, field_type, value_count = struct.unpack_from(
+            order + 'HHI',
+            data,
+            entry
+        )
+        if field_type not in TYPE_SIZES:
+            continue
+        # Values of up to four bytes are stored in the entry itself.
+        value_offset = entry + 8
+        if TYPE_SIZES[field_type] * value_count > 4:
+            value_offset, = struct.unpack_from(order + 'I', data, entry + 8)
+            if value_offset + TYPE_SIZES[field_type] * value_count > len(data):
+                raise ValueError('Field %x is out of bounds' % tag)
+        fields[tag] = (field_type, value_count, value_offset)
+    return fields
+
+
+def get_string(data, field):
+    field_type, count, offset = field
+    if field_type != ASCII:
+        raise ValueError('Expected a string')
+    value = data[offset:offset + count].split(b'\0', 1)[0]
+    try:
+        return value.decode('utf-8')
+    except UnicodeDecodeError:
+        return value.decode('latin-1')
+
+
+def get_long(data, order, field):
+    field_type, count, offset = field
+    if field_type == 3:
+        return struct.unpack_from(order + 'H', data, offset)[0]
+    return struct.unpack_from(order + 'I', data, offset)[0]
+
+
+def get_degrees(data, order, field):
+    """Convert degrees, minutes and seconds to decimal degrees.
+
+    :returns: float
+    """
+    field_type, count, offset = field
+    if count > 3:
+        raise ValueError('Expected degrees, minutes and seconds')
+    degrees = 0
+    for index in range(count):
+        numerator, denominator = struct.unpack_from(
+            order + 'II',
+            data,
+            offset + index * 8
+        )
+        if denominator == 0:
+            # exiftool has its own way of showing these.
+            raise ValueError('Invalid coordinate')
+        degrees += numerator / denominator / (60 ** index)
+    return degrees
+
+
+def read_xmp(packet):
+    """Read the title, album and original file name from an XMP packet.
+
+    :param bytes packet: The XMP packet.
+    :returns: dict
+    """
+    root = ElementTree.fromstring(bytes(packet).strip(b'\0 \t\r\n'))
+    metadata = {}
+    for description in root.iter(RDF + 'Description'):
+        for name, value in description.attrib.items():
+            if name in XMP_TAGS:
+                metadata[XMP_TAGS[name]] = value
+        for element in description:
+            if element.tag in XMP_TAGS:
+                metadata[XMP_TAGS[element.tag]] = get_xmp_value(element)
+    return metadata
+
+
+def get_xmp_value(element):
+    """Get the value of a simple, alternative or list XMP property.
+
+    The x-default of alternatives is preferred like exiftool does.
+    """
+    items = element.findall('*/' + RDF + 'li')
+    if not items:
+        return (element.text or '').strip()
+
+    for item in items:
+        if item.get(XML_LANG) == 'x-default':
+            return (item.text or '').strip()
+    return (items[0].text or '').strip()
@@ -64,8 +64,11 @@ import json
 import warnings
 import logging
 import codecs
+import threading
 
+from contextlib import contextmanager
 from future.utils import with_metaclass
+from queue import Empty, Queue
 
 try:        # Py3k compatibility
     basestring
@@ -85,8 +88,9 @@ sentinel = b"{ready}"
 
 # The block size when reading from exiftool.  The standard value
 # should be fine, though other values might give better performance in
-# some cases.
-block_size = 4096
+# some cases.  It matches the size of a pipe's buffer on Linux so large
+# outputs are read in as few calls as possible.
+block_size = 65536
 
 # constants related to keywords manipulations 
 KW_TAGNAME = "IPTC:Keywords"
@@ -153,15 +157,43 @@ def format_error (result):
         else:
             return 'exiftool finished with error: "%s"' % strip_nl(result) 
 
+class ExifToolTimeout(ValueError):
+    """Raised when ``exiftool`` doesn't answer before the deadline.
+
+    The process is replaced by a new one before this is raised, so the
+    instance can be used for the next request.
+    """
+
 class Singleton(type):
-    """Metaclass to use the singleton [anti-]pattern"""
+    """Metaclass to use the singleton [anti-]pattern
+
+    A thread can bind its own instance with :py:meth:`bind_thread()`.
+    That instance is then returned to every call made from that thread
+    instead of the process wide one.  This lets worker threads each talk
+    to their own ``exiftool`` process.
+    """
     instance = None
+    thread_local = threading.local()
 
     def __call__(cls, *args, **kwargs):
+        thread_instance = getattr(Singleton.thread_local, 'instance', None)
+        if thread_instance is not None:
+            return thread_instance
         if cls.instance is None:
             cls.instance = super(Singleton, cls).__call__(*args, **kwargs)
         return cls.instance
 
+    def new_instance(cls, *args, **kwargs):
+        """Create an instance which is not the shared singleton."""
+        return super(Singleton, cls).__call__(*args, **kwargs)
+
+    def bind_thread(cls, instance):
+        """Use `instance` for calls made from the current thread.
+
+        Passing None restores the process wide singleton.
+        """
+        Singleton.thread_local.instance = instance
+
 class ExifTool(object, with_metaclass(Singleton)):
     """Run the `exiftool` command-line tool and communicate to it.
 
@@ -171,6 +203,10 @@ class ExifTool(object, with_metaclass(Singleton)):
     - ``executable`` (string): file name of the ``exiftool`` executable.
       The default value ``exiftool`` will only work if the executable
       is in your ``PATH``
+    - ``timeout`` (number): seconds a single :py:meth:`execute()` may
+      take.  A process which takes longer is killed and started again
+      and :py:class:`ExifToolTimeout` is raised.  The default ``None``
+      waits forever.
 
     Most methods of this class are only available after calling
     :py:meth:`start()`, which will actually launch the subprocess.  To
@@ -201,7 +237,7 @@ class ExifTool(object, with_metaclass(Singleton)):
        associated with a running subprocess.
     """
 
-    def __init__(self, executable_=None, addedargs=None):
+    def __init__(self, executable_=None, addedargs=None, timeout=None):
         
         if executable_ is None:
             self.executable = executable
@@ -214,7 +250,8 @@ class ExifTool(object, with_metaclass(Singleton)):
             self.addedargs = addedargs
         else:
             raise TypeError("addedargs not a list of strings")
-        
+
+        self.timeout = timeout
         self.running = False
 
     def start(self):
@@ -246,12 +283,31 @@ class ExifTool(object, with_metaclass(Singleton)):
         """
         if not self.running:
             return
-        self._process.stdin.write(b"-stay_open\nFalse\n")
-        self._process.stdin.flush()
+        if self._process.poll() is None:
+            self._process.stdin.write(b"-stay_open\nFalse\n")
+            self._process.stdin.flush()
         self._process.communicate()
         del self._process
         self.running = False
 
+    def is_alive(self):
+        """Check that the ``exiftool`` process is still running."""
+        return self.running and self._process.poll() is None
+
+    def restart(self):
+        """Kill the ``exiftool`` process and start a new one."""
+        if self.running:
+            self._process.kill()
+            for stream in (self._process.stdin, self._process.stdout):
+                try:
+                    stream.close()
+                except (IOError, OSError):
+                    pass
+            self._process.wait()
+            del self._process
+            self.running = False
+        self.start()
+
     def __enter__(self):
         self.start()
         return self
@@ -281,15 +337,65 @@ class ExifTool(object, with_metaclass(Singleton)):
         .. note:: This is considered a low-level method, and should
            rarely be needed by application developers.
         """
+        return bytes(self._execute(*params))
+
+    def _execute(self, *params):
+        """Like :py:meth:`execute()` but returns the ``bytearray`` which
+        the output was read into, saving a copy of large outputs.
+        """
         if not self.running:
             raise ValueError("ExifTool instance not running.")
-        self._process.stdin.write(b"\n".join(params + (b"-execute\n",)))
-        self._process.stdin.flush()
-        output = b""
-        fd = self._process.stdout.fileno()
-        while not output[-32:].strip().endswith(sentinel):
-            output += os.read(fd, block_size)
-        return output.strip()[:-len(sentinel)]
+        if not self.is_alive():
+            logging.warning("exiftool exited; starting it again.")
+            self.restart()
+
+        # A watchdog kills the process when the deadline passes, which
+        # ends the read below.
+        process = self._process
+        expired = threading.Event()
+        watchdog = None
+        if self.timeout is not None:
+            def expire():
+                expired.set()
+                process.kill()
+            watchdog = threading.Timer(self.timeout, expire)
+            watchdog.daemon = True
+            watchdog.start()
+
+        # Appending to a bytearray takes linear time overall where
+        # concatenating bytes copies everything read so far every time.
+        # Only the last few bytes are looked at for the sentinel.
+        output = bytearray()
+        try:
+            process.stdin.write(b"\n".join(params + (b"-execute\n",)))
+            process.stdin.flush()
+            fd = process.stdout.fileno()
+            while not output[-32:].strip().endswith(sentinel):
+                block = os.read(fd, block_size)
+                if not block:
+                    break
+                output += block
+        except (IOError, OSError):
+            pass
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+
+        if not output[-32:].strip().endswith(sentinel):
+            self.restart()
+            if expired.is_set():
+                raise ExifToolTimeout(
+                    "exiftool took longer than %s seconds." % self.timeout)
+            raise ValueError("exiftool exited unexpectedly.")
+
+        # Strip the sentinel and the white space around the output in place.
+        tail = output[-32:]
+        del output[len(output) - len(tail) + len(tail.rstrip()) - len(sentinel):]
+        start = 0
+        while start < len(output) and output[start:start + 1].isspace():
+            start += 1
+        del output[:start]
+        return output
 
     def execute_json(self, *params):
         """Execute the given batch of parameters and parse the JSON output.
@@ -318,10 +424,11 @@ class ExifTool(object, with_metaclass(Singleton)):
         # Try utf-8 and fallback to latin.
         # http://stackoverflow.com/a/5552623/1318758
         # https://github.com/jmathai/elodie/issues/127
+        output = self._execute(b"-j", *params)
         try:
-            return json.loads(self.execute(b"-j", *params).decode("utf-8"))
+            return json.loads(output.decode("utf-8"))
         except UnicodeDecodeError as e:
-            return json.loads(self.execute(b"-j", *params).decode("latin-1"))
+            return json.loads(output.decode("latin-1"))
 
     def get_metadata_batch(self, filenames):
         """Return all meta-data for the given files.
@@ -396,7 +503,7 @@ class ExifTool(object, with_metaclass(Singleton)):
         """
         return self.get_tag_batch(tag, [filename])[0]
 
-    def set_tags_batch(self, tags, filenames):
+    def set_tags_batch(self, tags, filenames, error_file=None):
         """Writes the values of the specified tags for the given files.
 
         The first argument is a dictionary of tags and values.  The tag names may
@@ -404,6 +511,9 @@ class ExifTool(object, with_metaclass(Singleton)):
 
         The second argument is an iterable of file names.
 
+        If ``error_file`` is given, ``exiftool`` appends the names of the
+        files it couldn't write to that file (``-efile``).
+
         The format of the return value is the same as for
         :py:meth:`execute()`.
         
@@ -420,6 +530,8 @@ class ExifTool(object, with_metaclass(Singleton)):
                 
         params = []
         params_utf8 = []
+        if error_file is not None:
+            params.extend([u'-efile', error_file])
         for tag, value in tags.items():
             params.append(u'-%s=%s' % (tag, value))
             
@@ -485,3 +597,78 @@ class ExifTool(object, with_metaclass(Singleton)):
         as a string. 
         """
         return self.set_keywords_batch(mode, keywords, [filename])
+
+
+class ExifToolPool(object):
+    """Hand out ``exiftool`` processes to threads one request at a time.
+
+    Up to ``size`` processes are started as they are needed.  A process
+    which exited is started again before it's handed out.  The arguments
+    are the same as for :py:class:`ExifTool`.
+
+    Example usage::
+
+        with ExifToolPool(4, timeout=60) as pool:
+            with pool.borrow() as et:
+                metadata = et.get_metadata("a.jpg")
+    """
+
+    def __init__(self, size, executable_=None, addedargs=None, timeout=None):
+        self.size = max(1, size)
+        self.executable = executable_
+        self.addedargs = addedargs
+        self.timeout = timeout
+        self.instances = []
+        self.idle = Queue()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take a running :py:class:`ExifTool` instance out of the pool.
+
+        Waits for another thread to :py:meth:`release()` one when all
+        ``size`` processes are busy.
+        """
+        try:
+            instance = self.idle.get_nowait()
+        except Empty:
+            instance = None
+            with self.lock:
+                if len(self.instances) < self.size:
+                    instance = ExifTool.new_instance(
+                        executable_=self.executable,
+                        addedargs=self.addedargs,
+                        timeout=self.timeout)
+                    self.instances.append(instance)
+            if instance is None:
+                instance = self.idle.get()
+
+        if not instance.is_alive():
+            instance.restart()
+        return instance
+
+    def release(self, instance):
+        """Put an instance taken by :py:meth:`acquire()` back."""
+        self.idle.put(instance)
+
+    @contextmanager
+    def borrow(self):
+        """Context manager which acquires and releases an instance."""
+        instance = self.acquire()
+        try:
+            yield instance
+        finally:
+            self.release(instance)
+
+    def terminate(self):
+        """Terminate every process of the pool."""
+        with self.lock:
+            for instance in self.instances:
+                instance.terminate()
+            self.instances = []
+            self.idle = Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.terminate()
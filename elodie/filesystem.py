@@ -9,24 +9,58 @@ from builtins import object
 import os
 import re
 import shutil
+import threading
 import time
 
 from elodie import compatibility
+from elodie import geolocation
 from elodie import log
+from elodie.config import load_config
 from elodie.localstorage import Db
 from elodie.media.base import Base, get_all_subclasses
-from elodie.destination_folder import DestinationFolder
+from elodie.destination_folder import DestinationFolder, LOCATION_PARTS_REGEX
+from elodie.external.pyexiftool import ExifToolTimeout
 from elodie.plugins.plugins import Plugins
 
 class FileSystem(object):
     """A class for interacting with the file system."""
 
     def __init__(self):
+        # The default file name is along the lines of
+        #  2015-01-01_00-00-00-img_0001-my-title.jpg
+        self.default_file_name_definition = {
+            'date': '%Y-%m-%d_%H-%M-%S',
+            'name': '%date-%original_name-%title.%extension',
+        }
+        self.cached_file_name_definition = None
+        self.cached_file_name_plan = None
+        self.cached_config = None
+
+        # Used when sanitizing file names.
+        self.whitespace_regex = re.compile('[ \t\n\r\f\v]+')
+        # Used to remove the separator in front of a placeholder which has
+        #  no value. For example, %title- will be replaced with ''.
+        self.trailing_separator_regex = re.compile('[^a-zA-Z0-9_]+$')
+        self.placeholder_regex = re.compile('%[a-z_]+')
+
         self.destination_folder = DestinationFolder()
 
         # Instantiate a plugins object
         self.plugins = Plugins()
 
+        # When files are processed by several workers the hash db lookups
+        #  and writes are serialized. Partial checksums of files which are
+        #  being imported are tracked and a file with the same partial
+        #  checksum waits for them so that a duplicate being imported at
+        #  the same time is detected just as it would be when run
+        #  sequentially.
+        # Plugins aren't expected to be thread safe so they're serialized
+        #  too.
+        self.hash_db_lock = threading.RLock()
+        self.hash_db_condition = threading.Condition(self.hash_db_lock)
+        self.partials_in_progress = set()
+        self.plugins_lock = threading.RLock()
+
     def create_directory(self, directory_path):
         """Create a directory if it does not already exist.
 
@@ -117,6 +151,58 @@ class FileSystem(object):
         if(metadata is None):
             return None
 
+        literals, plan, upper = self.get_file_name_plan()
+
+        name = literals[0]
+        for (part, fallbacks), literal in zip(plan, literals[1:]):
+            this_value = None
+            for render, final in fallbacks:
+                value = render(metadata)
+                if value is None:
+                    continue
+                this_value = value
+                if final:
+                    break
+
+            # Here we replace the placeholder with it's corresponding value.
+            # Check if this_value was not set so that the placeholder
+            #  can be removed completely.
+            # For example, %title- will be replaced with ''
+            # Else replace the placeholder (i.e. %title) with the value.
+            if this_value is None:
+                stripped = self.trailing_separator_regex.sub('', name)
+                if stripped == name:
+                    name = '{}%{}'.format(name, part)
+                else:
+                    name = stripped
+            else:
+                name += this_value
+            name += literal
+
+        if upper:
+            return name.upper()
+        else:
+            return name.lower()
+
+    def get_file_name_plan(self):
+        """Returns the file name definition compiled into a render plan.
+
+        The name template is split into the literal text around each
+        placeholder and each placeholder into a list of fallbacks in the
+        form of (render, final) tuples. `render` takes the metadata and
+        returns the value or None if the fallback doesn't apply. When
+        `final` is True the remaining fallbacks are skipped.
+
+        The plan is compiled again only when config.ini changes.
+
+        :returns: tuple(list, list, bool) of the literal text, the
+            placeholders and whether the name is upper case.
+        """
+        definition = self.get_file_name_definition()
+        if(self.cached_file_name_plan is not None and
+                self.cached_file_name_plan[0] is definition):
+            return self.cached_file_name_plan[1]
+
         # Get the name template and definition.
         # Name template is in the form %date-%original_name-%title.%extension
         # Definition is in the form
@@ -125,85 +211,103 @@ class FileSystem(object):
         #    [('original_name', '')], [('title', '')], // contains a fallback
         #    [('extension', '')]
         #  ]
-        name_template, definition = self.get_file_name_definition()
+        name_template, parts = definition
 
-        name = name_template
-        for parts in definition:
-            this_value = None
-            for this_part in parts:
-                part, mask = this_part
+        literals = self.placeholder_regex.split(name_template)
+        plan = []
+        for this_part in parts:
+            fallbacks = []
+            for part, mask in this_part:
                 if part in ('date', 'day', 'month', 'year'):
-                    this_value = time.strftime(mask, metadata['date_taken'])
-                    break
+                    fallbacks.append((self._compile_date(mask), True))
                 elif part in ('location', 'city', 'state', 'country'):
-                    place_name = geolocation.place_name(
-                        metadata['latitude'],
-                        metadata['longitude']
-                    )
-
-                    location_parts = re.findall('(%[^%]+)', mask)
-                    this_value = self.parse_mask_for_location(
-                        mask,
-                        location_parts,
-                        place_name,
-                    )
-                    break
+                    fallbacks.append((self._compile_location(mask), True))
                 elif part in ('album', 'extension', 'title'):
-                    if metadata[part]:
-                        this_value = re.sub(self.whitespace_regex, '-', metadata[part].strip())
-                        break
+                    fallbacks.append((self._compile_metadata(part), True))
                 elif part in ('original_name'):
-                    # First we check if we have metadata['original_name'].
-                    # We have to do this for backwards compatibility because
-                    #   we original did not store this back into EXIF.
-                    if metadata[part]:
-                        this_value = os.path.splitext(metadata['original_name'])[0]
-                    else:
-                        # We didn't always store original_name so this is 
-                        #  for backwards compatibility.
-                        # We want to remove the hardcoded date prefix we used 
-                        #  to add to the name.
-                        # This helps when re-running the program on file 
-                        #  which were already processed.
-                        this_value = re.sub(
-                            '^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}-',
-                            '',
-                            metadata['base_name']
-                        )
-                        if(len(this_value) == 0):
-                            this_value = metadata['base_name']
-
-                    # Lastly we want to sanitize the name
-                    this_value = re.sub(self.whitespace_regex, '-', this_value.strip())
+                    fallbacks.append((self._compile_original_name(), False))
                 elif part.startswith('"') and part.endswith('"'):
-                    this_value = part[1:-1]
-                    break
+                    fallbacks.append((self._compile_text(part[1:-1]), True))
+            plan.append((this_part[0][0], fallbacks))
 
-            # Here we replace the placeholder with it's corresponding value.
-            # Check if this_value was not set so that the placeholder
-            #  can be removed completely.
-            # For example, %title- will be replaced with ''
-            # Else replace the placeholder (i.e. %title) with the value.
-            if this_value is None:
-                name = re.sub(
-                    #'[^a-z_]+%{}'.format(part),
-                    '[^a-zA-Z0-9_]+%{}'.format(part),
-                    '',
-                    name,
-                )
+        config = load_config()
+        upper = (
+            'File' in config and
+            'capitalization' in config['File'] and
+            config['File']['capitalization'] == 'upper'
+        )
+
+        self.cached_file_name_plan = (definition, (literals, plan, upper))
+        return self.cached_file_name_plan[1]
+
+    def _compile_date(self, mask):
+        return lambda metadata: time.strftime(mask, metadata['date_taken'])
+
+    def _compile_location(self, mask):
+        location_parts = LOCATION_PARTS_REGEX.findall(mask)
+
+        def render(metadata):
+            place_name = geolocation.place_name(
+                metadata['latitude'],
+                metadata['longitude']
+            )
+            return self.parse_mask_for_location(
+                mask,
+                location_parts,
+                place_name,
+            )
+        return render
+
+    def _compile_metadata(self, part):
+        def render(metadata):
+            if metadata[part]:
+                return self.whitespace_regex.sub('-', metadata[part].strip())
+            return None
+        return render
+
+    def _compile_original_name(self):
+        def render(metadata):
+            # First we check if we have metadata['original_name'].
+            # We have to do this for backwards compatibility because
+            #   we original did not store this back into EXIF.
+            if metadata['original_name']:
+                this_value = os.path.splitext(metadata['original_name'])[0]
             else:
-                name = re.sub(
-                    '%{}'.format(part),
-                    this_value,
-                    name,
+                # We didn't always store original_name so this is
+                #  for backwards compatibility.
+                # We want to remove the hardcoded date prefix we used
+                #  to add to the name.
+                # This helps when re-running the program on file
+                #  which were already processed.
+                this_value = re.sub(
+                    '^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}-',
+                    '',
+                    metadata['base_name']
                 )
+                if(len(this_value) == 0):
+                    this_value = metadata['base_name']
 
-        config = load_config()
+            # Lastly we want to sanitize the name
+            return self.whitespace_regex.sub('-', this_value.strip())
+        return render
 
-        if('File' in config and 'capitalization' in config['File'] and config['File']['capitalization'] == 'upper'):
-            return name.upper()
-        else:
-            return name.lower()
+    def _compile_text(self, text):
+        return lambda metadata: text
+
+    def write_to_destination(self):
+        """Check if config.ini asks for tags to be written to the
+        destination instead of the source.
+
+        It's set with `write_to=destination` in the [ExifTool] section.
+
+        :returns: bool
+        """
+        config = load_config()
+        return (
+            'ExifTool' in config and
+            'write_to' in config['ExifTool'] and
+            config['ExifTool']['write_to'].lower() == 'destination'
+        )
 
     def get_file_name_definition(self):
         """Returns a list of folder definitions.
@@ -222,13 +326,14 @@ class FileSystem(object):
 
         :returns: list
         """
-        # If we've done this already then return it immediately without
-        # incurring any extra work
-        if self.cached_file_name_definition is not None:
-            return self.cached_file_name_definition
-
         config = load_config()
 
+        # If we've done this already for this config.ini then return it
+        # immediately without incurring any extra work
+        if(self.cached_file_name_definition is not None and
+                self.cached_config is config):
+            return self.cached_file_name_definition
+
         # If File is in the config we assume name and its
         #  corresponding values are also present
         config_file = self.default_file_name_definition
@@ -246,6 +351,7 @@ class FileSystem(object):
         if not path_parts or len(path_parts) == 0:
             return (config_file['name'], self.default_file_name_definition)
 
+        self.cached_config = config
         self.cached_file_name_definition = []
         for part in path_parts:
             if part in config_file:
@@ -262,51 +368,79 @@ class FileSystem(object):
                     )
                 self.cached_file_name_definition.append(this_part)
 
-        # What if basename already has date_time information?
-        # e.g. 20160706_192934.jpg 
-        #      20160706_192934-1.jpg 
-        # strip it out
-        base_name = re.sub(
-            '^\d{4}\d{2}\d{2}_\d{2}\d{2}\d{2}',
-            '',
-            base_name
+        self.cached_file_name_definition = (
+            config_file['name'],
+            self.cached_file_name_definition
         )
+        return self.cached_file_name_definition
 
-        file_name = '%s-%s.%s' % (
-            time.strftime(
-                '%Y-%m-%d_%H-%M-%S',
-                metadata['date_taken']
-            ),
-            base_name,
-            metadata['extension'])
-        return file_name.lower()
+    def get_folder_path(self, metadata, path_parts=None):
+        """Given a media's metadata this function returns the folder path.
 
-    def process_file(self, _file, destination, media, **kwargs):
-        move = False
-        if('move' in kwargs):
-            move = kwargs['move']
+        See :meth:`~elodie.destination_folder.DestinationFolder.get_folder_path`.
 
-        allow_duplicate = False
-        if('allowDuplicate' in kwargs):
-            allow_duplicate = kwargs['allowDuplicate']
+        :returns: str
+        """
+        return self.destination_folder.get_folder_path(metadata, path_parts)
 
-        if(not media.is_valid()):
-            print('%s is not a valid media file. Skipping...' % _file)
-            return
+    def get_folder_path_definition(self):
+        """Returns a list of folder definitions.
 
-        media.set_original_name()
-        metadata = media.get_metadata()
+        See :meth:`~elodie.destination_folder.DestinationFolder.get_folder_path_definition`.
 
-        directory_name = self.destination_folder.get_folder_path(metadata)
+        :returns: list
+        """
+        return self.destination_folder.get_folder_path_definition()
 
-        dest_directory = os.path.join(destination, directory_name)
-        file_name = self.get_file_name(media)
-        dest_path = os.path.join(dest_directory, file_name)
+    def parse_mask_for_location(self, mask, location_parts, place_name):
+        """Takes a mask for a location and interpolates the actual place names.
 
-        db = Db()
-        checksum = db.checksum(_file)
+        See :meth:`~elodie.destination_folder.DestinationFolder.parse_mask_for_location`.
+
+        :returns: str
+        """
+        return self.destination_folder.parse_mask_for_location(
+            mask,
+            location_parts,
+            place_name
+        )
+
+    def process_checksum(self, _file, allow_duplicate, defer=False):
+        """Check if a file has been imported before and claim it.
+
+        The duplicate test is tiered. A file whose size isn't in the hash
+        db, or else whose partial checksum isn't, can't have been imported
+        before. Only when both match is the full checksum looked up.
+
+        :param str _file: Path to the file.
+        :param bool allow_duplicate: Claim the file even if it's been
+            imported before.
+        :param bool defer: If True and the file can't be a duplicate then
+            its full checksum isn't computed and None is returned in its
+            place.
+        :returns: tuple(str, str) of the checksum and partial checksum, or
+            None if the file should be skipped. The partial checksum must
+            be passed to release_checksum() once the file is done.
+        """
+        partial_checksum = Db.partial_checksum(_file)
+
+        with self.hash_db_condition:
+            while partial_checksum in self.partials_in_progress:
+                self.hash_db_condition.wait()
+            self.partials_in_progress.add(partial_checksum)
+
+            # Loaded once the partial checksum is claimed so it has every
+            #  file which could be a duplicate of this one.
+            db = Db()
+            may_have_hash = db.may_have_hash(partial_checksum)
+
+        if(defer is True and (allow_duplicate or not may_have_hash)):
+            return (None, partial_checksum)
+
+        checksum = Db.checksum(_file)
         if(checksum is None):
             log.info('Could not get checksum for %s.' % _file)
+            self.release_checksum(partial_checksum)
             return None
 
         # If duplicates are not allowed then we check if we've seen this file
@@ -314,20 +448,36 @@ class FileSystem(object):
         #   location we believe it to be.
         # If we find a checksum match but the file doesn't exist where we
         #  believe it to be then we write a debug log and proceed to import.
-        checksum_file = db.get_hash(checksum)
+        checksum_file = None
+        if(may_have_hash is True):
+            with self.hash_db_lock:
+                checksum_file = db.get_hash(checksum)
+
         if(allow_duplicate is False and checksum_file is not None):
             if(os.path.isfile(checksum_file)):
                 log.info('%s already at %s.' % (
                     _file,
                     checksum_file
                 ))
+                self.release_checksum(partial_checksum)
                 return None
             else:
                 log.info('%s matched checksum but file not found at %s.' % (  # noqa
                     _file,
                     checksum_file
                 ))
-        return checksum
+
+        return (checksum, partial_checksum)
+
+    def release_checksum(self, partial_checksum):
+        """Let other files with this partial checksum be processed.
+
+        :param str partial_checksum: Partial checksum from
+            process_checksum().
+        """
+        with self.hash_db_condition:
+            self.partials_in_progress.discard(partial_checksum)
+            self.hash_db_condition.notify_all()
 
     def process_file(self, _file, destination, media, **kwargs):
         move = False
@@ -345,15 +495,53 @@ class FileSystem(object):
             print('%s is not a valid media file. Skipping...' % _file)
             return
 
-        checksum = self.process_checksum(_file, allow_duplicate)
-        if(checksum is None):
+        # Tags are either written to the source before it's copied or held
+        #  back and written to the destination once it's there.
+        write_to_destination = (
+            self.write_to_destination() and
+            media.defer_tags()
+        )
+
+        # The hash db is keyed by the checksum of the file as it is now.
+        # If the original name is already stored, or tags are written to
+        #  the destination, then nothing writes to the file before it's
+        #  copied so the checksum can come from the copy instead of an
+        #  extra read.
+        claim = self.process_checksum(
+            _file,
+            allow_duplicate,
+            defer=(
+                write_to_destination or
+                media.get_original_name() is not None
+            )
+        )
+        if(claim is None):
             log.info('Original checksum returned None for %s. Skipping...' %
                      _file)
             return
 
+        checksum, partial_checksum = claim
+        try:
+            return self.process_claimed_file(
+                _file,
+                destination,
+                media,
+                metadata,
+                checksum,
+                partial_checksum,
+                move,
+                write_to_destination
+            )
+        finally:
+            self.release_checksum(partial_checksum)
+
+    def process_claimed_file(self, _file, destination, media, metadata,
+                             checksum, partial_checksum, move,
+                             write_to_destination=False):
         # Run `before()` for every loaded plugin and if any of them raise an exception
         #  then we skip importing the file and log a message.
-        plugins_run_before_status = self.plugins.run_all_before(_file, destination)
+        with self.plugins_lock:
+            plugins_run_before_status = self.plugins.run_all_before(_file, destination)
         if(plugins_run_before_status == False):
             log.warn('At least one plugin pre-run failed for %s' % _file)
             return
@@ -384,6 +572,7 @@ class FileSystem(object):
         if(os.path.exists(exif_original_file)):
             exif_original_file_exists = True
 
+        dest_checksum = None
         if(move is True):
             stat = os.stat(_file)
             # Move the processed file into the destination directory
@@ -392,18 +581,63 @@ class FileSystem(object):
             if(exif_original_file_exists is True):
                 # We can remove it as we don't need the initial file.
                 os.remove(exif_original_file)
+        else:
+            dest_checksum = compatibility._copyfile(_file, dest_path)
+
+        # A deferred checksum comes from the copy, or for a move from the
+        #  file which is now at the destination. Either way it's taken
+        #  before any tags are written to the destination.
+        if(checksum is None):
+            checksum = dest_checksum
+            if(checksum is None):
+                checksum = Db.checksum(dest_path)
+
+        dest_written = False
+        if(write_to_destination is True):
+            try:
+                write_status = media.write_deferred_tags(dest_path)
+            except ExifToolTimeout as e:
+                log.error('%s Writing tags to %s.' % (e, dest_path))
+                write_status = False
+                # exiftool was stopped before it could replace the copy.
+                if(os.path.isfile(dest_path + '_exiftool_tmp')):
+                    os.remove(dest_path + '_exiftool_tmp')
+            if(write_status is False):
+                log.error('Could not write tags to %s' % dest_path)
+                log.all('{"source":"%s", "error_msg":"Could not write tags to %s"}' % (  # noqa
+                    _file,
+                    dest_path
+                ))
+                # Leave things as they were before the import.
+                if(move is True):
+                    shutil.move(dest_path, _file)
+                    os.utime(_file, (stat.st_atime, stat.st_mtime))
+                else:
+                    os.remove(dest_path)
+                return
+            dest_written = write_status is True
+
+        if(move is True):
             os.utime(dest_path, (stat.st_atime, stat.st_mtime))
         else:
-            compatibility._copyfile(_file, dest_path)
-            self.set_utime_from_metadata(media.get_metadata(), dest_path)
+            self.set_utime_from_metadata(metadata, dest_path)
+
+        with self.hash_db_lock:
+            db = Db()
+            db.add_partial_checksum(checksum, partial_checksum)
+            db.add_hash(checksum, dest_path)
+            db.update_hash_db()
 
-        db = Db()
-        db.add_hash(checksum, dest_path)
-        db.update_hash_db()
+        # The copy already hashed what it wrote so the new file never has
+        #  to be read again to get its checksum, unless tags were written
+        #  to it since.
+        if(dest_checksum is not None and dest_written is False):
+            Db.get_checksum_cache().set(dest_path, dest_checksum)
 
         # Run `after()` for every loaded plugin and if any of them raise an exception
         #  then we skip importing the file and log a message.
-        plugins_run_after_status = self.plugins.run_all_after(_file, destination, dest_path, metadata)
+        with self.plugins_lock:
+            plugins_run_after_status = self.plugins.run_all_after(_file, destination, dest_path, metadata)
         if(plugins_run_after_status == False):
             log.warn('At least one plugin pre-run failed for %s' % _file)
             return
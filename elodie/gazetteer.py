@@ -0,0 +1,314 @@
+"""
+Look up place names for coordinates without a network connection.
+
+A gazetteer is a tab separated file of places with their coordinates. Two
+layouts are understood.
+
+* ``city<TAB>state<TAB>country<TAB>latitude<TAB>longitude``
+* The GeoNames ``cities*.txt`` dumps from https://download.geonames.org/
+  in which case the state and country are the admin1 and country codes.
+
+Empty lines and lines starting with ``#`` are ignored.
+
+The first time a gazetteer is used it is compiled into a binary index
+which is memory-mapped by later runs. The index is compiled again when the
+gazetteer changes. Places are sorted by the one degree cell they are in so
+a lookup only has to look at the places in the cell of the coordinates and
+the cells around it.
+"""
+from __future__ import division
+from builtins import object, range
+
+import io
+import math
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+from elodie import log
+from elodie.compatibility import _rename
+
+#: Mean radius of the earth in kilometers.
+EARTH_RADIUS = 6371.0
+
+#: Places further away than this many kilometers aren't used.
+MAX_DISTANCE = 50.0
+
+#: Magic, byte order, source mtime, source size, places, strings length.
+HEADER = struct.Struct('<8sQqqQQ')
+MAGIC = b'ELODIEGZ'
+BYTE_ORDER = 1 if sys.byteorder == 'little' else 2
+
+
+def cell_key(lat, lon):
+    """Get the key of the one degree cell the coordinates are in.
+
+    :param float lat: Latitude.
+    :param float lon: Longitude.
+    :returns: int
+    """
+    row = min(max(int(math.floor(lat)), -90), 89) + 90
+    column = (int(math.floor(lon)) + 180) % 360
+    return row * 360 + column
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Get the approximate distance between two coordinates.
+
+    :returns: float distance in kilometers.
+    """
+    delta_lon = (lon2 - lon1 + 180) % 360 - 180
+    x = math.radians(delta_lon) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.sqrt(x * x + y * y)
+
+
+def read_array(buffer, typecode, start, count):
+    """Get `count` values of `typecode` from `buffer` starting at `start`.
+
+    The values are read in place where memoryview.cast() is available,
+    which is only on Python 3, and copied otherwise.
+
+    :param buffer: The memory-mapped index.
+    :param str typecode: Type code of the 4 byte values, see :mod:`array`.
+    :param int start: Offset of the first value in bytes.
+    :param int count: Number of values.
+    :returns: memoryview or array
+    """
+    end = start + count * 4
+    if hasattr(memoryview, 'cast'):
+        return memoryview(buffer)[start:end].cast(typecode)
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(buffer[start:end])
+    else:
+        values.fromstring(buffer[start:end])
+    return values
+
+
+def mtime_ns(stat):
+    """Get the modification time of a file in nanoseconds.
+
+    st_mtime_ns is only there on Python 3.
+
+    :param stat: Result of :func:`os.stat` for the file.
+    :returns: int
+    """
+    return getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))
+
+
+def parse_line(line):
+    """Parse a line of a gazetteer.
+
+    :param str line: Line without the trailing new line.
+    :returns: tuple(str, str, str, float, float) of city, state, country,
+        latitude and longitude or None if the line is not a place.
+    """
+    if not line or line.startswith('#'):
+        return None
+
+    columns = line.split('\t')
+    try:
+        if len(columns) >= 19:
+            # GeoNames: name, latitude, longitude, country code, admin1 code
+            return (
+                columns[1],
+                columns[10],
+                columns[8],
+                float(columns[4]),
+                float(columns[5])
+            )
+        elif len(columns) >= 5:
+            return (
+                columns[0],
+                columns[1],
+                columns[2],
+                float(columns[3]),
+                float(columns[4])
+            )
+    except ValueError:
+        pass
+
+    return None
+
+
+class Gazetteer(object):
+    """A memory-mapped index of the places in a gazetteer.
+
+    :param str path: Path to the gazetteer.
+    :param str index_path: Path to the compiled index of the gazetteer.
+    :param float max_distance: Kilometers beyond which places aren't used.
+    """
+
+    def __init__(self, path, index_path, max_distance=MAX_DISTANCE):
+        self.path = path
+        self.index_path = index_path
+        self.max_distance = max_distance
+
+        stat = os.stat(path)
+        if not self.is_current(stat):
+            self.build(stat)
+
+        with io.open(index_path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _, _, _, _, count, _ = HEADER.unpack_from(self.map)
+        offset = HEADER.size
+        self.keys = read_array(self.map, 'i', offset, count)
+        offset += count * 4
+        self.lats = read_array(self.map, 'f', offset, count)
+        offset += count * 4
+        self.lons = read_array(self.map, 'f', offset, count)
+        offset += count * 4
+        self.names = read_array(self.map, 'I', offset, count * 3)
+        self.strings_offset = offset + count * 12
+
+    def is_current(self, stat):
+        """Check if the index was compiled from the gazetteer as it is now.
+
+        :param stat: Result of :func:`os.stat` for the gazetteer.
+        :returns: bool
+        """
+        try:
+            with io.open(self.index_path, 'rb') as f:
+                header = f.read(HEADER.size)
+        except (IOError, OSError):
+            return False
+
+        if len(header) != HEADER.size:
+            return False
+
+        magic, byte_order, index_mtime_ns, size, _, _ = HEADER.unpack(header)
+        return (
+            magic == MAGIC and
+            byte_order == BYTE_ORDER and
+            index_mtime_ns == mtime_ns(stat) and
+            size == stat.st_size
+        )
+
+    def build(self, stat):
+        """Compile the gazetteer into the index.
+
+        :param stat: Result of :func:`os.stat` for the gazetteer.
+        """
+        log.info('Building index of gazetteer %s' % self.path)
+        places = []
+        with io.open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                place = parse_line(line.rstrip('\r\n'))
+                if place is not None:
+                    places.append(
+                        (cell_key(place[3], place[4]),) + place
+                    )
+        places.sort(key=lambda place: place[0])
+
+        keys = array('i')
+        lats = array('f')
+        lons = array('f')
+        names = array('I')
+        # Offset 0 is the empty string.
+        strings = bytearray(b'\0')
+        string_offsets = {'': 0}
+        for key, city, state, country, lat, lon in places:
+            keys.append(key)
+            lats.append(lat)
+            lons.append(lon)
+            for name in (city, state, country):
+                if name not in string_offsets:
+                    string_offsets[name] = len(strings)
+                    strings.extend(name.encode('utf-8') + b'\0')
+                names.append(string_offsets[name])
+
+        # Write to a temporary file first so a concurrent run never sees
+        #  a partially written index.
+        temporary_path = '%s.%d' % (self.index_path, os.getpid())
+        with io.open(temporary_path, 'wb') as f:
+            f.write(HEADER.pack(
+                MAGIC,
+                BYTE_ORDER,
+                mtime_ns(stat),
+                stat.st_size,
+                len(places),
+                len(strings)
+            ))
+            for values in (keys, lats, lons, names):
+                # array.tobytes() is only there on Python 3.
+                if hasattr(values, 'tobytes'):
+                    f.write(values.tobytes())
+                else:
+                    f.write(values.tostring())
+            f.write(bytes(strings))
+        _rename(temporary_path, self.index_path)
+
+    def get_string(self, offset):
+        start = self.strings_offset + offset
+        end = self.map.find(b'\0', start)
+        return self.map[start:end].decode('utf-8')
+
+    def nearest(self, lat, lon):
+        """Find the place closest to the coordinates.
+
+        Only the cell of the coordinates and its neighbours are searched
+        and places further away than `max_distance` are left out.
+
+        :param float lat: Latitude.
+        :param float lon: Longitude.
+        :returns: int index of the place or None if there's no place nearby.
+        """
+        if lat < -90 or lat > 90:
+            return None
+
+        row = min(int(math.floor(lat)), 89)
+        column = int(math.floor(lon))
+        nearest = None
+        nearest_distance = None
+        for delta_row in (-1, 0, 1):
+            if row + delta_row < -90 or row + delta_row > 89:
+                continue
+            for delta_column in (-1, 0, 1):
+                key = cell_key(row + delta_row, column + delta_column)
+                start = bisect_left(self.keys, key)
+                end = bisect_right(self.keys, key, start)
+                for index in range(start, end):
+                    this_distance = distance(
+                        lat,
+                        lon,
+                        self.lats[index],
+                        self.lons[index]
+                    )
+                    if this_distance > self.max_distance:
+                        continue
+                    if nearest is None or this_distance < nearest_distance:
+                        nearest = index
+                        nearest_distance = this_distance
+
+        return nearest
+
+    def place_name(self, lat, lon):
+        """Get the place name for coordinates.
+
+        :param float lat: Latitude.
+        :param float lon: Longitude.
+        :returns: dict in the form of
+            {'city': ..., 'state': ..., 'country': ..., 'default': ...}
+            without the parts which are unknown or None if there's no place
+            nearby.
+        """
+        index = self.nearest(lat, lon)
+        if index is None:
+            return None
+
+        place_name = {}
+        for position, loc in enumerate(['city', 'state', 'country']):
+            name = self.get_string(self.names[index * 3 + position])
+            if name:
+                place_name[loc] = name
+                # The most specific part is the default.
+                if 'default' not in place_name:
+                    place_name['default'] = name
+
+        return place_name or None
@@ -8,7 +8,11 @@ standard_library.install_aliases()  # noqa
 
 from os import path
 
+import copy
+import random
 import requests
+import threading
+import time
 import urllib.request
 import urllib.parse
 import urllib.error
@@ -16,14 +20,255 @@ import urllib.error
 from elodie.config import load_config
 from elodie import constants
 from elodie import log
-from elodie.localstorage import Db
+from elodie.gazetteer import Gazetteer
+from elodie.localstorage import Db, LocationIndex, LocationNameIndex
+from elodie.workers import WorkerPool
 
 __KEY__ = None
 __DEFAULT_LOCATION__ = 'Unknown Location'
 __PREFER_ENGLISH_NAMES__ = None
+__GAZETTEER__ = None
+__GAZETTEER_LOCK__ = threading.Lock()
+__CLIENT__ = None
+__CLIENT_LOCK__ = threading.Lock()
+__PREFETCH_LOCK__ = threading.Lock()
+# Results of coordinates_by_name() keyed by the normalized name.
+__COORDINATES_BY_NAME__ = {}
+
+#: HTTP status codes of MapQuest responses which are retried.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+#: Counters of a :class:`MapQuestClient` which hasn't made any requests.
+EMPTY_STATS = {
+    'requests': 0,
+    'retries': 0,
+    'failures': 0,
+    'latency': 0.0,
+    'max_latency': 0.0,
+}
+
+
+class TokenBucket(object):
+    """Limit how often something happens.
+
+    Up to `capacity` calls to :meth:`acquire` return immediately, after that
+    they are spread out to `rate` calls per second.
+
+    :param float rate: Calls per second. 0 or less means no limit.
+    :param float capacity: Number of calls allowed in a burst. Defaults to
+        one second's worth of calls.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a call is allowed.
+
+        :returns: float seconds waited.
+        """
+        if self.rate <= 0:
+            return 0
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            # Taking the token before sleeping queues up concurrent callers.
+            self.tokens -= 1
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class MapQuestClient(object):
+    """Make requests to MapQuest over a persistent connection.
+
+    Requests are rate limited and retried with exponential backoff and
+    jitter when the connection fails, times out or MapQuest responds with
+    one of :data:`RETRY_STATUS_CODES`.
+
+    :param float timeout: Seconds to wait to connect and for a response.
+    :param int retries: Number of times a failed request is retried.
+    :param float requests_per_second: Rate limit, 0 for no limit.
+    :param float backoff: Upper bound in seconds of the first retry's delay,
+        doubled for every retry after that.
+    :param float max_backoff: Upper bound in seconds of any retry's delay.
+    """
+
+    def __init__(self, timeout, retries, requests_per_second, backoff=0.5,
+                 max_backoff=30):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate_limit = TokenBucket(requests_per_second)
+        self.session = requests.Session()
+        self.stats_lock = threading.Lock()
+        self.stats = dict(EMPTY_STATS)
+
+    def get(self, url, headers=None):
+        """Request `url` and retry if it fails.
+
+        :param str url: URL to request.
+        :param dict headers: HTTP headers to send.
+        :returns: :class:`requests.Response` which may be an error response
+            if it failed every time.
+        :raises requests.exceptions.RequestException: if no response was
+            received.
+        """
+        attempt = 0
+        while True:
+            self.rate_limit.acquire()
+            response = None
+            error = None
+            started = time.time()
+            try:
+                response = self.session.get(
+                    url,
+                    headers=headers,
+                    timeout=self.timeout
+                )
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                error = e
+            self.record(
+                time.time() - started,
+                response is None or
+                response.status_code in RETRY_STATUS_CODES
+            )
+
+            if(error is None and
+                    response.status_code not in RETRY_STATUS_CODES):
+                return response
+
+            if attempt >= self.retries:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self.retry_delay(attempt, response)
+            log.warn('MapQuest request failed (%s), retrying in %.1fs' % (
+                error if error is not None else response.status_code,
+                delay
+            ))
+            with self.stats_lock:
+                self.stats['retries'] += 1
+            time.sleep(delay)
+            attempt += 1
+
+    def retry_delay(self, attempt, response=None):
+        """Get how long to wait before retrying.
+
+        A Retry-After header in `response` is respected. Otherwise the delay
+        is random, up to `backoff` doubled for each attempt.
+
+        :param int attempt: Number of retries so far.
+        :param response: The failed :class:`requests.Response` if any.
+        :returns: float seconds.
+        """
+        if response is not None and 'Retry-After' in response.headers:
+            try:
+                return min(
+                    self.max_backoff,
+                    float(response.headers['Retry-After'])
+                )
+            except ValueError:
+                pass
+
+        return random.uniform(
+            0,
+            min(self.max_backoff, self.backoff * (2 ** attempt))
+        )
+
+    def record(self, latency, failed):
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['latency'] += latency
+            self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+            if failed:
+                self.stats['failures'] += 1
+
+    def get_stats(self):
+        """Get counters of the requests made so far.
+
+        :returns: dict with the number of `requests`, `retries` and
+            `failures` and the total and maximum `latency` in seconds.
+        """
+        with self.stats_lock:
+            return dict(self.stats)
+
+
+def get_client():
+    """Get the MapQuest client shared by all lookups.
+
+    The timeout, retries and rate limit can be set with `timeout`,
+    `retries` and `requests_per_second` in the [MapQuest] section of
+    config.ini.
+
+    :returns: :class:`MapQuestClient`
+    """
+    global __CLIENT__
+    with __CLIENT_LOCK__:
+        if __CLIENT__ is not None:
+            return __CLIENT__
+
+        settings = {
+            'timeout': constants.mapquest_timeout,
+            'retries': constants.mapquest_retries,
+            'requests_per_second': constants.mapquest_requests_per_second,
+        }
+        config = load_config()
+        if 'MapQuest' in config:
+            for key, cast in (('timeout', float), ('retries', int),
+                              ('requests_per_second', float)):
+                if key not in config['MapQuest']:
+                    continue
+                try:
+                    settings[key] = cast(config['MapQuest'][key])
+                except ValueError:
+                    log.error('Invalid %s in the [MapQuest] section of config.ini' % key)
+
+        __CLIENT__ = MapQuestClient(
+            settings['timeout'],
+            settings['retries'],
+            settings['requests_per_second']
+        )
+        return __CLIENT__
+
+def get_lookup_stats():
+    """Get counters of the MapQuest requests made so far.
+
+    See :meth:`MapQuestClient.get_stats`.
+
+    :returns: dict
+    """
+    if __CLIENT__ is None:
+        return dict(EMPTY_STATS)
+    return __CLIENT__.get_stats()
 
 
 def coordinates_by_name(name):
+    # Names are only looked up once per run, even if they weren't found.
+    key = LocationNameIndex.normalize(name)
+    if(key in __COORDINATES_BY_NAME__):
+        return copy.deepcopy(__COORDINATES_BY_NAME__[key])
+
+    coordinates = _coordinates_by_name(name)
+    __COORDINATES_BY_NAME__[key] = coordinates
+    return copy.deepcopy(coordinates)
+
+
+def _coordinates_by_name(name):
     # Try to get cached location first
     db = Db()
     cached_coordinates = db.get_location_coordinates(name)
@@ -138,6 +383,53 @@ def get_prefer_english_names():
     __PREFER_ENGLISH_NAMES__ = bool(config['MapQuest']['prefer_english_names'])
     return __PREFER_ENGLISH_NAMES__
 
+def get_engine():
+    """Get the geolocation engine selected in config.ini.
+
+    :returns: str 'offline' or 'mapquest'
+    """
+    config = load_config()
+    if(
+        'Geolocation' in config and
+        'engine' in config['Geolocation'] and
+        config['Geolocation']['engine'].strip().lower() == 'offline'
+    ):
+        return 'offline'
+
+    return 'mapquest'
+
+def get_gazetteer():
+    """Get the gazetteer used by the offline engine.
+
+    The gazetteer is loaded once and again only if config.ini points to a
+    different file.
+
+    :returns: :class:`~elodie.gazetteer.Gazetteer` or None if it's not
+        configured or can't be read.
+    """
+    global __GAZETTEER__
+    config = load_config()
+    if(
+        'Geolocation' not in config or
+        'gazetteer' not in config['Geolocation']
+    ):
+        log.error('No gazetteer set in the [Geolocation] section of config.ini')
+        return None
+
+    gazetteer_path = path.expanduser(config['Geolocation']['gazetteer'])
+    with __GAZETTEER_LOCK__:
+        if(__GAZETTEER__ is None or __GAZETTEER__.path != gazetteer_path):
+            try:
+                __GAZETTEER__ = Gazetteer(
+                    gazetteer_path,
+                    constants.gazetteer_index
+                )
+            except (IOError, OSError, UnicodeDecodeError) as e:
+                log.error('Could not load gazetteer %s: %s' % (gazetteer_path, e))
+                return None
+
+        return __GAZETTEER__
+
 def place_name(lat, lon):
     lookup_place_name_default = {'default': __DEFAULT_LOCATION__}
     if(lat is None or lon is None):
@@ -158,8 +450,24 @@ def place_name(lat, lon):
     if(isinstance(cached_place_name, dict)):
         return cached_place_name
 
+    # The offline engine is fast enough that its results aren't cached.
+    if(get_engine() == 'offline'):
+        gazetteer = get_gazetteer()
+        if(gazetteer is not None):
+            lookup_place_name = gazetteer.place_name(lat, lon)
+            if(lookup_place_name is not None):
+                return lookup_place_name
+        return lookup_place_name_default
+
+    # MapQuest already said it doesn't know a place near here.
+    if(db.is_location_miss(lat, lon, 3000)):
+        return lookup_place_name_default
+
     lookup_place_name = {}
-    geolocation_info = lookup(lat=lat, lon=lon)
+    result = fetch(lat=lat, lon=lon)
+    geolocation_info = None
+    if(result is not None):
+        geolocation_info = parse_result(result)
     if(geolocation_info is not None and 'address' in geolocation_info):
         address = geolocation_info['address']
         log.info('Location: "%s"' % geolocation_info['display_name'])
@@ -175,7 +483,12 @@ def place_name(lat, lon):
 
     if(lookup_place_name):
         db.add_location(lat, lon, lookup_place_name)
-        # TODO: Maybe this should only be done on exit and not for every write.
+        # location.json is only written now and then, see update_location_db().
+        db.update_location_db()
+    elif(result is not None):
+        # Only remember misses which MapQuest answered. Network errors and
+        #  a missing key are worth trying again.
+        db.add_location_miss(lat, lon)
         db.update_location_db()
 
     if('default' not in lookup_place_name):
@@ -184,7 +497,71 @@ def place_name(lat, lon):
     return lookup_place_name
 
 
+def prefetch_place_names(coordinates, workers=None):
+    """Look up the place names of many coordinates ahead of time.
+
+    Coordinates within 3km of each other end up with the same cached place
+    name so they're grouped and one of each group is looked up, unless the
+    location db already has it or MapQuest recently had no answer for it.
+    The lookups run on up to `workers` threads
+    and their results are added to the location db so that
+    :func:`place_name` doesn't have to wait for MapQuest later.
+
+    :param list coordinates: List of (latitude, longitude) tuples.
+    :param int workers: Number of lookups to run at the same time. Defaults
+        to :data:`~elodie.constants.geocode_prefetch_workers`.
+    :returns: int number of lookups.
+    """
+    if(get_engine() == 'offline' or not get_key()):
+        return 0
+
+    if workers is None:
+        workers = constants.geocode_prefetch_workers
+
+    # Prefetches from several import workers are run one after the other
+    #  so the same place isn't looked up by more than one of them.
+    with __PREFETCH_LOCK__:
+        db = Db()
+        clusters = LocationIndex()
+        representatives = []
+        for lat, lon in coordinates:
+            lat = float(lat)
+            lon = float(lon)
+            # 3km distace radius for a match, the same as place_name()
+            if(clusters.nearest(lat, lon, 3000) is not None):
+                continue
+            clusters.add({'lat': lat, 'long': lon, 'name': None})
+
+            if(isinstance(db.get_location_name(lat, lon, 3000), dict)):
+                continue
+            if(db.is_location_miss(lat, lon, 3000)):
+                continue
+            representatives.append((lat, lon))
+
+        if(len(representatives) == 0):
+            return 0
+
+        log.info('Looking up %d locations' % len(representatives))
+        WorkerPool(workers, exiftool=False).map(
+            lambda coordinate: place_name(*coordinate),
+            representatives
+        )
+        return len(representatives)
+
+
 def lookup(**kwargs):
+    result = fetch(**kwargs)
+    if(result is None):
+        return None
+    return parse_result(result)
+
+
+def fetch(**kwargs):
+    """Request a geocode from MapQuest without parsing the result.
+
+    :returns: dict decoded from the response or None if there's no key, the
+        request failed or MapQuest answered with an error status.
+    """
     if(
         'location' not in kwargs and
         'lat' not in kwargs and
@@ -212,8 +589,16 @@ def lookup(**kwargs):
         headers = {}
         if(prefer_english_names):
             headers = {'Accept-Language':'en-EN,en;q=0.8'}
-        r = requests.get(url, headers=headers)
-        return parse_result(r.json())
+        r = get_client().get(url, headers=headers)
+        # Rate limits, server errors and a rejected key say nothing about the
+        #  location so they mustn't end up in the location db as a miss.
+        if(r.status_code < 200 or r.status_code >= 300):
+            log.error('MapQuest returned status %d for %s' % (
+                r.status_code,
+                path
+            ))
+            return None
+        return r.json()
     except requests.exceptions.RequestException as e:
         log.error(e)
         return None
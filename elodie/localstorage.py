@@ -1,20 +1,29 @@
 """
 Methods for interacting with information Elodie caches about stored media.
 """
-from builtins import map
 from builtins import object
 
+import atexit
 import copy
 import hashlib
 import json
 import os
+import random
+import signal
+import six
+import sqlite3
 import sys
+import threading
+import time
 
-from math import radians, cos, sqrt
+from math import ceil, cos, degrees, floor, radians, sqrt
 from shutil import copyfile
 from time import strftime
 
 from elodie import constants
+from elodie import log
+from elodie.compatibility import _rename
+from elodie.config import load_config
 
 """ static variables used for the dbs for two reasons
   1) So that mock functions can load them for testing
@@ -24,44 +33,1018 @@ from elodie import constants
 """
 __hash_db__ = None
 __location_db__ = None
+__location_index__ = None
+__location_name_index__ = None
+__location_misses__ = None
+__location_miss_index__ = None
+__checksum_cache__ = None
+__metadata_cache__ = None
+__hash_index__ = None
+
+# Db used by get_checksums() in worker processes.
+__process_db__ = None
+
+# Guards writing the db files when several workers share them.
+__db_lock__ = threading.RLock()
+
+# State for group commits of hash.json. See Db.update_hash_db().
+__hash_db_pending__ = 0
+__hash_db_last_flush__ = None
+__hash_db_flushes__ = []
+__exit_handlers_registered__ = False
+__previous_signal_handlers__ = {}
+
+# State for deferred writes of location.json. See Db.update_location_db().
+__location_db_pending__ = 0
+__location_db_last_flush__ = None
 
 def mock_location_db(json_string):
   """Fill location_db with data for test purposes """
   global __location_db__
+  global __location_index__
+  global __location_name_index__
   __location_db__ = json.loads(json_string)
+  __location_index__ = None
+  __location_name_index__ = None
+
+def flush_hash_db():
+    """Write any hash db entries held back by group commits to hash.json.
+
+    :returns: int number of bytes written, 0 if nothing was pending.
+    """
+    global __hash_db_pending__
+    global __hash_db_last_flush__
+
+    with __db_lock__:
+        if __hash_db_pending__ == 0 or __hash_db__ is None:
+            return 0
+
+        written = write_hash_db(__hash_db__)
+        __hash_db_pending__ = 0
+        __hash_db_last_flush__ = time.time()
+        __hash_db_flushes__.append(written)
+        log.info('Flushed hash db (%d bytes)' % written)
+        return written
+
+def get_hash_db_flush_stats():
+    """Get the number of group commit flushes and their sizes.
+
+    :returns: dict with `flushes` and a list of `bytes` per flush.
+    """
+    with __db_lock__:
+        return {
+            'flushes': len(__hash_db_flushes__),
+            'bytes': list(__hash_db_flushes__)
+        }
+
+def write_hash_db(hash_db):
+    """Write `hash_db` to hash.json and drop the journal it replaces.
+
+    The journal is only removed once the new hash.json has been renamed
+    into place.
+
+    :param dict hash_db: Full contents of the hash db.
+    :returns: int number of bytes written.
+    """
+    written = write_json_file(constants.hash_db, hash_db, indent=0,
+                              sort_keys=False)
+    if os.path.isfile(constants.hash_db_journal):
+        os.remove(constants.hash_db_journal)
+    return written
+
+def flush_location_db():
+    """Write locations held back by Db.update_location_db() to location.json
+    and location_misses.json.
+
+    :returns: int number of locations and misses written, 0 if nothing was
+        pending.
+    """
+    global __location_db_pending__
+    global __location_db_last_flush__
+
+    with __db_lock__:
+        if __location_db_pending__ == 0 or __location_db__ is None:
+            return 0
+
+        write_location_db(__location_db__)
+        if __location_misses__ or os.path.isfile(constants.location_miss_db):
+            write_json_file(constants.location_miss_db, __location_misses__ or [])
+        written = __location_db_pending__
+        __location_db_pending__ = 0
+        __location_db_last_flush__ = time.time()
+        log.info('Flushed %d new locations to location db' % written)
+        return written
+
+def write_location_db(location_db):
+    """Replace location.json with `location_db`.
+
+    The locations are written to a temporary file which is renamed over
+    location.json so a crash leaves either the old or the new file.
+
+    :param list location_db: Full contents of the location db.
+    """
+    write_json_file(constants.location_db, location_db)
+
+def write_json_file(path, payload, indent=1, sort_keys=True):
+    """Replace the JSON file at `path` through a temporary file.
+
+    :param str path: Path of the file.
+    :param payload: Data to write.
+    :param int indent: Indentation passed to json.dump().
+    :param bool sort_keys: Whether json.dump() sorts the keys.
+    :returns: int number of bytes written.
+    """
+    temporary_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temporary_path, 'w') as f:
+            json.dump(payload, f, indent=indent, sort_keys=sort_keys)
+            f.flush()
+            os.fsync(f.fileno())
+            written = f.tell()
+        _rename(temporary_path, path)
+    except (IOError, OSError):
+        if os.path.isfile(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return written
+
+def get_checksums(file_path):
+    """Get the checksum and partial checksum of a file.
+
+    This is a function so that it can be run by worker processes. Every
+    process creates its own Db the first time it's called.
+
+    :param str file_path: Path to the file.
+    :returns: tuple(str, str, str) of path, checksum and partial checksum.
+    """
+    global __process_db__
+
+    if __process_db__ is None:
+        __process_db__ = Db()
+    return (
+        file_path,
+        __process_db__.checksum(file_path),
+        __process_db__.partial_checksum(file_path)
+    )
+
+def verify_checksum(entry):
+    """Read a file from the hash db and compare it to its checksum.
+
+    This is a function so that it can be run by worker processes. The file
+    is always read in full, the checksum cache isn't used.
+
+    :param tuple entry: Checksum and path as returned by Db.all().
+    :returns: tuple(str, str, bool, tuple) of checksum, path, whether the
+        file matched and the stat details it was verified for. The stat
+        details are None if the file doesn't exist.
+    """
+    global __process_db__
+
+    checksum, file_path = entry
+    if not os.path.isfile(file_path):
+        return (checksum, file_path, False, None)
+
+    if __process_db__ is None:
+        __process_db__ = Db()
+    stat_key = __process_db__.get_checksum_cache().stat_key(file_path)
+    actual_checksum = __process_db__.checksum(file_path, use_cache=False)
+    return (checksum, file_path, checksum == actual_checksum, stat_key)
+
+def get_metadata_cache():
+    """Get the metadata cache shared by every media object.
+
+    Its size can be set with `metadata_cache_size` in the [Database]
+    section of config.ini. A size of 0 turns the cache off.
+
+    :returns: MetadataCache or None if it's turned off.
+    """
+    global __metadata_cache__
+
+    size = constants.metadata_cache_size
+    config = load_config()
+    if 'Database' in config and 'metadata_cache_size' in config['Database']:
+        try:
+            size = int(config['Database']['metadata_cache_size'])
+        except ValueError:
+            log.error('Invalid metadata_cache_size in config.ini')
+
+    if size <= 0:
+        return None
+
+    with __db_lock__:
+        # A connection can't be shared with a forked worker process.
+        if(__metadata_cache__ is None or
+                __metadata_cache__.path != constants.metadata_cache or
+                __metadata_cache__.pid != os.getpid()):
+            if not os.path.exists(constants.application_directory):
+                os.makedirs(constants.application_directory)
+            __metadata_cache__ = MetadataCache(constants.metadata_cache, size)
+        __metadata_cache__.size = size
+        return __metadata_cache__
+
+def _flush_dbs_at_exit():
+    flush_location_db()
+    flush_hash_db()
+    stats = get_hash_db_flush_stats()
+    if stats['flushes'] > 0:
+        log.info('Hash db flushed %d times, bytes per flush: %s' % (
+            stats['flushes'], stats['bytes']
+        ))
+
+def _flush_dbs_on_signal(signum, frame):
+    flush_location_db()
+    flush_hash_db()
+    previous = __previous_signal_handlers__.get(signum)
+    if previous == signal.SIG_IGN:
+        return
+    if callable(previous):
+        previous(signum, frame)
+    else:
+        sys.exit(128 + signum)
+
+def _register_exit_handlers():
+    global __exit_handlers_registered__
+
+    if __exit_handlers_registered__:
+        return
+    __exit_handlers_registered__ = True
+
+    atexit.register(_flush_dbs_at_exit)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            __previous_signal_handlers__[signum] = signal.signal(
+                signum,
+                _flush_dbs_on_signal
+            )
+        except ValueError:
+            # Signal handlers can only be installed from the main thread.
+            pass
+
+class LocationIndex(object):
+
+    """A grid over latitude and longitude for finding nearby locations.
+
+    Locations are put in buckets of `cell_size` degrees so a lookup only has
+    to look at the buckets which are within the threshold of the point
+    instead of at every location.
+
+    :param list locations: Entries of the location db to index.
+    :param float cell_size: Size of a grid cell in degrees.
+    """
+
+    #: Radius of the earth in meters.
+    earth_radius = 6371000
+
+    def __init__(self, locations=None, cell_size=0.1):
+        self.cell_size = cell_size
+        self.cells = {}
+        for data in locations or []:
+            self.add(data)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.cells.values())
+
+    def add(self, data):
+        """Add an entry of the location db to the index.
+
+        :param dict data: Location with `lat`, `long` and `name` keys.
+        """
+        key = self.cell(data['lat'], data['long'])
+        self.cells.setdefault(key, []).append(
+            (radians(data['lat']), radians(data['long']), data)
+        )
+
+    def cell(self, latitude, longitude):
+        return (
+            int(floor(latitude / self.cell_size)),
+            int(floor(longitude / self.cell_size))
+        )
+
+    def nearest(self, latitude, longitude, threshold_m):
+        """Find the closest location within `threshold_m` meters.
+
+        :param float latitude: Latitude of the point.
+        :param float longitude: Longitude of the point.
+        :param int threshold_m: Maximum distance in meters.
+        :returns: tuple(float, dict) of distance and location, or None.
+        """
+        if not self.cells:
+            return None
+
+        threshold_degrees = degrees(float(threshold_m) / self.earth_radius)
+        lat_cells = int(ceil(threshold_degrees / self.cell_size))
+
+        # Cells get narrower towards the poles so we need more of them to
+        #  cover the threshold. Use the latitude closest to a pole which is
+        #  still within range.
+        max_lon_cells = int(ceil(180 / self.cell_size))
+        cos_lat = cos(radians(min(
+            90,
+            abs(latitude) + (lat_cells + 1) * self.cell_size
+        )))
+        if cos_lat < 1e-9:
+            lon_cells = max_lon_cells
+        else:
+            lon_cells = min(
+                max_lon_cells,
+                int(ceil(threshold_degrees / cos_lat / self.cell_size))
+            )
+
+        lat1 = radians(latitude)
+        lon1 = radians(longitude)
+        center_lat, center_lon = self.cell(latitude, longitude)
+        nearest = None
+        for lat_cell in range(center_lat - lat_cells, center_lat + lat_cells + 1):
+            for lon_cell in range(center_lon - lon_cells, center_lon + lon_cells + 1):
+                bucket = self.cells.get((lat_cell, lon_cell))
+                if bucket is None:
+                    continue
+
+                for lat2, lon2, data in bucket:
+                    # As threshold is quite small use simple math
+                    # From http://stackoverflow.com/questions/15736995/how-can-i-quickly-estimate-the-distance-between-two-latitude-longitude-points  # noqa
+                    x = (lon2 - lon1) * cos(0.5 * (lat2 + lat1))
+                    y = lat2 - lat1
+                    d = self.earth_radius * sqrt(x * x + y * y)
+                    if(d <= threshold_m and (nearest is None or d < nearest[0])):
+                        nearest = (d, data)
+
+        return nearest
+
+class LocationNameIndex(object):
+
+    """An index of the locations in the location db by their names.
+
+    Names are looked up case-insensitively and with runs of whitespace
+    treated as a single space. Locations named with a dict of place names
+    (see gh-160) can be found by their default name and by their place
+    names joined from the most to the least specific, for example
+    "Las Vegas", "Las Vegas, Nevada" and "Las Vegas, Nevada, United States".
+    The first location added for a name wins.
+
+    :param list locations: Entries of the location db to index.
+    """
+
+    #: Keys of place name dicts from the most to the least specific.
+    place_keys = ('hamlet', 'village', 'city', 'town', 'state', 'country')
+
+    def __init__(self, locations=None):
+        self.names = {}
+        for data in locations or []:
+            self.add(data)
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def normalize(name):
+        """Normalize a location name for lookups.
+
+        :param str name: Name of a location.
+        :returns: str
+        """
+        # str.casefold() is only there on Python 3.
+        if hasattr(name, 'casefold'):
+            name = name.casefold()
+        else:
+            name = name.lower()
+        return ' '.join(name.split())
+
+    def add(self, data):
+        """Add an entry of the location db to the index.
+
+        :param dict data: Location with `lat`, `long` and `name` keys.
+        """
+        name = data['name']
+        if isinstance(name, dict):
+            names = [name['default']] if 'default' in name else []
+            parts = [name[key] for key in self.place_keys if key in name]
+            for count in range(1, len(parts) + 1):
+                names.append(', '.join(parts[:count]))
+        else:
+            names = [name]
+
+        for this_name in names:
+            # json gives unicode names on Python 2.
+            if not isinstance(this_name, six.string_types):
+                continue
+            self.names.setdefault(
+                self.normalize(this_name),
+                (data['lat'], data['long'])
+            )
+
+    def get(self, name):
+        """Get the coordinates of the location with `name`.
+
+        :param str name: Name of the location.
+        :returns: tuple(float) of latitude and longitude, or None.
+        """
+        return self.names.get(self.normalize(name))
+
+class ChecksumCache(object):
+
+    """Checksums of files keyed by their path and stat details.
+
+    A cached checksum is only returned while the device, inode, size and
+    modification time of the file are unchanged so an edited or replaced
+    file is always hashed again.
+
+    :param str path: Path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path,
+            timeout=30,
+            check_same_thread=False
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            'path TEXT PRIMARY KEY, device INTEGER, inode INTEGER, '
+            'size INTEGER, mtime_ns INTEGER, checksum TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def stat_key(file_path):
+        """Get the stat details a cached checksum is valid for.
+
+        :param str file_path: Path to the file.
+        :returns: tuple(int) of device, inode, size and mtime in nanoseconds.
+        """
+        stat = os.stat(file_path)
+        mtime_ns = getattr(stat, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(stat.st_mtime * 1000000000)
+        return (stat.st_dev, stat.st_ino, stat.st_size, mtime_ns)
+
+    def get(self, file_path):
+        """Get the cached checksum for a file if it hasn't changed.
+
+        :param str file_path: Path to the file.
+        :returns: str or None
+        """
+        key = self.stat_key(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT device, inode, size, mtime_ns, checksum '
+                'FROM checksums WHERE path = ?',
+                (os.path.abspath(file_path),)
+            ).fetchone()
+        if row is None or tuple(row[:4]) != key:
+            return None
+        return row[4]
+
+    def set(self, file_path, checksum, key=None):
+        """Cache the checksum of a file.
+
+        :param str file_path: Path to the file.
+        :param str checksum: Checksum of the file.
+        :param tuple key: Stat details from :meth:`stat_key` taken before
+            the file was hashed. Defaults to the current ones.
+        """
+        if key is None:
+            key = self.stat_key(file_path)
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO checksums '
+                '(path, device, inode, size, mtime_ns, checksum) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (os.path.abspath(file_path),) + tuple(key) + (checksum,)
+            )
+            self.connection.commit()
+
+class MetadataCache(object):
+
+    """Metadata of files read by exiftool, keyed by their path and stat
+    details.
+
+    Like :class:`ChecksumCache` an entry is only returned while the device,
+    inode, size and modification time of the file are unchanged. Entries
+    also remember the exiftool arguments they were read with so a media
+    class which reads other tags doesn't get them. Once there are more than
+    `size` entries the least recently used ones are removed.
+
+    :param str path: Path to the SQLite database file.
+    :param int size: Maximum number of entries.
+    """
+
+    #: Number of hits remembered before their time of use is written.
+    touch_every = 256
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.connection = sqlite3.connect(
+            path,
+            timeout=30,
+            check_same_thread=False
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS metadata ('
+            'path TEXT PRIMARY KEY, device INTEGER, inode INTEGER, '
+            'size INTEGER, mtime_ns INTEGER, params TEXT NOT NULL, '
+            'metadata TEXT NOT NULL, used_at REAL NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS metadata_used_at ON metadata (used_at)'
+        )
+        self.connection.commit()
+
+    def get(self, file_path, params):
+        """Get the cached metadata for a file if it hasn't changed.
+
+        :param str file_path: Path to the file.
+        :param str params: The exiftool arguments the metadata is read with.
+        :returns: dict or None
+        """
+        try:
+            key = ChecksumCache.stat_key(file_path)
+        except OSError:
+            return None
+
+        path = os.path.abspath(file_path)
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT device, inode, size, mtime_ns, params, metadata '
+                'FROM metadata WHERE path = ?',
+                (path,)
+            ).fetchone()
+            if row is None or tuple(row[:4]) != key or row[4] != params:
+                return None
+
+            self.touched[path] = time.time()
+            if len(self.touched) >= self.touch_every:
+                self._write_touched()
+                self.connection.commit()
+
+        metadata = json.loads(row[5])
+        # The file may have been read under another path which links to it.
+        metadata['SourceFile'] = file_path
+        return metadata
+
+    def set_many(self, metadata_list, params):
+        """Cache the metadata of files.
+
+        :param list metadata_list: dicts in the format of
+            :meth:`~elodie.external.pyexiftool.ExifTool.execute_json`.
+        :param str params: The exiftool arguments the metadata was read
+            with.
+        """
+        now = time.time()
+        rows = []
+        for metadata in metadata_list:
+            if 'SourceFile' not in metadata:
+                continue
+            try:
+                key = ChecksumCache.stat_key(metadata['SourceFile'])
+            except OSError:
+                continue
+            rows.append(
+                (os.path.abspath(metadata['SourceFile']),) + key +
+                (params, json.dumps(metadata), now)
+            )
+
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO metadata (path, device, inode, size, '
+                'mtime_ns, params, metadata, used_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            self._write_touched()
+            self._evict()
+            self.connection.commit()
+
+    def remove(self, file_path):
+        """Forget the metadata of a file, for example after writing to it.
+
+        :param str file_path: Path to the file.
+        """
+        path = os.path.abspath(file_path)
+        with self.lock:
+            self.touched.pop(path, None)
+            self.connection.execute(
+                'DELETE FROM metadata WHERE path = ?',
+                (path,)
+            )
+            self.connection.commit()
+
+    def _write_touched(self):
+        self.connection.executemany(
+            'UPDATE metadata SET used_at = ? WHERE path = ?',
+            [(used_at, path) for path, used_at in self.touched.items()]
+        )
+        self.touched = {}
+
+    def _evict(self):
+        count = self.connection.execute(
+            'SELECT COUNT(*) FROM metadata'
+        ).fetchone()[0]
+        if count <= self.size:
+            return
+
+        # Make some room so the next few files don't evict one at a time.
+        excess = count - self.size + self.size // 10
+        self.connection.execute(
+            'DELETE FROM metadata WHERE path IN ('
+            'SELECT path FROM metadata ORDER BY used_at LIMIT ?)',
+            (excess,)
+        )
+
+class HashIndex(object):
+
+    """Sizes and partial checksums of the files in the hash db.
+
+    Used to tell that a file can't have been imported before without
+    computing its full checksum. That only holds while the index covers
+    every entry of the hash db, which is tracked by a `complete` flag. It's
+    set when the index is created next to an empty hash db or when the
+    hash db is reset and regenerated.
+
+    :param str path: Path to the SQLite database file.
+    :param bool complete: Whether the index starts out complete if it
+        doesn't exist yet.
+    """
+
+    def __init__(self, path, complete):
+        self.path = path
+        self.pid = os.getpid()
+        self.connection = sqlite3.connect(
+            path,
+            timeout=30,
+            check_same_thread=False
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS partials ('
+            'checksum TEXT PRIMARY KEY, size INTEGER NOT NULL, '
+            'partial TEXT NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS partials_size ON partials (size)'
+        )
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS partials_partial ON partials (partial)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+        )
+        self.connection.execute(
+            'INSERT OR IGNORE INTO meta (key, value) VALUES (?, ?)',
+            ('complete', '1' if complete else '0')
+        )
+        self.connection.commit()
+
+    def add(self, checksum, partial):
+        """Add the partial checksum of a file in the hash db.
+
+        :param str checksum: Full checksum of the file.
+        :param str partial: Partial checksum from Db.partial_checksum().
+        """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO partials (checksum, size, partial) '
+            'VALUES (?, ?, ?)',
+            (checksum, int(partial.split(':', 1)[0]), partial)
+        )
+
+    def clear(self):
+        """Remove all entries and mark the index complete."""
+        self.connection.execute('DELETE FROM partials')
+        self.connection.execute(
+            'UPDATE meta SET value = ? WHERE key = ?',
+            ('1', 'complete')
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def has_partial(self, partial):
+        return self.connection.execute(
+            'SELECT 1 FROM partials WHERE partial = ? LIMIT 1',
+            (partial,)
+        ).fetchone() is not None
+
+    def has_size(self, size):
+        return self.connection.execute(
+            'SELECT 1 FROM partials WHERE size = ? LIMIT 1',
+            (size,)
+        ).fetchone() is not None
+
+    def is_complete(self):
+        row = self.connection.execute(
+            'SELECT value FROM meta WHERE key = ?',
+            ('complete',)
+        ).fetchone()
+        return row is not None and row[0] == '1'
+
+class VerifyState(object):
+
+    """When each file in the hash db was last verified and how it went.
+
+    State is committed every `commit_every` files so an interrupted verify
+    keeps what it had done.
+
+    :param str path: Path to the SQLite database file.
+    :param int commit_every: Number of files between commits.
+    """
+
+    def __init__(self, path, commit_every=100):
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS verified ('
+            'path TEXT PRIMARY KEY, checksum TEXT NOT NULL, '
+            'device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, '
+            'verified_at REAL NOT NULL, ok INTEGER NOT NULL)'
+        )
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def least_recently_verified(self, entries, count):
+        """Pick the `count` entries which were verified longest ago.
+
+        Files which were never verified come first, in random order, so
+        verifying a sample every run rotates through the whole library.
+
+        :param list entries: Checksum and path tuples from Db.all().
+        :param int count: Number of entries to pick.
+        :returns: list
+        """
+        verified_at = dict(self.connection.execute(
+            'SELECT path, verified_at FROM verified'
+        ))
+        entries = list(entries)
+        random.shuffle(entries)
+        entries.sort(key=lambda entry: verified_at.get(entry[1], 0))
+        return entries[:count]
+
+    def set(self, checksum, file_path, ok, stat_key):
+        """Record the outcome of verifying a file.
+
+        :param str checksum: Checksum the file was verified against.
+        :param str file_path: Path to the file.
+        :param bool ok: Whether the file matched.
+        :param tuple stat_key: Stat details of the file from
+            ChecksumCache.stat_key(), or None.
+        """
+        if stat_key is None:
+            stat_key = (None, None, None, None)
+        self.connection.execute(
+            'INSERT OR REPLACE INTO verified (path, checksum, device, inode, '
+            'size, mtime_ns, verified_at, ok) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (file_path, checksum) + tuple(stat_key) + (time.time(), int(ok))
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def unchanged(self, checksum, file_path, stat_key):
+        """Check if a file passed its last verify and hasn't changed since.
+
+        :param str checksum: Checksum the file should have.
+        :param str file_path: Path to the file.
+        :param tuple stat_key: Current stat details of the file.
+        :returns: bool
+        """
+        row = self.connection.execute(
+            'SELECT checksum, device, inode, size, mtime_ns, ok '
+            'FROM verified WHERE path = ?',
+            (file_path,)
+        ).fetchone()
+        return (
+            row is not None and
+            row[0] == checksum and
+            row[5] == 1 and
+            tuple(row[1:5]) == tuple(stat_key)
+        )
+
+class JsonHashDb(object):
+
+    """A dict like view of the hash db loaded from hash.json.
+
+    The loaded entries are shared by every Db of the process and only read
+    here. Entries added through this view are kept on top of them until
+    :meth:`Db.update_hash_db` adds them to the shared entries, so opening
+    a Db doesn't copy the whole hash db.
+
+    :param dict shared: Entries of the hash db shared by the process.
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.added = {}
+        self.cleared = False
+
+    def __contains__(self, key):
+        return key in self.added or (not self.cleared and key in self.shared)
+
+    def __getitem__(self, key):
+        if key in self.added:
+            return self.added[key]
+        if self.cleared:
+            raise KeyError(key)
+        return self.shared[key]
+
+    def __setitem__(self, key, value):
+        self.added[key] = value
+
+    def __len__(self):
+        if self.cleared:
+            return len(self.added)
+        with __db_lock__:
+            return len(self.shared) + len(
+                [key for key in self.added if key not in self.shared]
+            )
+
+    def clear(self):
+        self.added = {}
+        self.cleared = True
+
+    def copy(self):
+        """Get the entries of the view as a new dict.
+
+        :returns: dict
+        """
+        entries = {}
+        if not self.cleared:
+            # The shared entries are updated in place under the lock.
+            with __db_lock__:
+                entries.update(self.shared)
+        entries.update(self.added)
+        return entries
+
+    def items(self):
+        return self.copy().items()
+
+class SqliteHashDb(object):
+
+    """A dict like view of the hash db stored in SQLite.
+
+    Lookups use the primary key index and writes are only visible to other
+    connections once :meth:`commit` is called. The database runs in WAL
+    mode so readers don't block the writer.
+
+    :param str path: Path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(
+            path,
+            timeout=30,
+            check_same_thread=False
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS hashes '
+            '(checksum TEXT PRIMARY KEY, path TEXT NOT NULL)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta '
+            '(name TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+        self.connection.commit()
+
+    def __contains__(self, key):
+        cursor = self.connection.execute(
+            'SELECT 1 FROM hashes WHERE checksum = ?',
+            (key,)
+        )
+        return cursor.fetchone() is not None
+
+    def __getitem__(self, key):
+        cursor = self.connection.execute(
+            'SELECT path FROM hashes WHERE checksum = ?',
+            (key,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def __setitem__(self, key, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO hashes (checksum, path) VALUES (?, ?)',
+            (key, value)
+        )
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM hashes'
+        ).fetchone()[0]
+
+    def backup(self, path):
+        """Copy the committed contents of the database to `path`.
+
+        :param str path: Path of the backup file.
+        """
+        destination = sqlite3.connect(path)
+        try:
+            self.connection.backup(destination)
+        finally:
+            destination.close()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM hashes')
+
+    def commit(self):
+        self.connection.commit()
+
+    def get_meta(self, name):
+        """Get a value from the meta table.
+
+        :param str name: Name of the value.
+        :returns: str or None if it isn't set.
+        """
+        cursor = self.connection.execute(
+            'SELECT value FROM meta WHERE name = ?',
+            (name,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, name, value):
+        """Set a value in the meta table.
+
+        Like other writes it's only visible once :meth:`commit` is called.
+
+        :param str name: Name of the value.
+        :param str value: The value.
+        """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+            (name, value)
+        )
+
+    def items(self):
+        cursor = self.connection.execute('SELECT checksum, path FROM hashes')
+        for row in cursor:
+            yield (row[0], row[1])
+
+    def update(self, entries, replace=True):
+        """Add `entries` to the database.
+
+        :param dict entries: Paths keyed by checksum.
+        :param bool replace: Replace the paths of checksums which are
+            already in the database. Otherwise those are kept.
+        """
+        self.connection.executemany(
+            'INSERT OR %s INTO hashes (checksum, path) VALUES (?, ?)' % (
+                'REPLACE' if replace else 'IGNORE'
+            ),
+            entries.items()
+        )
 
 class Db(object):
 
     """A class for interacting with the JSON files created by Elodie."""
 
     def __init__(self):
-        global __hash_db__
         global __location_db__
+        global __location_index__
+        global __location_name_index__
+        global __location_misses__
+        global __location_miss_index__
 
         # verify that the application directory (~/.elodie) exists,
         #   else create it
         if not os.path.exists(constants.application_directory):
             os.makedirs(constants.application_directory)
 
-        # If the hash db doesn't exist we create it.
-        # Otherwise we only open for reading
-        if not os.path.isfile(constants.hash_db):
-            with open(constants.hash_db, 'a'):
-                os.utime(constants.hash_db, None)
-
-        if __hash_db__ == None:
-            self.hash_db = {}
+        # Entries added since the last call to update_hash_db().
+        self.hash_db_added = {}
+        self.hash_db_reset = False
+        self.hash_index = None
+        self.hash_index_added = {}
+        self.hash_index_reset = False
 
-            # We know from above that this file exists so we open it
-            #   for reading only.
-            with open(constants.hash_db, 'r') as f:
-                try:
-                    self.hash_db = json.load(f)
-                except ValueError:
-                    pass
-            __hash_db__ = copy.deepcopy(self.hash_db)
+        if self.use_sqlite():
+            self.hash_db = self.open_sqlite_hash_db()
         else:
-            self.hash_db = copy.deepcopy(__hash_db__)
+            self.load_json_hash_db()
+
+        # Group commits of the hash db and new locations are written at
+        #  exit.
+        _register_exit_handlers()
 
         # If the location db doesn't exist we create it.
         # Otherwise we only open for reading
@@ -70,18 +1053,153 @@ class Db(object):
                 os.utime(constants.location_db, None)
 
         if __location_db__ == None:
-            self.location_db = []
+            location_db = []
 
             # We know from above that this file exists so we open it
             #   for reading only.
             with open(constants.location_db, 'r') as f:
                 try:
-                    self.location_db = json.load(f)
+                    location_db = json.load(f)
                 except ValueError:
                     pass
-            __location_db__ = copy.deepcopy(self.location_db)
-        else:
-            self.location_db = copy.deepcopy(__location_db__)
+            __location_db__ = location_db
+            __location_index__ = None
+            __location_name_index__ = None
+
+        # Locations are only ever appended so every Db shares the list.
+        self.location_db = __location_db__
+
+        # The index of saved locations is shared by every Db and only built
+        #  once. Locations added to this Db go in their own index until
+        #  they're written.
+        if __location_index__ is None:
+            __location_index__ = LocationIndex(__location_db__)
+        self.location_index = __location_index__
+        self.location_index_added = LocationIndex()
+        if __location_name_index__ is None:
+            __location_name_index__ = LocationNameIndex(__location_db__)
+        self.location_name_index = __location_name_index__
+        self.location_name_index_added = LocationNameIndex()
+
+        # Places where lookups found nothing. Expired ones are dropped.
+        if __location_misses__ is None:
+            __location_misses__ = []
+            if os.path.isfile(constants.location_miss_db):
+                with open(constants.location_miss_db, 'r') as f:
+                    try:
+                        __location_misses__ = [
+                            data for data in json.load(f)
+                            if not self.is_expired_miss(data)
+                        ]
+                    except ValueError:
+                        pass
+            __location_miss_index__ = None
+        if __location_miss_index__ is None:
+            __location_miss_index__ = LocationIndex(__location_misses__)
+        self.location_miss_index = __location_miss_index__
+        self.location_misses_added = []
+        self.location_miss_index_added = LocationIndex()
+        # Locations added since the last call to update_location_db().
+        self.location_db_added = []
+
+    def use_sqlite(self):
+        """Check if config.ini selects the SQLite hash db.
+
+        :returns: bool
+        """
+        config = load_config()
+        return (
+            'Database' in config and
+            'backend' in config['Database'] and
+            config['Database']['backend'].lower() == 'sqlite'
+        )
+
+    def group_commit_settings(self):
+        """Get how often hash.json is rewritten from config.ini.
+
+        `flush_every` is the number of files and `flush_interval` the number
+        of seconds after which held back entries are written. A
+        `flush_every` of 0 only flushes on time. The default of (1, 0)
+        writes hash.json on every update.
+
+        :returns: tuple(int, float) of flush_every and flush_interval.
+        """
+        config = load_config()
+        if 'Database' not in config:
+            return (1, 0)
+
+        try:
+            flush_interval = float(config['Database'].get('flush_interval', 0))
+            flush_every = int(config['Database'].get(
+                'flush_every',
+                0 if flush_interval > 0 else 1
+            ))
+        except ValueError:
+            log.warn('Invalid flush_every or flush_interval in config.ini')
+            return (1, 0)
+
+        if flush_interval <= 0:
+            return (max(1, flush_every), 0)
+        return (max(0, flush_every), flush_interval)
+
+    def open_sqlite_hash_db(self):
+        """Open the SQLite hash db.
+
+        The first time it's opened any entries in hash.json and its journal
+        are copied into it. hash.json itself is left untouched. The entries
+        are committed together with a `migrated` marker so a migration which
+        is interrupted runs again the next time.
+
+        :returns: SqliteHashDb
+        """
+        hash_db = SqliteHashDb(constants.hash_db_sqlite)
+        if hash_db.get_meta('migrated') is not None:
+            return hash_db
+
+        entries = {}
+        if os.path.isfile(constants.hash_db):
+            with open(constants.hash_db, 'r') as f:
+                try:
+                    entries = json.load(f)
+                except ValueError:
+                    entries = {}
+        entries.update(self.read_hash_db_journal())
+        if entries:
+            log.info('Migrating %d entries from %s to %s' % (
+                len(entries), constants.hash_db, constants.hash_db_sqlite
+            ))
+            # Entries already in hash.db are newer than the ones in hash.json.
+            hash_db.update(entries, False)
+        hash_db.set_meta('migrated', '1')
+        hash_db.commit()
+
+        return hash_db
+
+    def load_json_hash_db(self):
+        """Load the hash db from hash.json."""
+        global __hash_db__
+
+        # If the hash db doesn't exist we create it.
+        # Otherwise we only open for reading
+        if not os.path.isfile(constants.hash_db):
+            with open(constants.hash_db, 'a'):
+                os.utime(constants.hash_db, None)
+
+        # Other threads update the shared hash db under the lock.
+        with __db_lock__:
+            if __hash_db__ == None:
+                hash_db = {}
+
+                # We know from above that this file exists so we open it
+                #   for reading only.
+                with open(constants.hash_db, 'r') as f:
+                    try:
+                        hash_db = json.load(f)
+                    except ValueError:
+                        pass
+                hash_db.update(self.read_hash_db_journal())
+                __hash_db__ = hash_db
+            self.hash_db = JsonHashDb(__hash_db__)
 
     def add_hash(self, key, value, write=False):
         """Add a hash to the hash db.
@@ -91,17 +1209,24 @@ class Db(object):
         :param bool write: If true, write the hash db to disk.
         """
         self.hash_db[key] = value
+        self.hash_db_added[key] = value
         if(write is True):
             self.update_hash_db()
 
+    def add_partial_checksum(self, key, partial):
+        """Add the partial checksum of a file to the hash index.
+
+        It's written along with the hash db by update_hash_db().
+
+        :param str key: Checksum of the file as used in the hash db.
+        :param str partial: Partial checksum from partial_checksum().
+        """
+        self.hash_index_added[key] = partial
+
     # Location database
-    # Currently quite simple just a list of long/lat pairs with a name
-    # If it gets many entries a lookup might take too long and a better
-    # structure might be needed. Some speed up ideas:
-    # - Sort it and inter-half method can be used
-    # - Use integer part of long or lat as key to get a lower search list
-    # - Cache a small number of lookups, photos are likely to be taken in
-    #   clusters around a spot during import.
+    # A list of long/lat pairs with a name which is written to disk as is.
+    # Lookups by coordinates go through a LocationIndex grid so they only
+    #   look at locations near the point.
     def add_location(self, latitude, longitude, place, write=False):
         """Add a location to the database.
 
@@ -114,14 +1239,21 @@ class Db(object):
         data['lat'] = latitude
         data['long'] = longitude
         data['name'] = place
-        self.location_db.append(data)
+        self.location_db_added.append(data)
+        self.location_index_added.add(data)
+        self.location_name_index_added.add(data)
         if(write is True):
             self.update_location_db()
 
     def backup_hash_db(self):
         """Backs up the hash db."""
+        mask = strftime('%Y-%m-%d_%H-%M-%S')
+        if isinstance(self.hash_db, SqliteHashDb):
+            backup_file_name = '%s-%s' % (constants.hash_db_sqlite, mask)
+            self.hash_db.backup(backup_file_name)
+            return backup_file_name
+
         if os.path.isfile(constants.hash_db):
-            mask = strftime('%Y-%m-%d_%H-%M-%S')
             backup_file_name = '%s-%s' % (constants.hash_db, mask)
             copyfile(constants.hash_db, backup_file_name)
             return backup_file_name
@@ -134,16 +1266,32 @@ class Db(object):
         """
         return key in self.hash_db
 
-    def checksum(self, file_path, blocksize=65536):
+    @staticmethod
+    def checksum(file_path, blocksize=65536, use_cache=True):
         """Create a hash value for the given file.
 
         See http://stackoverflow.com/a/3431835/1318758.
 
+        Checksums are cached by the path and stat details of the file. Files
+        which haven't changed since they were last hashed aren't read again
+        unless `constants.rehash` is True.
+
         :param str file_path: Path to the file to create a hash for.
         :param int blocksize: Read blocks of this size from the file when
             creating the hash.
+        :param bool use_cache: If False, always read the file and don't
+            touch the cache.
         :returns: str or None
         """
+        cache = None
+        if use_cache:
+            cache = Db.get_checksum_cache()
+            key = cache.stat_key(file_path)
+            if not constants.rehash:
+                cached_checksum = cache.get(file_path)
+                if cached_checksum is not None:
+                    return cached_checksum
+
         hasher = hashlib.sha256()
         with open(file_path, 'rb') as f:
             buf = f.read(blocksize)
@@ -151,8 +1299,92 @@ class Db(object):
             while len(buf) > 0:
                 hasher.update(buf)
                 buf = f.read(blocksize)
-            return hasher.hexdigest()
-        return None
+            checksum = hasher.hexdigest()
+
+        if cache is not None:
+            cache.set(file_path, checksum, key)
+        return checksum
+
+    @staticmethod
+    def partial_checksum(file_path, blocksize=65536):
+        """Create a cheap hash value from the size, head and tail of a file.
+
+        Files with different partial checksums can't have the same
+        checksum so this is enough to rule out most duplicates without
+        reading whole files.
+
+        :param str file_path: Path to the file to create a hash for.
+        :param int blocksize: Number of bytes to read from the start and
+            from the end of the file.
+        :returns: str
+        """
+        size = os.path.getsize(file_path)
+        hasher = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            hasher.update(f.read(blocksize))
+            if size > blocksize:
+                f.seek(max(blocksize, size - blocksize))
+                hasher.update(f.read(blocksize))
+        return '%d:%s' % (size, hasher.hexdigest())
+
+    def get_hash_index(self):
+        """Get the size and partial checksum index of the hash db.
+
+        The index is shared by every Db in a process so its connection is
+        only opened once.
+
+        :returns: HashIndex
+        """
+        global __hash_index__
+
+        if self.hash_index is None:
+            with __db_lock__:
+                # A connection can't be shared with a forked worker process.
+                if(__hash_index__ is None or
+                        __hash_index__.path != constants.hash_index or
+                        __hash_index__.pid != os.getpid()):
+                    __hash_index__ = HashIndex(
+                        constants.hash_index,
+                        len(self.hash_db) == 0
+                    )
+                self.hash_index = __hash_index__
+        return self.hash_index
+
+    def may_have_hash(self, partial):
+        """Check if a file with this partial checksum may be in the hash db.
+
+        A file whose size isn't in the index, or else whose partial
+        checksum isn't, can't be. If the index doesn't cover the whole hash
+        db then every file may be.
+
+        :param str partial: Partial checksum from partial_checksum().
+        :returns: bool
+        """
+        hash_index = self.get_hash_index()
+        size = int(partial.split(':', 1)[0])
+        with __db_lock__:
+            if not hash_index.is_complete():
+                return True
+            return (
+                hash_index.has_size(size) and
+                hash_index.has_partial(partial)
+            )
+
+    @staticmethod
+    def get_checksum_cache():
+        """Get the checksum cache shared by every Db.
+
+        :returns: ChecksumCache
+        """
+        global __checksum_cache__
+
+        with __db_lock__:
+            # A connection can't be shared with a forked worker process.
+            if(__checksum_cache__ is None or
+                    __checksum_cache__.path != constants.checksum_cache or
+                    __checksum_cache__.pid != os.getpid()):
+                __checksum_cache__ = ChecksumCache(constants.checksum_cache)
+            return __checksum_cache__
 
     def get_hash(self, key):
         """Get the hash value for a given key.
@@ -164,6 +1396,38 @@ class Db(object):
             return self.hash_db[key]
         return None
 
+    def add_location_miss(self, latitude, longitude):
+        """Remember that a lookup found nothing for a location.
+
+        The miss is written with the locations by
+        :meth:`update_location_db`.
+
+        :param float latitude: Latitude of the location.
+        :param float longitude: Longitude of the location.
+        """
+        data = {'lat': latitude, 'long': longitude, 'time': time.time()}
+        self.location_misses_added.append(data)
+        self.location_miss_index_added.add(data)
+
+    def is_expired_miss(self, data):
+        return data['time'] + constants.location_miss_ttl < time.time()
+
+    def is_location_miss(self, latitude, longitude, threshold_m):
+        """Check if a lookup found nothing near a location recently.
+
+        :param float latitude: Latitude of the location.
+        :param float longitude: Longitude of the location.
+        :param int threshold_m: The miss must be this close to the given
+            latitude and longitude.
+        :returns: bool
+        """
+        for index in (self.location_miss_index, self.location_miss_index_added):
+            match = index.nearest(latitude, longitude, threshold_m)
+            if match is not None and not self.is_expired_miss(match[1]):
+                return True
+
+        return False
+
     def get_location_name(self, latitude, longitude, threshold_m):
         """Find a name for a location in the database.
 
@@ -173,28 +1437,20 @@ class Db(object):
             the given latitude and longitude.
         :returns: str, or None if a matching location couldn't be found.
         """
-        last_d = sys.maxsize
-        name = None
-        for data in self.location_db:
-            # As threshold is quite small use simple math
-            # From http://stackoverflow.com/questions/15736995/how-can-i-quickly-estimate-the-distance-between-two-latitude-longitude-points  # noqa
-            # convert decimal degrees to radians
-
-            lon1, lat1, lon2, lat2 = list(map(
-                radians,
-                [longitude, latitude, data['long'], data['lat']]
-            ))
+        matches = [
+            match for match in (
+                self.location_index.nearest(latitude, longitude, threshold_m),
+                self.location_index_added.nearest(
+                    latitude,
+                    longitude,
+                    threshold_m
+                )
+            ) if match is not None
+        ]
+        if not matches:
+            return None
 
-            r = 6371000  # radius of the earth in m
-            x = (lon2 - lon1) * cos(0.5 * (lat2 + lat1))
-            y = lat2 - lat1
-            d = r * sqrt(x * x + y * y)
-            # Use if closer then threshold_km reuse lookup
-            if(d <= threshold_m and d < last_d):
-                name = data['name']
-            last_d = d
-
-        return name
+        return copy.deepcopy(min(matches, key=lambda match: match[0])[1]['name'])
 
     def get_location_coordinates(self, name):
         """Get the latitude and longitude for a location.
@@ -202,11 +1458,10 @@ class Db(object):
         :param str name: Name of the location.
         :returns: tuple(float), or None if the location wasn't in the database.
         """
-        for data in self.location_db:
-            if data['name'] == name:
-                return (data['lat'], data['long'])
-
-        return None
+        coordinates = self.location_name_index.get(name)
+        if coordinates is None:
+            coordinates = self.location_name_index_added.get(name)
+        return coordinates
 
     def all(self):
         """Generator to get all entries from self.hash_db
@@ -216,22 +1471,139 @@ class Db(object):
         for checksum, path in self.hash_db.items():
             yield (checksum, path)
 
+    def read_hash_db_journal(self):
+        """Read entries which were journaled but not yet flushed.
+
+        A torn last line from a crash is ignored.
+
+        :returns: dict
+        """
+        entries = {}
+        if not os.path.isfile(constants.hash_db_journal):
+            return entries
+
+        with open(constants.hash_db_journal, 'r') as f:
+            for line in f:
+                try:
+                    entries.update(json.loads(line))
+                except ValueError:
+                    pass
+        return entries
+
     def reset_hash_db(self):
-        self.hash_db = {}
+        self.hash_db.clear()
+        self.hash_db_added = {}
+        self.hash_db_reset = True
+        self.hash_index_added = {}
+        self.hash_index_reset = True
 
     def update_hash_db(self):
-        """Write the hash db to disk."""
+        """Write the hash db to disk.
+
+        If config.ini sets `flush_every` or `flush_interval` new entries are
+        appended to a journal and hash.json is only rewritten once enough
+        files or time have passed, and again when Elodie exits.
+        """
         global __hash_db__
+        global __hash_db_pending__
+        global __hash_db_last_flush__
+
+        # The index has to cover every entry in the hash db so it's always
+        #  written first.
+        if self.hash_index_added or self.hash_index_reset:
+            with __db_lock__:
+                hash_index = self.get_hash_index()
+                if self.hash_index_reset:
+                    hash_index.clear()
+                for key, partial in self.hash_index_added.items():
+                    hash_index.add(key, partial)
+                hash_index.commit()
+            self.hash_index_added = {}
+            self.hash_index_reset = False
+
+        if isinstance(self.hash_db, SqliteHashDb):
+            with __db_lock__:
+                self.hash_db.commit()
+            return
+
+        flush_every, flush_interval = self.group_commit_settings()
+        with __db_lock__:
+            rewrite = (flush_every, flush_interval) == (1, 0) or self.hash_db_reset
+            if not rewrite:
+                if len(self.hash_db_added) == 0:
+                    return
 
-        with open(constants.hash_db, 'w') as f:
-            json.dump(self.hash_db, f, indent=0)
-            __hash_db__ = copy.deepcopy(self.hash_db)
+                with open(constants.hash_db_journal, 'a') as f:
+                    f.write('%s\n' % json.dumps(self.hash_db_added))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            # The shared entries are only changed in place to add to them.
+            #  Db objects which are open keep the entries from before a reset.
+            if self.hash_db_reset or __hash_db__ is None:
+                __hash_db__ = self.hash_db.copy()
+            else:
+                __hash_db__.update(self.hash_db_added)
+            added = len(self.hash_db_added)
+            self.hash_db = JsonHashDb(__hash_db__)
+            self.hash_db_added = {}
+            self.hash_db_reset = False
+
+            if rewrite:
+                write_hash_db(__hash_db__)
+                __hash_db_pending__ = 0
+                return
+
+            __hash_db_pending__ += added
+
+            if __hash_db_last_flush__ is None:
+                __hash_db_last_flush__ = time.time()
+
+            if((flush_every > 0 and __hash_db_pending__ >= flush_every) or (
+                    flush_interval > 0 and
+                    time.time() - __hash_db_last_flush__ >= flush_interval)):
+                flush_hash_db()
 
     def update_location_db(self):
-        """Write the location db to disk."""
+        """Add the locations and misses added to this Db to the location db.
+
+        The locations are visible to every Db right away. location.json
+        is written once :data:`~elodie.constants.location_db_flush_every`
+        locations are waiting or
+        :data:`~elodie.constants.location_db_flush_interval` seconds have
+        passed since it was last written, and at exit.
+        """
         global __location_db__
+        global __location_db_pending__
+        global __location_db_last_flush__
+        global __location_misses__
+
+        with __db_lock__:
+            if __location_db__ is None:
+                __location_db__ = []
+            __location_db__.extend(self.location_db_added)
+            __location_db_pending__ += len(self.location_db_added)
+            for data in self.location_db_added:
+                self.location_index.add(data)
+                self.location_name_index.add(data)
+            self.location_db = __location_db__
+            self.location_db_added = []
+            self.location_index_added = LocationIndex()
+            self.location_name_index_added = LocationNameIndex()
+
+            if __location_misses__ is None:
+                __location_misses__ = []
+            __location_misses__.extend(self.location_misses_added)
+            __location_db_pending__ += len(self.location_misses_added)
+            for data in self.location_misses_added:
+                self.location_miss_index.add(data)
+            self.location_misses_added = []
+            self.location_miss_index_added = LocationIndex()
 
-        with open(constants.location_db, 'w') as f:
-            json.dump(self.location_db, f, indent=1, sort_keys =True)
-            __location_db__ = copy.deepcopy(self.location_db)
+            if __location_db_last_flush__ is None:
+                __location_db_last_flush__ = time.time()
+            if(__location_db_pending__ >= constants.location_db_flush_every or
+                    time.time() - __location_db_last_flush__ >=
+                    constants.location_db_flush_interval):
+                flush_location_db()
 
@@ -209,6 +209,14 @@ class Base(object):
         """
         return False
 
+    def defer_tags(self):
+        """Hold back tags set from now on so they can be written to another
+        file. See :meth:`~elodie.media.media.Media.write_deferred_tags`.
+
+        :returns: bool, False if this type of file is always written in place.
+        """
+        return False
+
     @classmethod
     def get_class_by_file(cls, _file, classes):
         """Static method to get a media object by file.
@@ -12,10 +12,24 @@ from __future__ import print_function
 
 import os
 import six
+import tempfile
+import threading
 
 # load modules
-from elodie.external.pyexiftool import ExifTool
-from elodie.media.base import Base
+from elodie import localstorage
+from elodie import constants
+from elodie import log
+from elodie.external.pyexiftool import ExifTool, ExifToolTimeout, check_ok
+from elodie.media.base import Base, get_all_subclasses
+
+# Attributes read ahead of time by Media.prefetch_exiftool_attributes().
+# They're kept per thread, keyed by the normalized path of the file, until
+#  a Media object for that file asks for them.
+__exiftool_prefetch__ = threading.local()
+
+# Arguments for exiftool which read the tags a Media class uses, by class
+#  and speed option.
+__exiftool_params__ = {}
 
 class Media(Base):
 
@@ -26,6 +40,14 @@ class Media(Base):
 
     __name__ = 'Media'
 
+    #: Option which speeds up exiftool without losing tags from this type of
+    #:  file. ``-fast2`` also stops at the media data of QuickTime files,
+    #:  which is often before their metadata.
+    exiftool_speed = '-fast'
+
+    #: ``exiftool_speed`` for the extensions which need a different one.
+    exiftool_speed_by_extension = {}
+
     d_coordinates = {
         'latitude': 'latitude_ref',
         'longitude': 'longitude_ref'
@@ -52,6 +74,7 @@ class Media(Base):
         self.original_name_key = 'XMP:OriginalFileName'
         self.set_gps_ref = True
         self.exif_metadata = None
+        self.deferred_tags = None
 
     def get_album(self):
         """Get album from EXIF
@@ -122,19 +145,169 @@ class Media(Base):
 
         :returns: dict, or False if exiftool was not available.
 
-        The attributes are cached when they are read for the first time.
+        The attributes are cached when they are read for the first time,
+        both on this object and in the metadata cache on disk.
         """
         source = self.source
 
         #Cache exif metadata results and use if already exists for media
         if(self.exif_metadata is None):
-            self.exif_metadata = ExifTool().get_metadata(source)
+            self.exif_metadata = self.pop_prefetched_exiftool_attributes()
+        if(self.exif_metadata is None):
+            metadata_list = self.load_exiftool_attributes([source])
+            self.exif_metadata = metadata_list[0] if metadata_list else {}
+
+        # Tags held back by defer_tags() are read as if they were written.
+        if self.deferred_tags:
+            self.exif_metadata.update(self.deferred_tags)
 
         if not self.exif_metadata:
             return False
 
         return self.exif_metadata
 
+    def defer_tags(self):
+        """Hold back tags set from now on until
+        :meth:`write_deferred_tags` is called.
+
+        exiftool rewrites the whole file for every write so several tags
+        are best written together. Holding them back also leaves the source
+        alone when they're meant for a copy of it.
+
+        :returns: True
+        """
+        if self.deferred_tags is None:
+            self.deferred_tags = {}
+        return True
+
+    def write_deferred_tags(self, destination=None):
+        """Write the tags held back since :meth:`defer_tags` with one
+        exiftool call.
+
+        :param str destination: Fully qualified path of a copy of the file
+            to write to. Defaults to the file itself.
+        :returns: bool, or None if there was nothing to write.
+        """
+        tags = self.deferred_tags
+        self.deferred_tags = None
+        if not tags:
+            return None
+
+        if destination is None:
+            destination = self.source
+            self.pop_prefetched_exiftool_attributes()
+
+        status = ExifTool().set_tags(tags, destination)
+
+        # A copy is new so exiftool's backup of it isn't needed.
+        if(destination != self.source and
+                os.path.exists(destination + '_original')):
+            os.remove(destination + '_original')
+
+        cache = localstorage.get_metadata_cache()
+        if cache is not None:
+            cache.remove(destination)
+        self.reset_cache()
+
+        output = status.decode('utf-8', 'replace')
+        return output != '' and check_ok(output)
+
+    @classmethod
+    def write_deferred_tags_batch(cls, media_list):
+        """Write the tags held back by several media objects.
+
+        Files which get the same tags are written together with one
+        exiftool call per batch of ``constants.exiftool_batch_size``
+        files. If exiftool reports an error for a batch then the files it
+        names as failed are marked as such and the others are left alone.
+        If it can't tell which files failed, or the batch runs out of
+        time, the files are written one at a time.
+
+        :param list media_list: Media objects, with or without held back
+            tags.
+        :returns: list of bool, or None for the objects which had nothing
+            to write, in the same order as `media_list`.
+        """
+        statuses = [None] * len(media_list)
+        groups = {}
+        for index, media in enumerate(media_list):
+            tags = getattr(media, 'deferred_tags', None)
+            if not tags:
+                continue
+            key = tuple(sorted(tags.items()))
+            groups.setdefault(key, []).append(index)
+
+        cache = localstorage.get_metadata_cache()
+        batch_size = constants.exiftool_batch_size
+        for indexes in groups.values():
+            tags = media_list[indexes[0]].deferred_tags
+            for start in range(0, len(indexes), batch_size):
+                batch = indexes[start:start + batch_size]
+                sources = [media_list[index].source for index in batch]
+                batch_statuses = cls.__set_tags_batch(tags, sources)
+                for index, source, status in zip(batch, sources, batch_statuses):
+                    if status is None:
+                        status = cls.__set_tags_one(tags, source)
+                    statuses[index] = status
+
+        for index, media in enumerate(media_list):
+            if statuses[index] is None:
+                continue
+            media.deferred_tags = None
+            media.pop_prefetched_exiftool_attributes()
+            if cache is not None:
+                cache.remove(media.source)
+            media.reset_cache()
+
+        return statuses
+
+    @staticmethod
+    def __set_tags_batch(tags, sources):
+        """Write `tags` to `sources` with one exiftool call.
+
+        The exiftool deadline is stretched to cover every file of the batch.
+
+        :returns: list of bool for each file, None where it's not known if
+            the file was written.
+        """
+        exiftool = ExifTool()
+        timeout = exiftool.timeout
+        descriptor, error_file = tempfile.mkstemp(prefix='elodie-', suffix='.efile')
+        os.close(descriptor)
+        try:
+            if timeout is not None:
+                exiftool.timeout = timeout * len(sources)
+            status = exiftool.set_tags_batch(tags, sources, error_file=error_file)
+            with open(error_file, 'rb') as f:
+                failed = set(f.read().decode('utf-8', 'replace').splitlines())
+        except ExifToolTimeout as e:
+            log.warn('%s Writing %d files one at a time.' % (e, len(sources)))
+            return [None] * len(sources)
+        finally:
+            exiftool.timeout = timeout
+            os.remove(error_file)
+
+        if check_ok(status.decode('utf-8', 'replace')):
+            return [True] * len(sources)
+
+        failed = failed.intersection(sources)
+        if not failed:
+            return [None] * len(sources)
+        return [source not in failed for source in sources]
+
+    @staticmethod
+    def __set_tags_one(tags, source):
+        """Write `tags` to `source` on its own.
+
+        :returns: bool
+        """
+        try:
+            status = ExifTool().set_tags(tags, source)
+        except ExifToolTimeout as e:
+            log.error('%s Could not write %s.' % (e, source))
+            return False
+        return check_ok(status.decode('utf-8', 'replace'))
+
     def get_camera_make(self):
         """Get the camera make stored in EXIF.
 
@@ -209,6 +382,198 @@ class Media(Base):
 
         return exiftool_attributes[self.title_key]
 
+    def get_exiftool_tags(self):
+        """Get the exiftool tags this object reads.
+
+        The tags are collected from the attributes whose names end in
+        ``_key`` or ``_keys`` and from ``exif_map`` so a sub-class only has
+        to set them in its constructor.
+
+        :returns: list of tag names.
+        """
+        tags = set()
+        for name, value in vars(self).items():
+            if name == 'exif_map':
+                for keys in value.values():
+                    tags.update(keys)
+            elif name.endswith('_key'):
+                tags.add(value)
+            elif name.endswith('_keys'):
+                tags.update(value)
+        return sorted(tags)
+
+    @classmethod
+    def get_exiftool_speed(cls, source=None):
+        """Get the option which speeds up exiftool for a file.
+
+        :param str source: Path of the file. Defaults to the option for
+            most files of this class.
+        :returns: str or None
+        """
+        if source is None:
+            return cls.exiftool_speed
+        extension = os.path.splitext(source)[1][1:].lower()
+        return cls.exiftool_speed_by_extension.get(
+            extension,
+            cls.exiftool_speed
+        )
+
+    @classmethod
+    def get_exiftool_params(cls, source=None):
+        """Get the exiftool arguments which read only the tags this class
+        uses.
+
+        :param str source: Path of the file to read. Defaults to the
+            arguments for most files of this class.
+        :returns: list of arguments.
+        """
+        speed = cls.get_exiftool_speed(source)
+        if (cls, speed) not in __exiftool_params__:
+            params = ['-%s' % tag for tag in cls().get_exiftool_tags()]
+            if speed:
+                params.insert(0, speed)
+            __exiftool_params__[(cls, speed)] = params
+        return __exiftool_params__[(cls, speed)]
+
+    @classmethod
+    def read_exiftool_attributes(cls, sources):
+        """Read the tags this class uses from files with one exiftool call
+        for each speed option they need.
+
+        :param list sources: Fully qualified paths of files.
+        :returns: list of dicts in the format of
+            :meth:`~elodie.external.pyexiftool.ExifTool.execute_json`.
+        """
+        sources_by_speed = {}
+        for source in sources:
+            sources_by_speed.setdefault(
+                cls.get_exiftool_speed(source),
+                []
+            ).append(source)
+
+        metadata_list = []
+        for speed_sources in sources_by_speed.values():
+            params = cls.get_exiftool_params(speed_sources[0]) + speed_sources
+            metadata_list.extend(ExifTool().execute_json(*params))
+        return metadata_list
+
+    @classmethod
+    def load_exiftool_attributes(cls, sources):
+        """Get the tags this class uses for files from the metadata cache
+        and read the ones which aren't cached.
+
+        Files which haven't changed since they were last read aren't read
+        again. See :class:`~elodie.localstorage.MetadataCache`.
+
+        :param list sources: Fully qualified paths of files.
+        :returns: list of dicts in the format of
+            :meth:`~elodie.external.pyexiftool.ExifTool.execute_json`.
+        """
+        cache = localstorage.get_metadata_cache()
+        if cache is None:
+            return cls.read_exiftool_attributes(sources)
+
+        metadata_list = []
+        remaining = []
+        for source in sources:
+            params = ' '.join(cls.get_exiftool_params(source))
+            metadata = cache.get(source, params)
+            if metadata is None:
+                remaining.append(source)
+            else:
+                metadata_list.append(metadata)
+
+        if remaining:
+            read_list = cls.read_exiftool_attributes(remaining)
+            read_by_params = {}
+            for metadata in read_list:
+                params = ' '.join(
+                    cls.get_exiftool_params(metadata.get('SourceFile'))
+                )
+                read_by_params.setdefault(params, []).append(metadata)
+            for params, params_list in read_by_params.items():
+                cache.set_many(params_list, params)
+            metadata_list.extend(read_list)
+        return metadata_list
+
+    def pop_prefetched_exiftool_attributes(self):
+        """Get and forget the attributes prefetched for this file.
+
+        :returns: dict, or None if they weren't prefetched.
+        """
+        prefetched = getattr(__exiftool_prefetch__, 'attributes', {})
+        return prefetched.pop(os.path.normpath(self.source), None)
+
+    @classmethod
+    def prefetch_exiftool_attributes(cls, sources):
+        """Read the attributes of several files with one exiftool call.
+
+        Each exiftool call has a fixed overhead which dominates for small
+        files. The attributes are held until
+        :meth:`get_exiftool_attributes` is called for the file so only
+        files which weren't prefetched cost a call of their own.
+        Attributes prefetched by an earlier call from the same thread are
+        discarded. Files of each type are read with one call since each
+        type reads its own tags.
+
+        :param list sources: Fully qualified paths of files.
+        """
+        classes = {}
+        for subclass in get_all_subclasses(Media):
+            for extension in subclass.extensions:
+                classes[extension] = subclass
+
+        sources_by_class = {}
+        for source in sources:
+            extension = os.path.splitext(source)[1][1:].lower()
+            if extension in classes:
+                sources_by_class.setdefault(
+                    classes[extension],
+                    []
+                ).append(source)
+
+        __exiftool_prefetch__.attributes = {}
+        for media_class, class_sources in sources_by_class.items():
+            try:
+                metadata_list = media_class.load_exiftool_attributes(
+                    class_sources
+                )
+            except ValueError as e:
+                log.error('Could not prefetch metadata: %s' % e)
+                continue
+
+            for metadata in metadata_list:
+                if 'SourceFile' not in metadata:
+                    continue
+                __exiftool_prefetch__.attributes[
+                    os.path.normpath(metadata['SourceFile'])
+                ] = metadata
+
+    @classmethod
+    def get_prefetched_coordinates(cls):
+        """Get the coordinates of the files prefetched by this thread.
+
+        The prefetched attributes are left for the files to use.
+
+        :returns: list of (latitude, longitude) tuples for the files which
+            have both.
+        """
+        prefetched = getattr(__exiftool_prefetch__, 'attributes', {})
+        subclasses = get_all_subclasses(Media)
+        coordinates = []
+        for source, attributes in prefetched.items():
+            media = cls.get_class_by_file(source, subclasses)
+            if not media:
+                continue
+
+            media.exif_metadata = attributes
+            latitude = media.get_coordinate('latitude')
+            longitude = media.get_coordinate('longitude')
+            if latitude is not None and longitude is not None:
+                coordinates.append((latitude, longitude))
+
+        return coordinates
+
     def reset_cache(self):
         """Resets any internal cache
         """
@@ -322,7 +687,19 @@ class Media(Base):
 
         source = self.source
 
+        if self.deferred_tags is not None:
+            self.deferred_tags.update(tags)
+            return True
+
+        # Prefetched attributes are stale once the file is written.
+        self.pop_prefetched_exiftool_attributes()
+
         status = ''
         status = ExifTool().set_tags(tags,source)
 
+        # So are cached ones, even if the modification time didn't change.
+        cache = localstorage.get_metadata_cache()
+        if cache is not None:
+            cache.remove(source)
+
         return status != ''
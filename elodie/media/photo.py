@@ -14,6 +14,8 @@ import time
 from datetime import datetime
 from re import compile
 
+from elodie import constants
+from elodie import exif
 from elodie import log
 from .media import Media
 
@@ -30,6 +32,43 @@ class Photo(Media):
     #: Valid extensions for photo files.
     extensions = ('arw', 'cr2', 'dng', 'gif', 'heic', 'jpeg', 'jpg', 'nef', 'png', 'rw2')
 
+    #: Photos don't need maker notes, which are slow to decode.
+    exiftool_speed = '-fast2'
+
+    #: ``-fast2`` stops at the image data of PNG files and the media data
+    #:  of HEIC files, which metadata may come after.
+    exiftool_speed_by_extension = {'heic': '-fast', 'png': '-fast'}
+
+    @classmethod
+    def read_exiftool_attributes(cls, sources):
+        """Read the tags this class uses from photos.
+
+        JPEG and TIFF based photos are read by :func:`elodie.exif.read`
+        without starting exiftool. The rest, and any it can't decode, are
+        read with one exiftool call.
+
+        :param list sources: Fully qualified paths of files.
+        :returns: list of dicts in the format of
+            :meth:`~elodie.external.pyexiftool.ExifTool.execute_json`.
+        """
+        if not constants.native_exif:
+            return super(Photo, cls).read_exiftool_attributes(sources)
+
+        metadata_list = []
+        remaining = []
+        for source in sources:
+            metadata = exif.read(source)
+            if metadata is None:
+                remaining.append(source)
+            else:
+                metadata_list.append(metadata)
+
+        if remaining:
+            metadata_list.extend(
+                super(Photo, cls).read_exiftool_attributes(remaining)
+            )
+        return metadata_list
+
     def __init__(self, source=None):
         super(Photo, self).__init__(source)
 
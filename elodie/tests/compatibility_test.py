@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+# Project imports
+import hashlib
+import mock
+import os
+import shutil
+import stat
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
+
+from . import helper
+from elodie import compatibility
+
+os.environ['TZ'] = 'GMT'
+
+def test_copyfile_returns_checksum():
+    temporary_folder, folder = helper.create_working_folder()
+
+    src = helper.get_file('plain.jpg')
+    dst = os.path.join(folder, 'plain.jpg')
+    checksum = compatibility._copyfile(src, dst)
+
+    with open(src, 'rb') as f:
+        src_contents = f.read()
+    with open(dst, 'rb') as f:
+        dst_contents = f.read()
+
+    shutil.rmtree(folder)
+
+    assert checksum == hashlib.sha256(src_contents).hexdigest(), checksum
+    assert dst_contents == src_contents
+
+def test_copyfile_larger_than_buffer():
+    temporary_folder, folder = helper.create_working_folder()
+
+    src = os.path.join(folder, 'src.bin')
+    dst = os.path.join(folder, 'dst.bin')
+    contents = os.urandom(compatibility.COPY_BUFFER_SIZE * 2 + 123)
+    with open(src, 'wb') as f:
+        f.write(contents)
+
+    checksum = compatibility._copyfile(src, dst)
+    # The buffer is reused by the next copy.
+    checksum_again = compatibility._copyfile(src, dst)
+
+    with open(dst, 'rb') as f:
+        dst_contents = f.read()
+
+    shutil.rmtree(folder)
+
+    assert checksum == hashlib.sha256(contents).hexdigest(), checksum
+    assert checksum_again == checksum, checksum_again
+    assert dst_contents == contents
+
+def test_copyfile_empty_file_keeps_mode():
+    temporary_folder, folder = helper.create_working_folder()
+
+    src = os.path.join(folder, 'src.txt')
+    dst = os.path.join(folder, 'dst.txt')
+    open(src, 'wb').close()
+    os.chmod(src, 0o640)
+
+    checksum = compatibility._copyfile(src, dst)
+    mode = stat.S_IMODE(os.stat(dst).st_mode)
+
+    shutil.rmtree(folder)
+
+    assert checksum == hashlib.sha256(b'').hexdigest(), checksum
+    assert mode == 0o640, oct(mode)
+
+def write_rename_files(folder):
+    src = os.path.join(folder, 'src.json')
+    dst = os.path.join(folder, 'dst.json')
+    with open(src, 'w') as f:
+        f.write('new')
+    with open(dst, 'w') as f:
+        f.write('old')
+    return src, dst
+
+def test_rename_replaces_destination():
+    temporary_folder, folder = helper.create_working_folder()
+    src, dst = write_rename_files(folder)
+
+    compatibility._rename(src, dst)
+
+    with open(dst, 'r') as f:
+        contents = f.read()
+    src_exists = os.path.exists(src)
+    shutil.rmtree(folder)
+
+    assert contents == 'new', contents
+    assert src_exists == False
+
+@mock.patch('elodie.constants.python_version', 2)
+@mock.patch('elodie.compatibility.os.name', 'nt')
+@mock.patch('elodie.compatibility.os.rename')
+def test_rename_removes_destination_on_windows_with_python2(mock_rename):
+    temporary_folder, folder = helper.create_working_folder()
+    src, dst = write_rename_files(folder)
+
+    compatibility._rename(src, dst)
+
+    dst_exists = os.path.exists(dst)
+    shutil.rmtree(folder)
+
+    assert dst_exists == False
+    mock_rename.assert_called_once_with(src, dst)
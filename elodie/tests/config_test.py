@@ -12,7 +12,7 @@ from tempfile import gettempdir
 sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
 
 from elodie import constants
-from elodie.config import load_config, mock_config_ini
+from elodie.config import config_stat_key, load_config, mock_config_ini
 
 @patch('elodie.config.config_file', '%s/config.ini-singleton-success' % gettempdir())
 def test_load_config_singleton_success():
@@ -48,6 +48,52 @@ def test_load_config_singleton_no_file():
 
     assert config == {}, config
 
+@patch('elodie.config.config_file', '%s/config.ini-reload-on-change' % gettempdir())
+def test_load_config_reloads_when_file_changes():
+    with open('%s/config.ini-reload-on-change' % gettempdir(), 'w') as f:
+        f.write("""
+[MapQuest]
+key=first-key
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    first = load_config()
+    unchanged = load_config()
+
+    with open('%s/config.ini-reload-on-change' % gettempdir(), 'w') as f:
+        f.write("""
+[MapQuest]
+key=the-second-key
+        """)
+
+    second = load_config()
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    assert first is unchanged
+    assert second is not first
+    assert second['MapQuest']['key'] == 'the-second-key', second.get('MapQuest', 'key')
+
+class StatWithoutNanoseconds(object):
+    """What os.stat() returns on Python 2."""
+    st_mtime = 1500000000.5
+    st_size = 42
+
+@patch('elodie.config.config_file', '%s/config.ini-stat-key' % gettempdir())
+@patch('elodie.config.os.stat')
+def test_config_stat_key_without_st_mtime_ns(mock_stat):
+    mock_stat.return_value = StatWithoutNanoseconds()
+
+    stat_key = config_stat_key()
+
+    assert stat_key == (
+        '%s/config.ini-stat-key' % gettempdir(),
+        int(1500000000.5 * 1e9),
+        42
+    ), stat_key
+
 @patch('elodie.config.config_file', '%s/config.ini-load-plugin-config-unset-backwards-compat' % gettempdir())
 def test_load_plugin_config_unset_backwards_compat():
     with open('%s/config.ini-load-plugin-config-unset-backwards-compat' % gettempdir(), 'w') as f:
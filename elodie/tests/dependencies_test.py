@@ -1,6 +1,9 @@
 import mock
 
-from elodie.dependencies import get_exiftool
+from tempfile import gettempdir
+
+from elodie.config import load_config
+from elodie.dependencies import get_exiftool, get_exiftool_timeout
 
 
 @mock.patch('elodie.dependencies.find_executable')
@@ -16,3 +19,18 @@ def test_exiftool(mock_os, mock_find_executable):
 
     mock_os.path.isfile.return_value = False
     assert get_exiftool() is None
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-exiftool-timeout' % gettempdir())
+def test_exiftool_timeout():
+    timeouts = []
+    for contents in ('', '[ExifTool]\ntimeout=5', '[ExifTool]\ntimeout=0', '[ExifTool]\ntimeout=soon'):
+        with open('%s/config.ini-exiftool-timeout' % gettempdir(), 'w') as f:
+            f.write(contents)
+        if hasattr(load_config, 'config'):
+            del load_config.config
+        timeouts.append(get_exiftool_timeout())
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    assert timeouts == [60, 5.0, None, 60], timeouts
@@ -4,6 +4,7 @@ import mock
 import os
 import sys
 import time
+from tempfile import gettempdir
 
 from nose.plugins.attrib import attr
 
@@ -11,7 +12,7 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirna
 
 import elodie.destination_folder
 
-from elodie.destination_path_config import Destination_path_pattern, Destination_actual_path
+from elodie.destination_path_config import Destination_path_pattern, Destination_actual_path, load_full_path
 
 config_string1 = """
 [MapQuest]
@@ -263,3 +264,57 @@ full_path = ${location1}/${year}/${month} | ${location2}/${year}/${month} | ${lo
     config = Destination_path_pattern()
     full_path = __do_test(config_str, metadata)
     assert full_path == 'UNKNOWN LOCATION/2017/December', '"%s"' % full_path
+
+@attr('NewPathTest')
+def test_load_full_path_reloads_when_file_changes():
+    config_ini = '%s/config.ini-full-path-reload' % gettempdir()
+    with open(config_ini, 'w') as f:
+        f.write("""
+[Folder]
+year = %Y
+full_path = ${year}
+""")
+
+    compiled = load_full_path(config_ini)
+    unchanged = load_full_path(config_ini)
+
+    with open(config_ini, 'w') as f:
+        f.write("""
+[Folder]
+month = %B
+year = %Y
+full_path = %country/${year}/${month}
+""")
+
+    changed = load_full_path(config_ini)
+
+    assert compiled is unchanged
+    assert compiled.render(metadata) == '2017', compiled.render(metadata)
+    assert changed.render(metadata) == 'UK/2017/December', changed.render(metadata)
+
+@attr('NewPathTest')
+def test_load_full_path_without_full_path():
+    config_ini = '%s/config.ini-full-path-missing' % gettempdir()
+    with open(config_ini, 'w') as f:
+        f.write("""
+[Directory]
+full_path = %date
+""")
+
+    assert load_full_path(config_ini) is None
+
+@attr('NewPathTest')
+@mock.patch('elodie.destination_folder.config_file', '%s/config.ini-full-path-folder' % gettempdir())
+def test_get_folder_path_uses_full_path():
+    with open('%s/config.ini-full-path-folder' % gettempdir(), 'w') as f:
+        f.write("""
+[Folder]
+month = %B
+year = %Y
+full_path = %village/${year} | %county/${year}/${month}
+""")
+
+    destination_folder = elodie.destination_folder.DestinationFolder()
+    path = destination_folder.get_folder_path(metadata)
+
+    assert path == 'Cumbria/2017/December', path
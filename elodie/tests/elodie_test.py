@@ -4,6 +4,7 @@ import mock
 import os
 import sys
 import shutil
+import sqlite3
 
 from nose.plugins.attrib import attr
 
@@ -19,7 +20,9 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirna
 import helper
 elodie = load_source('elodie', os.path.abspath('{}/../../elodie.py'.format(os.path.dirname(os.path.realpath(__file__)))))
 
+from elodie import constants
 from elodie.config import load_config
+from elodie.external.pyexiftool import ExifToolTimeout
 from elodie.localstorage import Db
 from elodie.media.audio import Audio
 from elodie.media.photo import Photo
@@ -95,6 +98,81 @@ def test_import_file_video():
 
     assert helper.path_tz_fix(os.path.join('2015-01-Jan','California','2015-01-19_12-45-11-video.mov')) in dest_path, dest_path
 
+@mock.patch('elodie.media.media.ExifTool.execute_json')
+def test_import_file_exiftool_timeout(mock_execute_json):
+    mock_execute_json.side_effect = ExifToolTimeout('exiftool took longer than 60 seconds.')
+    temporary_folder, folder = helper.create_working_folder()
+    temporary_folder_destination, folder_destination = helper.create_working_folder()
+
+    origin = '%s/video.mov' % folder
+    shutil.copyfile(helper.get_file('video.mov'), origin)
+
+    helper.reset_dbs()
+    dest_path = elodie.import_file(origin, folder_destination, False, False, False)
+    helper.restore_dbs()
+
+    shutil.rmtree(folder)
+    shutil.rmtree(folder_destination)
+
+    assert mock_execute_json.called
+    assert dest_path is None, dest_path
+
+@mock.patch('elodie.media.media.ExifTool.execute_json')
+def test_import_file_album_from_folder_exiftool_timeout(mock_execute_json):
+    mock_execute_json.side_effect = ExifToolTimeout('exiftool took longer than 60 seconds.')
+    temporary_folder, folder = helper.create_working_folder()
+    temporary_folder_destination, folder_destination = helper.create_working_folder()
+
+    origin = '%s/video.mov' % folder
+    shutil.copyfile(helper.get_file('video.mov'), origin)
+
+    helper.reset_dbs()
+    dest_path = elodie.import_file(origin, folder_destination, True, False, False)
+    helper.restore_dbs()
+
+    shutil.rmtree(folder)
+    shutil.rmtree(folder_destination)
+
+    assert mock_execute_json.called
+    assert dest_path is None, dest_path
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-import-write-to-destination' % gettempdir())
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+def test_import_file_album_from_folder_writes_destination_only(mock_set_tags):
+    with open('%s/config.ini-import-write-to-destination' % gettempdir(), 'w') as f:
+        f.write("""
+[ExifTool]
+write_to=destination
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    mock_set_tags.return_value = b'    1 image files updated\n'
+    temporary_folder, folder = helper.create_working_folder()
+    temporary_folder_destination, folder_destination = helper.create_working_folder()
+
+    origin = '%s/Holiday/plain.jpg' % folder
+    os.makedirs(os.path.dirname(origin))
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+    origin_checksum = helper.checksum(origin)
+
+    dest_path = elodie.import_file(origin, folder_destination, True, False, True)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    origin_checksum_after = helper.checksum(origin)
+
+    shutil.rmtree(folder)
+    shutil.rmtree(folder_destination)
+
+    assert origin_checksum == origin_checksum_after
+    assert mock_set_tags.call_count == 1, mock_set_tags.call_args_list
+    tags, path = mock_set_tags.call_args[0]
+    assert path == dest_path, (path, dest_path)
+    assert tags['XMP-xmpDM:Album'] == 'Holiday', tags
+    assert tags['XMP:OriginalFileName'] == 'plain.jpg', tags
+
 def test_import_file_path_utf8_encoded_ascii_checkmark():
     temporary_folder, folder = helper.create_working_folder()
     temporary_folder_destination, folder_destination = helper.create_working_folder()
@@ -293,6 +371,27 @@ def test_import_invalid_file_exit_code():
 
     assert result.exit_code == 1, result.exit_code
 
+def test_import_with_workers_matches_sequential():
+    temporary_folder, folder = helper.create_working_folder()
+    temporary_folder_destination, folder_destination = helper.create_working_folder()
+
+    # Two identical files so the second is a duplicate either way.
+    shutil.copyfile(helper.get_file('valid.txt'), '%s/valid.txt' % folder)
+    shutil.copyfile(helper.get_file('valid.txt'), '%s/valid-copy.txt' % folder)
+    shutil.copyfile(helper.get_file('plain.jpg'), '%s/plain.jpg' % folder)
+    shutil.copyfile(helper.get_file('with-title.jpg'), '%s/with-title.jpg' % folder)
+
+    helper.reset_dbs()
+    runner = CliRunner()
+    result = runner.invoke(elodie._import, ['--destination', folder_destination, '--workers', '3', folder])
+    helper.restore_dbs()
+
+    shutil.rmtree(folder)
+    shutil.rmtree(folder_destination)
+
+    assert 'Success         3' in result.output, result.output
+    assert 'Error           1' in result.output, result.output
+
 def test_import_file_with_single_exclude():
     temporary_folder, folder = helper.create_working_folder()
     temporary_folder_destination, folder_destination = helper.create_working_folder()
@@ -636,6 +735,102 @@ def test_update_with_directory_passed_in():
 
     assert updated_file_exists, updated_file_path
 
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+@mock.patch('elodie.media.media.ExifTool.set_tags_batch')
+def test_update_writes_all_tags_at_once(mock_set_tags_batch, mock_set_tags):
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = '%s/2015-12-Dec/Unknown Location/plain.jpg' % folder
+    os.makedirs(os.path.dirname(origin))
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+    mock_set_tags_batch.return_value = b'    1 image files updated\n'
+    mock_set_tags.return_value = b'    1 image files updated\n'
+
+    runner = CliRunner()
+    result = runner.invoke(elodie._update, ['--album', 'Album', '--title', 'Title', '--time', '2000-01-01', origin])
+
+    shutil.rmtree(folder)
+
+    assert result.exit_code == 0, result.output
+    assert mock_set_tags_batch.call_count == 1, mock_set_tags_batch.call_args_list
+    tags, paths = mock_set_tags_batch.call_args[0]
+    assert paths == [origin], paths
+    assert tags['XMP-xmpDM:Album'] == 'Album', tags
+    assert tags['XMP:Title'] == 'Title', tags
+    assert tags['EXIF:DateTimeOriginal'] == '2000:01:01 00:00:00', tags
+
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+@mock.patch('elodie.media.media.ExifTool.set_tags_batch')
+def test_update_writes_files_with_the_same_tags_together(mock_set_tags_batch, mock_set_tags):
+    temporary_folder, folder = helper.create_working_folder()
+
+    origins = []
+    for name in ('first.jpg', 'second.jpg', 'third.jpg'):
+        origin = '%s/2015-12-Dec/Unknown Location/%s' % (folder, name)
+        if not os.path.isdir(os.path.dirname(origin)):
+            os.makedirs(os.path.dirname(origin))
+        shutil.copyfile(helper.get_file('plain.jpg'), origin)
+        origins.append(origin)
+    mock_set_tags_batch.return_value = b'    3 image files updated\n'
+    mock_set_tags.return_value = b'    1 image files updated\n'
+
+    runner = CliRunner()
+    result = runner.invoke(elodie._update, ['--album', 'Album'] + origins)
+    left_behind = [origin for origin in origins if os.path.isfile(origin)]
+
+    shutil.rmtree(folder)
+
+    assert result.exit_code == 0, result.output
+    assert mock_set_tags_batch.call_count == 1, mock_set_tags_batch.call_args_list
+    tags, paths = mock_set_tags_batch.call_args[0]
+    assert sorted(paths) == sorted(origins), paths
+    assert tags == {'XMP-xmpDM:Album': 'Album'}, tags
+    assert left_behind == [], left_behind
+    assert 'Success         3' in result.output, result.output
+
+@mock.patch('elodie.media.media.ExifTool.execute_json')
+def test_update_exiftool_timeout(mock_execute_json):
+    mock_execute_json.side_effect = ExifToolTimeout('exiftool took longer than 60 seconds.')
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = '%s/2015-12-Dec/Unknown Location/plain.jpg' % folder
+    os.makedirs(os.path.dirname(origin))
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+
+    runner = CliRunner()
+    result = runner.invoke(elodie._update, ['--title', 'Title', origin])
+    origin_exists = os.path.isfile(origin)
+
+    shutil.rmtree(folder)
+
+    assert origin_exists
+    assert not isinstance(result.exception, ExifToolTimeout), result.exception
+    assert 'Error           1' in result.output, result.output
+    assert result.exit_code == 1, result.exit_code
+
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+@mock.patch('elodie.media.media.ExifTool.set_tags_batch')
+def test_update_reports_failed_write(mock_set_tags_batch, mock_set_tags):
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = '%s/2015-12-Dec/Unknown Location/plain.jpg' % folder
+    os.makedirs(os.path.dirname(origin))
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+    error = b"    0 image files updated\n    1 files weren't updated due to errors\n"
+    mock_set_tags_batch.return_value = error
+    mock_set_tags.return_value = error
+
+    runner = CliRunner()
+    result = runner.invoke(elodie._update, ['--album', 'Album', origin])
+    origin_exists = os.path.isfile(origin)
+
+    shutil.rmtree(folder)
+
+    assert mock_set_tags_batch.call_count == 1, mock_set_tags_batch.call_args_list
+    assert origin_exists
+    assert 'Failed to update' in result.output, result.output
+    assert result.exit_code == 1, result.exit_code
+
 @attr('tbd')  # test currently broken tjw
 def test_update_invalid_file_exit_code():
     temporary_folder, folder = helper.create_working_folder()
@@ -681,6 +876,26 @@ def test_regenerate_valid_source():
     assert result.exit_code == 0, result.exit_code
     assert '3c19a5d751cf19e093b7447297731124d9cc987d3f91a9d1872c3b1c1b15639a' in db.hash_db, db.hash_db
 
+def test_regenerate_valid_source_with_jobs():
+    temporary_folder, folder = helper.create_working_folder()
+
+    for name in ('valid.txt', 'plain.jpg', 'with-title.jpg', 'audio.m4a'):
+        shutil.copyfile(helper.get_file(name), '%s/%s' % (folder, name))
+
+    runner = CliRunner()
+    result_sequential = runner.invoke(elodie._generate_db, ['--source', folder])
+    hash_db_sequential = dict(Db().all())
+    result_parallel = runner.invoke(elodie._generate_db, ['--source', folder, '--jobs', '3', '--rehash'])
+    hash_db_parallel = dict(Db().all())
+
+    shutil.rmtree(folder)
+
+    assert result_sequential.exit_code == 0, result_sequential.output
+    assert result_parallel.exit_code == 0, result_parallel.output
+    assert result_parallel.output == result_sequential.output, result_parallel.output
+    assert len(hash_db_parallel) == 4, hash_db_parallel
+    assert hash_db_parallel == hash_db_sequential, hash_db_parallel
+
 @attr('tbd')  # test currently broken tjw
 def test_regenerate_valid_source_with_invalid_files():
     temporary_folder, folder = helper.create_working_folder()
@@ -719,6 +934,70 @@ def test_verify_ok():
     assert 'Success         1' in result.output, result.output
     assert 'Error           0' in result.output, result.output
 
+def test_verify_with_jobs():
+    temporary_folder, folder = helper.create_working_folder()
+
+    for name in ('valid.txt', 'plain.jpg', 'with-title.jpg', 'audio.m4a'):
+        shutil.copyfile(helper.get_file(name), '%s/%s' % (folder, name))
+
+    runner = CliRunner()
+    runner.invoke(elodie._generate_db, ['--source', folder])
+    with open('%s/valid.txt' % folder, 'a') as f:
+        f.write('changed text')
+    result = runner.invoke(elodie._verify, ['--jobs', '2'])
+
+    shutil.rmtree(folder)
+
+    assert 'Success         3' in result.output, result.output
+    assert 'Error           1' in result.output, result.output
+
+def test_verify_since_last_skips_unchanged_files():
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = '%s/valid.txt' % folder
+    shutil.copyfile(helper.get_file('valid.txt'), origin)
+
+    runner = CliRunner()
+    runner.invoke(elodie._generate_db, ['--source', folder])
+    runner.invoke(elodie._verify)
+
+    # Change the contents without changing the size or modification time
+    #  which only a full verify catches.
+    stat = os.stat(origin)
+    with open(origin, 'r+') as f:
+        f.write('x')
+    os.utime(origin, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    result_since_last = runner.invoke(elodie._verify, ['--since-last'])
+    result_full = runner.invoke(elodie._verify)
+
+    shutil.rmtree(folder)
+
+    assert 'Error           0' in result_since_last.output, result_since_last.output
+    assert 'Error           1' in result_full.output, result_full.output
+
+def test_verify_sample_rotates():
+    temporary_folder, folder = helper.create_working_folder()
+
+    for name in ('valid.txt', 'plain.jpg', 'with-title.jpg', 'audio.m4a'):
+        shutil.copyfile(helper.get_file(name), '%s/%s' % (folder, name))
+
+    runner = CliRunner()
+    runner.invoke(elodie._generate_db, ['--source', folder])
+    if os.path.isfile(constants.verify_db):
+        os.remove(constants.verify_db)
+
+    result_first = runner.invoke(elodie._verify, ['--sample', '50'])
+    result_second = runner.invoke(elodie._verify, ['--sample', '50'])
+    connection = sqlite3.connect(constants.verify_db)
+    verified = connection.execute('SELECT COUNT(*) FROM verified').fetchone()[0]
+    connection.close()
+
+    shutil.rmtree(folder)
+
+    assert 'Success         2' in result_first.output, result_first.output
+    assert 'Success         2' in result_second.output, result_second.output
+    assert verified == 4, verified
+
 @attr('tbd')  # test currently broken tjw
 def test_verify_error():
     temporary_folder, folder = helper.create_working_folder()
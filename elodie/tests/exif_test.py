@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+# Project imports
+import mock
+import os
+import struct
+import sys
+from tempfile import gettempdir
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
+
+from . import helper
+from elodie import exif
+from elodie.media.photo import Photo
+
+os.environ['TZ'] = 'GMT'
+
+def write_tiff(name):
+    """Write a big-endian TIFF with a camera make, GPS and an XMP packet."""
+    xmp = (
+        b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF '
+        b'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        b'<rdf:Description xmlns:elodie="https://github.com/jmathai/elodie/">'
+        b'<elodie:Album><rdf:Alt><rdf:li xml:lang="x-default">Tiff Album'
+        b'</rdf:li></rdf:Alt></elodie:Album></rdf:Description></rdf:RDF>'
+        b'</x:xmpmeta>'
+    )
+    make = b'Nikon\0'
+    ifd0_offset = 8
+    gps_offset = ifd0_offset + 2 + 3 * 12 + 4
+    data_offset = gps_offset + 2 + 2 * 12 + 4
+    entries = struct.pack('>H', 3)
+    entries += struct.pack('>HHII', 0x010F, 2, len(make), data_offset)
+    entries += struct.pack('>HHII', 0x02BC, 7, len(xmp), data_offset + len(make))
+    entries += struct.pack('>HHII', 0x8825, 4, 1, gps_offset)
+    entries += struct.pack('>I', 0)
+    degrees_offset = data_offset + len(make) + len(xmp)
+    gps = struct.pack('>H', 2)
+    gps += struct.pack('>HHI', 0x0001, 2, 2) + b'S\0\0\0'
+    gps += struct.pack('>HHII', 0x0002, 5, 3, degrees_offset)
+    gps += struct.pack('>I', 0)
+    degrees = struct.pack('>IIIIII', 18, 1, 8, 1, 30, 1)
+
+    path = '%s/%s' % (gettempdir(), name)
+    with open(path, 'wb') as f:
+        f.write(b'MM\0*' + struct.pack('>I', ifd0_offset))
+        f.write(entries + gps + make + xmp + degrees)
+    return path
+
+def test_read_jpeg_with_location():
+    metadata = exif.read(helper.get_file('with-location.jpg'))
+
+    assert metadata['SourceFile'] == helper.get_file('with-location.jpg'), metadata
+    assert metadata['EXIF:Make'] == 'Canon', metadata
+    assert metadata['EXIF:Model'] == 'Canon EOS REBEL T2i', metadata
+    assert metadata['EXIF:DateTimeOriginal'] == '2015:12:05 00:59:26', metadata
+    assert metadata['EXIF:CreateDate'] == '2015:12:05 00:59:26', metadata
+    assert metadata['EXIF:GPSLatitudeRef'] == 'N', metadata
+    assert metadata['EXIF:GPSLongitudeRef'] == 'W', metadata
+    assert helper.isclose(metadata['EXIF:GPSLatitude'], 37.3667027222222), metadata
+    assert helper.isclose(metadata['EXIF:GPSLongitude'], 122.033383611111), metadata
+
+def test_read_jpeg_with_xmp_attributes():
+    metadata = exif.read(helper.get_file('with-album-and-title-and-location.jpg'))
+
+    assert metadata['XMP:Album'] == 'Test Album', metadata
+    assert metadata['XMP:Title'] == 'Some Title', metadata
+
+def test_read_jpeg_with_xmp_elements():
+    metadata = exif.read(helper.get_file('with-filename-and-title-in-exif.jpg'))
+
+    assert metadata['XMP:OriginalFileName'] == 'foobar.jpg', metadata
+    assert metadata['XMP:Title'] == 'Foobar Title', metadata
+
+def test_read_jpeg_without_exif():
+    metadata = exif.read(helper.get_file('no-exif.jpg'))
+
+    assert metadata == {'SourceFile': helper.get_file('no-exif.jpg')}, metadata
+
+def test_read_tiff():
+    metadata = exif.read(write_tiff('exif-test.tiff'))
+
+    assert metadata['EXIF:Make'] == 'Nikon', metadata
+    assert metadata['EXIF:GPSLatitudeRef'] == 'S', metadata
+    assert helper.isclose(metadata['EXIF:GPSLatitude'], 18.1416666666667), metadata
+    assert metadata['XMP:Album'] == 'Tiff Album', metadata
+
+def test_read_leaves_other_files_to_exiftool():
+    for name in ('photo.png', 'photo.heic', 'invalid.jpg', 'with-null-coordinates.jpg'):
+        metadata = exif.read(helper.get_file(name))
+        assert metadata is None, (name, metadata)
+
+    assert exif.read('%s/does-not-exist.jpg' % gettempdir()) is None
+
+@mock.patch('elodie.media.media.ExifTool.execute_json')
+def test_photo_reads_with_exiftool_as_fallback(mock_execute_json):
+    mock_execute_json.return_value = [{'SourceFile': helper.get_file('photo.png')}]
+
+    metadata_list = Photo.read_exiftool_attributes([
+        helper.get_file('with-location.jpg'),
+        helper.get_file('photo.png'),
+    ])
+
+    sources = [metadata['SourceFile'] for metadata in metadata_list]
+    assert sources == [helper.get_file('with-location.jpg'), helper.get_file('photo.png')], sources
+    assert mock_execute_json.call_count == 1, mock_execute_json.call_count
+    assert mock_execute_json.call_args[0][-1] == helper.get_file('photo.png'), mock_execute_json.call_args
+
+@mock.patch('elodie.constants.native_exif', False)
+@mock.patch('elodie.media.media.ExifTool.execute_json')
+def test_photo_reads_with_exiftool_when_disabled(mock_execute_json):
+    mock_execute_json.return_value = []
+
+    Photo.read_exiftool_attributes([helper.get_file('with-location.jpg')])
+
+    assert mock_execute_json.call_args[0][-1] == helper.get_file('with-location.jpg'), mock_execute_json.call_args
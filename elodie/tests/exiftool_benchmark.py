@@ -0,0 +1,61 @@
+"""
+Measure how fast output is read from an ``exiftool -stay_open`` process.
+
+A stand-in for exiftool answers every request with JSON of the given size so
+only the reading and decoding in
+:meth:`~elodie.external.pyexiftool.ExifTool.execute_json` is measured.
+
+Run it from the root of the repository::
+
+    python -m elodie.tests.exiftool_benchmark
+"""
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
+
+from elodie.external.pyexiftool import ExifTool
+from elodie.tests import helper
+
+#: Response sizes in bytes and how many times each is requested.
+SIZES = [
+    ('1 KB', 1024, 2000),
+    ('1 MB', 1024 * 1024, 50),
+    ('50 MB', 50 * 1024 * 1024, 3),
+]
+
+
+def run():
+    exiftool = ExifTool.new_instance(executable_=helper.get_stand_in_exiftool())
+    exiftool.start()
+
+    rows = []
+    try:
+        for label, size, repeat in SIZES:
+            param = 'size=%d' % size
+            # Let the stand-in warm up before measuring.
+            exiftool.execute_json(param)
+            start = time.time()
+            for _ in range(repeat):
+                exiftool.execute_json(param)
+            elapsed = time.time() - start
+            rows.append([
+                label,
+                repeat,
+                '%.3f' % (elapsed / repeat * 1000),
+                '%.1f' % (size * repeat / elapsed / 1024 / 1024),
+            ])
+    finally:
+        exiftool.terminate()
+
+    print(tabulate(rows, headers=['Response', 'Requests', 'ms/request', 'MB/s']))
+
+
+if __name__ == '__main__':
+    run()
@@ -14,12 +14,13 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirna
 from . import helper
 from elodie.config import load_config
 from elodie.filesystem import FileSystem
+from elodie.localstorage import Db
 from elodie.media.text import Text
 from elodie.media.media import Media
 from elodie.media.photo import Photo
 from elodie.media.video import Video
 from nose.plugins.skip import SkipTest
-from elodie.external.pyexiftool import ExifTool
+from elodie.external.pyexiftool import ExifTool, ExifToolTimeout
 from elodie.dependencies import get_exiftool
 from elodie import constants
 
@@ -310,6 +311,48 @@ name=%date-%original_name-%title.%extension
 
     assert file_name == helper.path_tz_fix('2015-12-05-plain.jpg'), file_name
 
+@mock.patch('elodie.config.config_file', '%s/config.ini-filename-reload' % gettempdir())
+def test_get_file_name_reloads_when_config_changes():
+    with open('%s/config.ini-filename-reload' % gettempdir(), 'w') as f:
+        f.write("""
+[File]
+date=%Y-%m-%d
+name=%date-%original_name.%extension
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    filesystem = FileSystem()
+    metadata = {
+        'date_taken': time.strptime('2015-12-05 00:59:26', '%Y-%m-%d %H:%M:%S'),
+        'original_name': None,
+        'base_name': 'plain',
+        'extension': 'jpg',
+        'title': None,
+        'album': None,
+    }
+    file_name = filesystem.get_file_name(metadata)
+    plan = filesystem.get_file_name_plan()
+    file_name_unchanged = filesystem.get_file_name(metadata)
+
+    with open('%s/config.ini-filename-reload' % gettempdir(), 'w') as f:
+        f.write("""
+[File]
+date=%Y
+name=%date-%original_name.%extension
+capitalization=upper
+        """)
+
+    file_name_changed = filesystem.get_file_name(metadata)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    assert file_name == '2015-12-05-plain.jpg', file_name
+    assert file_name_unchanged == file_name, file_name_unchanged
+    assert filesystem.get_file_name_plan() is not plan
+    assert file_name_changed == '2015-PLAIN.JPG', file_name_changed
+
 @mock.patch('elodie.config.config_file', '%s/config.ini-filename-custom-with-lowercase' % gettempdir())
 def test_get_file_name_custom_with_lower_capitalization():
     with open('%s/config.ini-filename-custom-with-lowercase' % gettempdir(), 'w') as f:
@@ -729,6 +772,194 @@ def test_process_file_plain():
     assert origin_checksum_preprocess == origin_checksum
     assert helper.path_tz_fix(os.path.join('2015-12-Dec','Unknown Location','2015-12-05_00-59-26-photo.jpg')) in destination, destination
 
+def test_process_file_caches_destination_checksum():
+    filesystem = FileSystem()
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = os.path.join(folder,'photo.jpg')
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+
+    media = Photo(origin)
+    destination = filesystem.process_file(origin, temporary_folder, media, allowDuplicate=True)
+
+    cached_checksum = Db().get_checksum_cache().get(destination)
+    destination_checksum = helper.checksum(destination)
+
+    shutil.rmtree(folder)
+    shutil.rmtree(os.path.dirname(os.path.dirname(destination)))
+
+    assert cached_checksum is not None
+    assert cached_checksum == destination_checksum, cached_checksum
+
+def test_process_checksum_defers_when_not_a_duplicate():
+    filesystem = FileSystem()
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = os.path.join(folder,'file.txt')
+    with open(origin, 'w') as f:
+        f.write(helper.random_string(100))
+
+    db = Db()
+    db.reset_hash_db()
+    db.update_hash_db()
+
+    claim = filesystem.process_checksum(origin, False, defer=True)
+    filesystem.release_checksum(claim[1])
+    claim_not_deferred = filesystem.process_checksum(origin, False)
+    filesystem.release_checksum(claim_not_deferred[1])
+    origin_checksum = helper.checksum(origin)
+
+    shutil.rmtree(folder)
+
+    assert claim[0] is None, claim
+    assert claim_not_deferred[0] == origin_checksum, claim_not_deferred
+
+def test_process_file_deferred_checksum_detects_duplicate():
+    filesystem = FileSystem()
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = os.path.join(folder,'photo.jpg')
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+    media = Photo(origin)
+    media.set_original_name()
+    origin_checksum = helper.checksum(origin)
+
+    media = Photo(origin)
+    destination = filesystem.process_file(origin, temporary_folder, media, allowDuplicate=True)
+    recorded_path = Db().get_hash(origin_checksum)
+
+    media = Photo(origin)
+    destination_duplicate = filesystem.process_file(origin, temporary_folder, media)
+
+    shutil.rmtree(folder)
+    shutil.rmtree(os.path.dirname(os.path.dirname(destination)))
+
+    assert recorded_path == destination, recorded_path
+    assert destination_duplicate is None, destination_duplicate
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-write-to-destination' % gettempdir())
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+def test_process_file_writes_tags_to_destination(mock_set_tags):
+    with open('%s/config.ini-write-to-destination' % gettempdir(), 'w') as f:
+        f.write("""
+[ExifTool]
+write_to=destination
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    mock_set_tags.return_value = b'    1 image files updated\n'
+    filesystem = FileSystem()
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = os.path.join(folder,'photo.jpg')
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+
+    origin_checksum_preprocess = helper.checksum(origin)
+    media = Photo(origin)
+    destination = filesystem.process_file(origin, temporary_folder, media, allowDuplicate=True)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    origin_checksum = helper.checksum(origin)
+    db = Db()
+    checksum_file = db.get_hash(origin_checksum)
+
+    shutil.rmtree(folder)
+    shutil.rmtree(os.path.dirname(os.path.dirname(destination)))
+
+    assert origin_checksum_preprocess == origin_checksum
+    assert mock_set_tags.call_count == 1, mock_set_tags.call_args_list
+    mock_set_tags.assert_called_with({'XMP:OriginalFileName': 'photo.jpg'}, destination)
+    assert checksum_file == destination, checksum_file
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-write-to-destination-error' % gettempdir())
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+def test_process_file_writing_tags_to_destination_fails(mock_set_tags):
+    with open('%s/config.ini-write-to-destination-error' % gettempdir(), 'w') as f:
+        f.write("""
+[ExifTool]
+write_to=destination
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    mock_set_tags.return_value = b"    0 image files updated\n    1 files weren't updated due to errors\n"
+    filesystem = FileSystem()
+    temporary_folder, folder = helper.create_working_folder()
+    temporary_folder_destination, folder_destination = helper.create_working_folder()
+
+    origin = os.path.join(folder,'photo.jpg')
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+    with open(origin, 'ab') as f:
+        # Make the checksum unique so no other test has seen it.
+        f.write(helper.random_string(32).encode('utf-8'))
+    origin_checksum = helper.checksum(origin)
+
+    media = Photo(origin)
+    destination = filesystem.process_file(origin, folder_destination, media, allowDuplicate=True)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    copied_files = [name for _, _, names in os.walk(folder_destination) for name in names]
+    checksum_file = Db().get_hash(origin_checksum)
+
+    shutil.rmtree(folder)
+    shutil.rmtree(folder_destination)
+
+    assert destination is None, destination
+    assert mock_set_tags.call_count == 1, mock_set_tags.call_args_list
+    assert copied_files == [], copied_files
+    assert checksum_file is None, checksum_file
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-write-to-destination-timeout' % gettempdir())
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+def test_process_file_writing_tags_to_destination_times_out(mock_set_tags):
+    with open('%s/config.ini-write-to-destination-timeout' % gettempdir(), 'w') as f:
+        f.write("""
+[ExifTool]
+write_to=destination
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    def set_tags(tags, source):
+        # exiftool is stopped while it writes its temporary file.
+        with open(source + '_exiftool_tmp', 'w') as f:
+            f.write('partial')
+        raise ExifToolTimeout('exiftool took longer than 60 seconds.')
+    mock_set_tags.side_effect = set_tags
+    filesystem = FileSystem()
+    temporary_folder, folder = helper.create_working_folder()
+    temporary_folder_destination, folder_destination = helper.create_working_folder()
+
+    origin = os.path.join(folder,'photo.jpg')
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+    with open(origin, 'ab') as f:
+        # Make the checksum unique so no other test has seen it.
+        f.write(helper.random_string(32).encode('utf-8'))
+    origin_checksum = helper.checksum(origin)
+
+    media = Photo(origin)
+    destination = filesystem.process_file(origin, folder_destination, media, allowDuplicate=True)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    copied_files = [name for _, _, names in os.walk(folder_destination) for name in names]
+    origin_exists = os.path.isfile(origin)
+    checksum_file = Db().get_hash(origin_checksum)
+
+    shutil.rmtree(folder)
+    shutil.rmtree(folder_destination)
+
+    assert destination is None, destination
+    assert copied_files == [], copied_files
+    assert origin_exists
+    assert checksum_file is None, checksum_file
+
 def test_process_file_with_title():
     filesystem = FileSystem()
     temporary_folder, folder = helper.create_working_folder()
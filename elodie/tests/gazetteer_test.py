@@ -0,0 +1,150 @@
+from __future__ import absolute_import
+# Project imports
+import os
+import sys
+from tempfile import gettempdir
+
+import mock
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
+
+from elodie.gazetteer import Gazetteer, cell_key, mtime_ns, parse_line, read_array
+
+os.environ['TZ'] = 'GMT'
+
+gazetteer_text = u"""# city\tstate\tcountry\tlatitude\tlongitude
+Sunnyvale\tCalifornia\tUnited States of America\t37.36883\t-122.03635
+Cupertino\tCalifornia\tUnited States of America\t37.32300\t-122.03218
+Carlisle\tEngland\tUnited Kingdom\t54.89510\t-2.93820
+Suva\tCentral\tFiji\t-18.14161\t178.44149
+Taveuni\tNorthern\t\t-16.85\t-179.97
+"""
+
+def write_gazetteer(name, text=gazetteer_text):
+    gazetteer_path = '%s/%s' % (gettempdir(), name)
+    with open(gazetteer_path, 'w') as f:
+        f.write(text)
+    index_path = '%s.idx' % gazetteer_path
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    return (gazetteer_path, index_path)
+
+def test_parse_line():
+    assert parse_line('# comment') is None
+    assert parse_line('') is None
+    assert parse_line('Suva\tCentral\tFiji\tnot-a-number\t178.4') is None
+    assert parse_line('Suva\tCentral\tFiji\t-18.1\t178.4') == ('Suva', 'Central', 'Fiji', -18.1, 178.4)
+
+def test_parse_line_geonames():
+    line = '\t'.join([
+        '2205218', 'Suva', 'Suva', 'Suva', '-18.14161', '178.44149', 'P',
+        'PPLC', 'FJ', '', '01', '', '', '', '93970', '', '10',
+        'Pacific/Fiji', '2019-09-05'
+    ])
+
+    assert parse_line(line) == ('Suva', '01', 'FJ', -18.14161, 178.44149), parse_line(line)
+
+def test_cell_key_wraps_longitude():
+    assert cell_key(10.5, -180.5) == cell_key(10.5, 179.5)
+    assert cell_key(90, 0) == cell_key(89.5, 0)
+
+class StatWithoutNanoseconds(object):
+    """What os.stat() returns on Python 2."""
+    st_mtime = 1500000000.5
+
+def test_mtime_ns_without_st_mtime_ns():
+    assert mtime_ns(StatWithoutNanoseconds()) == int(1500000000.5 * 1e9)
+
+def test_place_name():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-place-name.tsv')
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+
+    place_name = gazetteer.place_name(37.3667027222222, -122.033383611111)
+
+    assert place_name == {
+        'city': 'Sunnyvale',
+        'state': 'California',
+        'country': 'United States of America',
+        'default': 'Sunnyvale'
+    }, place_name
+    assert gazetteer.place_name(37.33, -122.03)['city'] == 'Cupertino'
+    assert gazetteer.place_name(54.9, -2.9)['city'] == 'Carlisle'
+
+def test_place_name_across_antimeridian():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-antimeridian.tsv')
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+
+    place_name = gazetteer.place_name(-16.9, 179.9)
+
+    assert place_name == {
+        'city': 'Taveuni',
+        'state': 'Northern',
+        'default': 'Taveuni'
+    }, place_name
+
+def test_place_name_nothing_nearby():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-nothing-nearby.tsv')
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+
+    assert gazetteer.place_name(0.5, 0.5) is None
+    assert gazetteer.place_name(123456.000, 123456.000) is None
+
+def test_place_name_too_far_away():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-too-far-away.tsv')
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+
+    # Sunnyvale is in a neighbouring cell but about 100km away.
+    assert gazetteer.place_name(38.27, -122.03) is None
+
+def test_place_name_with_max_distance():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-max-distance.tsv')
+    gazetteer = Gazetteer(gazetteer_path, index_path, max_distance=200)
+
+    assert gazetteer.place_name(38.27, -122.03)['city'] == 'Sunnyvale'
+
+    gazetteer = Gazetteer(gazetteer_path, index_path, max_distance=1)
+
+    assert gazetteer.place_name(37.345, -122.034) is None
+
+class MemoryviewWithoutCast(object):
+    pass
+
+@mock.patch('elodie.gazetteer.memoryview', MemoryviewWithoutCast, create=True)
+def test_read_array_without_memoryview_cast():
+    from array import array
+    values = array('i', [1, -2, 3])
+    buffer = b'xx' + (values.tobytes() if hasattr(values, 'tobytes') else values.tostring())
+
+    assert list(read_array(buffer, 'i', 2, 2)) == [1, -2]
+    assert list(read_array(buffer, 'i', 6, 2)) == [-2, 3]
+
+@mock.patch('elodie.gazetteer.memoryview', MemoryviewWithoutCast, create=True)
+def test_place_name_without_memoryview_cast():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-without-cast.tsv')
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+
+    assert gazetteer.place_name(37.33, -122.03)['city'] == 'Cupertino'
+    assert gazetteer.place_name(-18.1, 178.4)['city'] == 'Suva'
+
+def test_index_is_reused():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-reused.tsv')
+    Gazetteer(gazetteer_path, index_path)
+    index_mtime = os.stat(index_path).st_mtime_ns
+
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+
+    assert os.stat(index_path).st_mtime_ns == index_mtime
+    assert gazetteer.place_name(-18.1, 178.4)['city'] == 'Suva'
+
+def test_index_is_rebuilt_when_gazetteer_changes():
+    gazetteer_path, index_path = write_gazetteer('gazetteer-rebuilt.tsv')
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+    assert gazetteer.place_name(-18.1, 178.4)['city'] == 'Suva'
+
+    with open(gazetteer_path, 'w') as f:
+        f.write(u'Lami\tCentral\tFiji\t-18.11667\t178.41667\n')
+
+    gazetteer = Gazetteer(gazetteer_path, index_path)
+
+    assert gazetteer.place_name(-18.1, 178.4)['city'] == 'Lami'
+    assert gazetteer.place_name(37.36, -122.03) is None
@@ -5,18 +5,31 @@ from past.utils import old_div
 # Project imports
 import mock
 import os
+import json
 import random
 import re
+import requests
 import sys
+import threading
+import time
 from mock import patch
 from tempfile import gettempdir
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
 from nose.plugins.attrib import attr
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
 
 from . import helper
 from elodie import geolocation
+from elodie.geolocation import MapQuestClient, TokenBucket
+from elodie.config import load_config
+from elodie.localstorage import Db, flush_location_db
 
 os.environ['TZ'] = 'GMT'
 
@@ -89,6 +102,73 @@ def test_reverse_lookup_with_invalid_lat_lon():
     res = geolocation.lookup(lat=999, lon=999)
     assert res is None, res
 
+@mock.patch('elodie.config.config_file', '%s/config.ini-offline-engine' % gettempdir())
+@mock.patch('elodie.constants.location_db', '%s/location.json-offline-engine' % gettempdir())
+@mock.patch('elodie.constants.location_miss_db', '%s/location_misses.json-offline-engine' % gettempdir())
+@mock.patch('elodie.localstorage.__location_db__', None)
+@mock.patch('elodie.localstorage.__location_index__', None)
+@mock.patch('elodie.localstorage.__location_misses__', None)
+@mock.patch('elodie.localstorage.__location_miss_index__', None)
+@mock.patch('elodie.constants.gazetteer_index', '%s/gazetteer.idx-offline-engine' % gettempdir())
+@mock.patch('elodie.geolocation.__GAZETTEER__', None)
+@mock.patch('elodie.geolocation.fetch')
+def test_place_name_offline_engine(mock_fetch):
+    with open('%s/location.json-offline-engine' % gettempdir(), 'w') as f:
+        f.write('[]')
+    with open('%s/gazetteer-offline-engine.tsv' % gettempdir(), 'w') as f:
+        f.write("Carlisle\tEngland\tUnited Kingdom\t54.8951\t-2.9382\n")
+    with open('%s/config.ini-offline-engine' % gettempdir(), 'w') as f:
+        f.write("""
+[Geolocation]
+engine=offline
+gazetteer=%s/gazetteer-offline-engine.tsv
+        """ % gettempdir())
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    place_name = geolocation.place_name(54.9286804166667, -2.94800427777778)
+    no_place_name = geolocation.place_name(0.5, 0.5)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    assert mock_fetch.called is False
+    assert place_name == {
+        'city': 'Carlisle',
+        'state': 'England',
+        'country': 'United Kingdom',
+        'default': 'Carlisle'
+    }, place_name
+    assert no_place_name == {'default': 'Unknown Location'}, no_place_name
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-offline-engine-no-gazetteer' % gettempdir())
+@mock.patch('elodie.constants.location_db', '%s/location.json-offline-engine-no-gazetteer' % gettempdir())
+@mock.patch('elodie.constants.location_miss_db', '%s/location_misses.json-offline-engine-no-gazetteer' % gettempdir())
+@mock.patch('elodie.localstorage.__location_db__', None)
+@mock.patch('elodie.localstorage.__location_index__', None)
+@mock.patch('elodie.localstorage.__location_misses__', None)
+@mock.patch('elodie.localstorage.__location_miss_index__', None)
+@mock.patch('elodie.geolocation.__GAZETTEER__', None)
+@mock.patch('elodie.geolocation.fetch')
+def test_place_name_offline_engine_without_gazetteer(mock_fetch):
+    with open('%s/location.json-offline-engine-no-gazetteer' % gettempdir(), 'w') as f:
+        f.write('[]')
+    with open('%s/config.ini-offline-engine-no-gazetteer' % gettempdir(), 'w') as f:
+        f.write("""
+[Geolocation]
+engine=offline
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    place_name = geolocation.place_name(54.9286804166667, -2.94800427777778)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    assert mock_fetch.called is False
+    assert place_name == {'default': 'Unknown Location'}, place_name
+
 @mock.patch('elodie.geolocation.__KEY__', 'invalid_key')
 def test_reverse_lookup_with_invalid_key():
     res = geolocation.lookup(lat=37.368, lon=-122.03)
@@ -237,3 +317,316 @@ def test_parse_result_with_unknown_lat_lon():
 
     res = geolocation.parse_result(results)
     assert res is None, res
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """A local stand-in for MapQuest which sends the queued responses."""
+    daemon_threads = True
+
+    def __init__(self, responses):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.responses = list(responses)
+        self.requests = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path='/'):
+        return 'http://127.0.0.1:%d%s' % (self.server_address[1], path)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, self.client_address[1]))
+            if len(self.server.responses) > 1:
+                status, headers, body, delay = self.server.responses.pop(0)
+            else:
+                status, headers, body, delay = self.server.responses[0]
+
+        time.sleep(delay)
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(20, 1)
+
+    first = bucket.acquire()
+    second = bucket.acquire()
+
+    assert first == 0, first
+    assert second > 0.02, second
+
+def test_token_bucket_without_limit():
+    bucket = TokenBucket(0)
+
+    assert sum([bucket.acquire() for _ in range(100)]) == 0
+
+def test_client_reuses_connection():
+    server = StandInServer([(200, {}, {'ok': True}, 0)])
+    client = MapQuestClient(5, 0, 0)
+
+    for _ in range(3):
+        response = client.get(server.url())
+        assert response.json() == {'ok': True}, response.text
+    server.shutdown()
+
+    ports = set([port for path, port in server.requests])
+    assert len(server.requests) == 3, server.requests
+    assert len(ports) == 1, ports
+
+def test_client_retries_rate_limited_requests():
+    server = StandInServer([
+        (429, {'Retry-After': '0'}, {}, 0),
+        (503, {}, {}, 0),
+        (200, {}, {'ok': True}, 0),
+    ])
+    client = MapQuestClient(5, 3, 0, backoff=0.01)
+
+    response = client.get(server.url())
+    server.shutdown()
+
+    stats = client.get_stats()
+    assert response.status_code == 200, response.status_code
+    assert stats['requests'] == 3, stats
+    assert stats['retries'] == 2, stats
+    assert stats['failures'] == 2, stats
+    assert stats['latency'] > 0, stats
+
+def test_client_returns_error_response_when_out_of_retries():
+    server = StandInServer([(429, {}, {}, 0)])
+    client = MapQuestClient(5, 2, 0, backoff=0.01)
+
+    response = client.get(server.url())
+    server.shutdown()
+
+    assert response.status_code == 429, response.status_code
+    assert client.get_stats()['requests'] == 3, client.get_stats()
+
+def test_client_times_out():
+    server = StandInServer([(200, {}, {'ok': True}, 1)])
+    client = MapQuestClient(0.1, 1, 0, backoff=0.01)
+
+    try:
+        client.get(server.url())
+        raised = False
+    except requests.exceptions.Timeout:
+        raised = True
+    server.shutdown()
+
+    assert raised is True
+    assert client.get_stats()['requests'] == 2, client.get_stats()
+    assert client.get_stats()['failures'] == 2, client.get_stats()
+
+@mock.patch('elodie.geolocation.__KEY__', 'stand-in-key')
+@mock.patch('elodie.geolocation.__PREFER_ENGLISH_NAMES__', False)
+@mock.patch('elodie.geolocation.__CLIENT__', None)
+def test_lookup_with_stand_in_server():
+    address = {'city': 'Sunnyvale', 'state': 'California'}
+    server = StandInServer([
+        (429, {'Retry-After': '0'}, {}, 0),
+        (200, {}, {'display_name': 'Sunnyvale', 'address': address}, 0),
+    ])
+
+    with mock.patch('elodie.constants.mapquest_base_url', server.url('')):
+        res = geolocation.lookup(lat=37.368, lon=-122.03)
+    server.shutdown()
+
+    stats = geolocation.get_lookup_stats()
+    assert res['address'] == address, res
+    assert server.requests[-1][0].startswith('/nominatim/v1/reverse.php?'), server.requests
+    assert 'key=stand-in-key' in server.requests[-1][0], server.requests
+    assert stats['requests'] == 2, stats
+    assert stats['retries'] == 1, stats
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-prefetch' % gettempdir())
+@mock.patch('elodie.localstorage.__location_db__', None)
+@mock.patch('elodie.localstorage.__location_index__', None)
+@mock.patch('elodie.localstorage.__location_db_pending__', 0)
+@mock.patch('elodie.localstorage.__location_db_last_flush__', None)
+@mock.patch('elodie.geolocation.__KEY__', 'stand-in-key')
+@mock.patch('elodie.geolocation.__PREFER_ENGLISH_NAMES__', False)
+@mock.patch('elodie.geolocation.__CLIENT__', None)
+def test_prefetch_place_names():
+    with open('%s/location.json-prefetch' % gettempdir(), 'w') as f:
+        f.write('[{"lat": -33.8688, "long": 151.2093, "name": {"city": "Sydney", "default": "Sydney"}}]')
+    address = {'city': 'Sunnyvale', 'state': 'California'}
+    server = StandInServer([
+        (200, {}, {'display_name': 'Sunnyvale', 'address': address}, 0),
+    ])
+
+    with mock.patch('elodie.constants.mapquest_base_url', server.url('')):
+        lookups = geolocation.prefetch_place_names([
+            (37.3667, -122.0333),
+            (37.3700, -122.0300),
+            (37.3750, -122.0200),
+            (54.9286, -2.9480),
+            (-33.8690, 151.2090),
+        ], 2)
+        requests_after_prefetch = len(server.requests)
+        place_name = geolocation.place_name(37.3701, -122.0301)
+    server.shutdown()
+    flush_location_db()
+
+    with open('%s/location.json-prefetch' % gettempdir(), 'r') as f:
+        location_db = json.load(f)
+
+    assert lookups == 2, lookups
+    assert requests_after_prefetch == 2, server.requests
+    assert len(server.requests) == 2, server.requests
+    assert place_name['city'] == 'Sunnyvale', place_name
+    assert len(location_db) == 3, location_db
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-miss' % gettempdir())
+@mock.patch('elodie.constants.location_miss_db', '%s/location_misses.json-miss' % gettempdir())
+@mock.patch('elodie.localstorage.__location_db__', None)
+@mock.patch('elodie.localstorage.__location_index__', None)
+@mock.patch('elodie.localstorage.__location_misses__', None)
+@mock.patch('elodie.localstorage.__location_miss_index__', None)
+@mock.patch('elodie.localstorage.__location_db_pending__', 0)
+@mock.patch('elodie.localstorage.__location_db_last_flush__', None)
+@mock.patch('elodie.geolocation.__KEY__', 'stand-in-key')
+@mock.patch('elodie.geolocation.__PREFER_ENGLISH_NAMES__', False)
+@mock.patch('elodie.geolocation.__CLIENT__', None)
+def test_place_name_remembers_misses():
+    for path in ('location.json-miss', 'location_misses.json-miss'):
+        with open('%s/%s' % (gettempdir(), path), 'w') as f:
+            f.write('[]')
+    server = StandInServer([(200, {}, {'error': 'Unable to geocode'}, 0)])
+
+    with mock.patch('elodie.constants.mapquest_base_url', server.url('')):
+        first = geolocation.place_name(12.3456, -45.6789)
+        second = geolocation.place_name(12.3500, -45.6800)
+        lookups = geolocation.prefetch_place_names([(12.3400, -45.6700)])
+    server.shutdown()
+    flush_location_db()
+
+    with open('%s/location_misses.json-miss' % gettempdir(), 'r') as f:
+        location_misses = json.load(f)
+
+    assert first == {'default': 'Unknown Location'}, first
+    assert second == {'default': 'Unknown Location'}, second
+    assert lookups == 0, lookups
+    assert len(server.requests) == 1, server.requests
+    assert len(location_misses) == 1, location_misses
+    assert location_misses[0]['lat'] == 12.3456, location_misses
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-error' % gettempdir())
+@mock.patch('elodie.constants.location_miss_db', '%s/location_misses.json-error' % gettempdir())
+@mock.patch('elodie.localstorage.__location_db__', None)
+@mock.patch('elodie.localstorage.__location_index__', None)
+@mock.patch('elodie.localstorage.__location_misses__', None)
+@mock.patch('elodie.localstorage.__location_miss_index__', None)
+@mock.patch('elodie.geolocation.__KEY__', 'stand-in-key')
+@mock.patch('elodie.geolocation.__CLIENT__', None)
+@mock.patch('elodie.geolocation.fetch')
+def test_place_name_does_not_remember_errors(mock_fetch):
+    with open('%s/location.json-error' % gettempdir(), 'w') as f:
+        f.write('[]')
+    if os.path.exists('%s/location_misses.json-error' % gettempdir()):
+        os.remove('%s/location_misses.json-error' % gettempdir())
+    mock_fetch.return_value = None
+
+    geolocation.place_name(23.4567, -56.7891)
+    geolocation.place_name(23.4567, -56.7891)
+
+    assert mock_fetch.call_count == 2, mock_fetch.call_count
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-status' % gettempdir())
+@mock.patch('elodie.constants.location_miss_db', '%s/location_misses.json-status' % gettempdir())
+@mock.patch('elodie.localstorage.__location_db__', None)
+@mock.patch('elodie.localstorage.__location_index__', None)
+@mock.patch('elodie.localstorage.__location_misses__', None)
+@mock.patch('elodie.localstorage.__location_miss_index__', None)
+@mock.patch('elodie.localstorage.__location_db_pending__', 0)
+@mock.patch('elodie.localstorage.__location_db_last_flush__', None)
+@mock.patch('elodie.geolocation.__KEY__', 'stand-in-key')
+@mock.patch('elodie.geolocation.__PREFER_ENGLISH_NAMES__', False)
+@mock.patch('elodie.geolocation.__CLIENT__', MapQuestClient(5, 0, 0))
+def test_place_name_does_not_remember_error_statuses():
+    with open('%s/location.json-status' % gettempdir(), 'w') as f:
+        f.write('[]')
+    if os.path.exists('%s/location_misses.json-status' % gettempdir()):
+        os.remove('%s/location_misses.json-status' % gettempdir())
+    server = StandInServer([
+        (429, {}, {'error': 'Too many requests'}, 0),
+        (403, {}, {'error': 'The AppKey submitted with this request is invalid.'}, 0),
+        (200, {}, {'display_name': 'Sunnyvale', 'address': {'city': 'Sunnyvale'}}, 0),
+    ])
+
+    with mock.patch('elodie.constants.mapquest_base_url', server.url('')):
+        rate_limited = geolocation.fetch(lat=34.5678, lon=-67.8912)
+        forbidden_place = geolocation.place_name(34.5678, -67.8912)
+        is_miss = Db().is_location_miss(34.5678, -67.8912, 3000)
+        place = geolocation.place_name(34.5678, -67.8912)
+    server.shutdown()
+
+    assert rate_limited is None, rate_limited
+    assert forbidden_place == {'default': 'Unknown Location'}, forbidden_place
+    assert is_miss is False, is_miss
+    assert place['city'] == 'Sunnyvale', place
+    assert len(server.requests) == 3, server.requests
+
+@mock.patch('elodie.geolocation.__KEY__', None)
+@mock.patch('elodie.constants.mapquest_key', None)
+@mock.patch('elodie.config.config_file', '%s/config.ini-prefetch-no-key' % gettempdir())
+@mock.patch('elodie.geolocation.fetch')
+def test_prefetch_place_names_without_key(mock_fetch):
+    with open('%s/config.ini-prefetch-no-key' % gettempdir(), 'w') as f:
+        f.write('')
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    lookups = geolocation.prefetch_place_names([(37.3667, -122.0333)])
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+    assert lookups == 0, lookups
+    assert mock_fetch.called is False
+
+@mock.patch('elodie.geolocation.__COORDINATES_BY_NAME__', {})
+@mock.patch('elodie.geolocation.lookup')
+def test_coordinates_by_name_is_memoized(mock_lookup):
+    mock_lookup.return_value = {
+        'results': [{
+            'locations': [{
+                'latLng': {'lat': 36.17, 'lng': -115.14},
+                'geocodeQuality': 'CITY'
+            }]
+        }]
+    }
+    name = 'Las Vegas %s, NV' % helper.random_string(10)
+
+    first = geolocation.coordinates_by_name(name)
+    first['latitude'] = 0
+    second = geolocation.coordinates_by_name(name.upper())
+    third = geolocation.coordinates_by_name('  %s' % name.replace(' ', '  '))
+
+    assert mock_lookup.call_count == 1, mock_lookup.call_count
+    assert second == {'latitude': 36.17, 'longitude': -115.14}, second
+    assert third == second, third
+
+@mock.patch('elodie.geolocation.__COORDINATES_BY_NAME__', {})
+@mock.patch('elodie.geolocation.lookup')
+def test_coordinates_by_name_remembers_misses(mock_lookup):
+    mock_lookup.return_value = None
+    name = helper.random_string(10)
+
+    first = geolocation.coordinates_by_name(name)
+    second = geolocation.coordinates_by_name(name)
+
+    assert first is None, first
+    assert second is None, second
+    assert mock_lookup.call_count == 1, mock_lookup.call_count
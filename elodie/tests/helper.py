@@ -5,7 +5,9 @@ from past.utils import old_div
 import hashlib
 import os
 import random
+import stat
 import string
+import sys
 import tempfile
 import re
 import time
@@ -100,6 +102,46 @@ def random_coordinate(coordinate, precision):
     # Here we add to the decimal section of the coordinate by a given precision
     return coordinate + ((old_div(10.0, (10.0**precision))) * random_decimal())
 
+# Answers like exiftool -stay_open. A request containing "hang" never gets
+#  an answer, "size=N" gets N bytes of data, "latin1" gets data which isn't
+#  utf-8 and "count" gets the number of requests answered so far.
+STAND_IN_EXIFTOOL = """#!%s
+import sys
+import time
+
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+answered = 0
+params = []
+for line in iter(sys.stdin.readline, ''):
+    line = line.strip()
+    if line == 'False':
+        break
+    if line != '-execute':
+        params.append(line)
+        continue
+    if 'hang' in params:
+        time.sleep(3600)
+    data = b''
+    for param in params:
+        if param.startswith('size='):
+            data = b'x' * int(param[5:])
+        elif param == 'latin1':
+            data = b'caf\\xe9'
+        elif param == 'count':
+            data = str(answered).encode('ascii')
+    params = []
+    answered += 1
+    stdout.write(b'[{"SourceFile": "ok", "Data": "' + data + b'"}]\\n{ready}\\n')
+    stdout.flush()
+"""
+
+def get_stand_in_exiftool():
+    path = os.path.join(tempfile.gettempdir(), 'exiftool-stand-in')
+    with open(path, 'w') as f:
+        f.write(STAND_IN_EXIFTOOL % sys.executable)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
 def temp_dir():
     return tempfile.gettempdir()
 
@@ -1,13 +1,19 @@
 from __future__ import print_function
 from __future__ import absolute_import
 # Project imports
+import json
+import mock
 import os
+import shutil
 import sys
+import threading
+from tempfile import gettempdir
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
 
 from . import helper
-from elodie.localstorage import Db
+from elodie.config import load_config
+from elodie.localstorage import Db, LocationIndex, LocationNameIndex, MetadataCache, SqliteHashDb, VerifyState, flush_hash_db, flush_location_db, get_hash_db_flush_stats, write_hash_db
 from elodie import constants
 
 os.environ['TZ'] = 'GMT'
@@ -180,6 +186,167 @@ def test_checksum():
 
     assert checksum == 'd5eb755569ddbc8a664712d2d7d6e0fa1ddfcdb378475e4a6758dc38d5ea9a16', 'Checksum for plain.jpg did not match'
 
+def write_same_size_keep_stat(file_path, contents):
+    stat = os.stat(file_path)
+    with open(file_path, 'r+b') as f:
+        f.write(contents)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def test_checksum_uses_cache_when_stat_unchanged():
+    temporary_folder, folder = helper.create_working_folder()
+    file_path = os.path.join(folder, 'file.txt')
+    with open(file_path, 'wb') as f:
+        f.write(b'aaaa')
+
+    db = Db()
+    checksum = db.checksum(file_path)
+    write_same_size_keep_stat(file_path, b'bbbb')
+    cached_checksum = db.checksum(file_path)
+    actual_checksum = db.checksum(file_path, use_cache=False)
+
+    shutil.rmtree(folder)
+
+    assert cached_checksum == checksum, cached_checksum
+    assert actual_checksum != checksum, actual_checksum
+
+def test_checksum_cache_misses_when_file_changes():
+    temporary_folder, folder = helper.create_working_folder()
+    file_path = os.path.join(folder, 'file.txt')
+    with open(file_path, 'wb') as f:
+        f.write(b'aaaa')
+
+    db = Db()
+    checksum = db.checksum(file_path)
+    with open(file_path, 'ab') as f:
+        f.write(b'b')
+    checksum_after_change = db.checksum(file_path)
+
+    shutil.rmtree(folder)
+
+    assert checksum_after_change != checksum, checksum_after_change
+
+@mock.patch('elodie.constants.rehash', True)
+def test_checksum_rehash_ignores_cache():
+    temporary_folder, folder = helper.create_working_folder()
+    file_path = os.path.join(folder, 'file.txt')
+    with open(file_path, 'wb') as f:
+        f.write(b'aaaa')
+
+    db = Db()
+    checksum = db.checksum(file_path)
+    write_same_size_keep_stat(file_path, b'bbbb')
+    rehashed_checksum = db.checksum(file_path)
+
+    shutil.rmtree(folder)
+
+    assert rehashed_checksum != checksum, rehashed_checksum
+
+def test_metadata_cache_misses_when_file_changes():
+    temporary_folder, folder = helper.create_working_folder()
+    file_path = os.path.join(folder, 'file.jpg')
+    with open(file_path, 'wb') as f:
+        f.write(b'aaaa')
+
+    cache = MetadataCache(os.path.join(folder, 'metadata.db'), 10)
+    cache.set_many([{'SourceFile': file_path, 'XMP:Title': 'Title'}], '-XMP:Title')
+    cached = cache.get(file_path, '-XMP:Title')
+    other_params = cache.get(file_path, '-XMP:Album')
+    with open(file_path, 'ab') as f:
+        f.write(b'b')
+    after_change = cache.get(file_path, '-XMP:Title')
+    missing = cache.get(os.path.join(folder, 'missing.jpg'), '-XMP:Title')
+
+    shutil.rmtree(folder)
+
+    assert cached == {'SourceFile': file_path, 'XMP:Title': 'Title'}, cached
+    assert other_params is None, other_params
+    assert after_change is None, after_change
+    assert missing is None, missing
+
+def test_metadata_cache_evicts_least_recently_used():
+    temporary_folder, folder = helper.create_working_folder()
+    file_paths = []
+    for name in ('a.jpg', 'b.jpg', 'c.jpg', 'd.jpg'):
+        file_path = os.path.join(folder, name)
+        with open(file_path, 'wb') as f:
+            f.write(b'aaaa')
+        file_paths.append(file_path)
+
+    cache = MetadataCache(os.path.join(folder, 'metadata.db'), 3)
+    cache.set_many([{'SourceFile': file_path} for file_path in file_paths[:3]], '')
+    # Reading the first file makes the second the least recently used.
+    cache.get(file_paths[0], '')
+    cache.set_many([{'SourceFile': file_paths[3]}], '')
+    cached = [cache.get(file_path, '') is not None for file_path in file_paths]
+    cache.remove(file_paths[0])
+    removed = cache.get(file_paths[0], '')
+
+    shutil.rmtree(folder)
+
+    assert cached == [True, False, True, True], cached
+    assert removed is None, removed
+
+def test_partial_checksum_ignores_middle_of_file():
+    temporary_folder, folder = helper.create_working_folder()
+    first = os.path.join(folder, 'first.bin')
+    second = os.path.join(folder, 'second.bin')
+    third = os.path.join(folder, 'third.bin')
+    with open(first, 'wb') as f:
+        f.write(b'a' * 1000 + b'b' * 1000 + b'c' * 1000)
+    with open(second, 'wb') as f:
+        f.write(b'a' * 1000 + b'x' * 1000 + b'c' * 1000)
+    with open(third, 'wb') as f:
+        f.write(b'a' * 1000 + b'b' * 1001 + b'c' * 1000)
+
+    db = Db()
+    first_checksum = db.partial_checksum(first, 1000)
+    second_checksum = db.partial_checksum(second, 1000)
+    third_checksum = db.partial_checksum(third, 1000)
+
+    shutil.rmtree(folder)
+
+    assert first_checksum == second_checksum, second_checksum
+    assert first_checksum != third_checksum, third_checksum
+    assert first_checksum.startswith('3000:'), first_checksum
+
+@mock.patch('elodie.constants.hash_index', '%s/hash_index.db-tiers' % gettempdir())
+def test_may_have_hash_tiers():
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.isfile('%s%s' % (constants.hash_index, suffix)):
+            os.remove('%s%s' % (constants.hash_index, suffix))
+
+    db = Db()
+    db.reset_hash_db()
+    db.add_partial_checksum('checksum-a', '3000:aaaa')
+    db.add_hash('checksum-a', '/path/a')
+    db.update_hash_db()
+
+    db2 = Db()
+    unseen_size = db2.may_have_hash('4000:aaaa')
+    unseen_partial = db2.may_have_hash('3000:bbbb')
+    seen_partial = db2.may_have_hash('3000:aaaa')
+
+    os.remove(constants.hash_index)
+
+    assert unseen_size == False
+    assert unseen_partial == False
+    assert seen_partial == True
+
+@mock.patch('elodie.constants.hash_index', '%s/hash_index.db-incomplete' % gettempdir())
+def test_may_have_hash_incomplete_index():
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.isfile('%s%s' % (constants.hash_index, suffix)):
+            os.remove('%s%s' % (constants.hash_index, suffix))
+
+    db = Db()
+    # The index is created next to a hash db it knows nothing about.
+    db.hash_db['checksum-a'] = '/path/a'
+    may_have_hash = db.may_have_hash('4000:aaaa')
+
+    os.remove(constants.hash_index)
+
+    assert may_have_hash == True
+
 def test_add_location():
     db = Db()
 
@@ -232,6 +399,138 @@ def test_get_location_name_outside_threshold():
 
     assert retrieved_name is None
 
+def test_get_location_name_returns_nearest():
+    db = Db()
+
+    latitude, longitude, name = helper.get_test_location()
+    far_name = '%s-%s' % (name, helper.random_string(10))
+    near_name = '%s-%s' % (name, helper.random_string(10))
+    db.add_location(latitude + 0.02, longitude, far_name)
+    db.add_location(latitude + 0.001, longitude, near_name)
+
+    retrieved_name = db.get_location_name(latitude, longitude, 3000)
+
+    assert retrieved_name == near_name, retrieved_name
+
+location_db_patches = [
+    mock.patch('elodie.localstorage.__location_db__', None),
+    mock.patch('elodie.localstorage.__location_index__', None),
+    mock.patch('elodie.localstorage.__location_misses__', None),
+    mock.patch('elodie.localstorage.__location_miss_index__', None),
+    mock.patch('elodie.localstorage.__location_db_pending__', 0),
+    mock.patch('elodie.localstorage.__location_db_last_flush__', None),
+    mock.patch('elodie.localstorage.__exit_handlers_registered__', True),
+]
+
+def with_location_db_patches(function):
+    for patch in reversed(location_db_patches):
+        function = patch(function)
+    return function
+
+def read_location_db():
+    with open(constants.location_db, 'r') as f:
+        contents = f.read()
+    return json.loads(contents) if contents else []
+
+def add_location_and_update(latitude, longitude, name):
+    db = Db()
+    db.add_location(latitude, longitude, name)
+    db.update_location_db()
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-deferred' % gettempdir())
+@mock.patch('elodie.constants.location_db_flush_every', 3)
+@mock.patch('elodie.constants.location_db_flush_interval', 3600)
+@with_location_db_patches
+def test_update_location_db_defers_writes():
+    with open(constants.location_db, 'w') as f:
+        f.write('[]')
+
+    latitude, longitude, name = helper.get_test_location()
+    names = ['%s-%s' % (name, helper.random_string(10)) for _ in range(3)]
+    add_location_and_update(latitude, longitude, names[0])
+    add_location_and_update(latitude + 1, longitude, names[1])
+
+    on_disk_before_flush = read_location_db()
+    visible_before_flush = Db().get_location_name(latitude + 1, longitude, 5)
+
+    add_location_and_update(latitude + 2, longitude, names[2])
+
+    on_disk_after_flush = read_location_db()
+    leftovers = [
+        f for f in os.listdir(gettempdir())
+        if f.startswith('location.json-deferred.')
+    ]
+    os.remove(constants.location_db)
+
+    assert on_disk_before_flush == [], on_disk_before_flush
+    assert visible_before_flush == names[1], visible_before_flush
+    assert [data['name'] for data in on_disk_after_flush] == names, on_disk_after_flush
+    assert leftovers == [], leftovers
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-deferred-exit' % gettempdir())
+@mock.patch('elodie.constants.location_db_flush_every', 100)
+@mock.patch('elodie.constants.location_db_flush_interval', 3600)
+@with_location_db_patches
+def test_flush_location_db_writes_pending_locations():
+    with open(constants.location_db, 'w') as f:
+        f.write('[{"lat": 1.0, "long": 2.0, "name": "existing"}]')
+
+    latitude, longitude, name = helper.get_test_location()
+    add_location_and_update(latitude, longitude, name)
+
+    on_disk_before_flush = read_location_db()
+    written = flush_location_db()
+    on_disk_after_flush = read_location_db()
+    written_again = flush_location_db()
+    os.remove(constants.location_db)
+
+    assert len(on_disk_before_flush) == 1, on_disk_before_flush
+    assert [data['name'] for data in on_disk_after_flush] == ['existing', name], on_disk_after_flush
+    assert written == 1, written
+    assert written_again == 0, written_again
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-deferred-interval' % gettempdir())
+@mock.patch('elodie.constants.location_db_flush_every', 100)
+@mock.patch('elodie.constants.location_db_flush_interval', 0)
+@with_location_db_patches
+def test_update_location_db_flushes_after_interval():
+    with open(constants.location_db, 'w') as f:
+        f.write('')
+
+    latitude, longitude, name = helper.get_test_location()
+    add_location_and_update(latitude, longitude, name)
+
+    on_disk = read_location_db()
+    os.remove(constants.location_db)
+
+    assert [data['name'] for data in on_disk] == [name], on_disk
+
+def test_location_index_nearest_across_cells():
+    index = LocationIndex([
+        {'lat': 0.0999, 'long': 10.0999, 'name': 'inside'},
+        {'lat': 0.2, 'long': 10.0, 'name': 'outside'},
+    ])
+
+    # In the next cell over in both directions but only ~30 meters away.
+    nearest = index.nearest(0.1001, 10.1001, 100)
+
+    assert nearest is not None
+    assert nearest[1]['name'] == 'inside', nearest
+    assert nearest[0] < 100, nearest
+
+def test_location_index_nearest_near_pole():
+    index = LocationIndex([{'lat': 89.99, 'long': -170.0, 'name': 'pole'}])
+
+    nearest = index.nearest(89.99, 10.0, 5000)
+
+    assert nearest is not None
+    assert nearest[1]['name'] == 'pole', nearest
+
+def test_location_index_nearest_empty():
+    index = LocationIndex()
+
+    assert index.nearest(37.0, -122.0, 3000) is None
+
 def test_get_location_coordinates_exists():
     db = Db()
     
@@ -261,3 +560,568 @@ def test_get_location_coordinates_does_not_exists():
     location = db.get_location_coordinates(name)
 
     assert location is None
+
+def test_get_location_coordinates_normalizes_name():
+    db = Db()
+
+    latitude, longitude, name = helper.get_test_location()
+    name = '%s %s' % (name, helper.random_string(10))
+    db.add_location(latitude, longitude, name)
+
+    location = db.get_location_coordinates('  %s ' % name.upper().replace(' ', '   '))
+
+    assert location == (latitude, longitude), location
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-misses' % gettempdir())
+@mock.patch('elodie.constants.location_miss_db', '%s/location_misses.json-misses' % gettempdir())
+@with_location_db_patches
+def test_location_misses_are_written_with_locations():
+    with open(constants.location_db, 'w') as f:
+        f.write('[]')
+    if os.path.exists(constants.location_miss_db):
+        os.remove(constants.location_miss_db)
+
+    latitude, longitude, name = helper.get_test_location()
+    db = Db()
+    db.add_location_miss(latitude, longitude)
+    db.update_location_db()
+    flush_location_db()
+
+    with open(constants.location_miss_db, 'r') as f:
+        on_disk = json.load(f)
+    os.remove(constants.location_db)
+    os.remove(constants.location_miss_db)
+
+    assert db.is_location_miss(latitude, longitude, 5) is True
+    assert Db().is_location_miss(latitude, longitude, 5) is True
+    assert Db().is_location_miss(latitude + 1, longitude, 5) is False
+    assert len(on_disk) == 1, on_disk
+    assert on_disk[0]['lat'] == latitude, on_disk
+
+@mock.patch('elodie.constants.location_db', '%s/location.json-expired-misses' % gettempdir())
+@mock.patch('elodie.constants.location_miss_db', '%s/location_misses.json-expired-misses' % gettempdir())
+@with_location_db_patches
+def test_location_misses_expire():
+    with open(constants.location_db, 'w') as f:
+        f.write('[]')
+    with open(constants.location_miss_db, 'w') as f:
+        f.write('[{"lat": 1.0, "long": 2.0, "time": 0}, {"lat": 3.0, "long": 4.0, "time": 9999999999}]')
+
+    db = Db()
+    expired = db.is_location_miss(1.0, 2.0, 5)
+    current = db.is_location_miss(3.0, 4.0, 5)
+    with mock.patch('elodie.constants.location_miss_ttl', -1):
+        db.add_location_miss(5.0, 6.0)
+        just_expired = db.is_location_miss(5.0, 6.0, 5)
+    os.remove(constants.location_db)
+    os.remove(constants.location_miss_db)
+
+    assert expired is False
+    assert current is True
+    assert just_expired is False
+
+@with_location_db_patches
+@mock.patch('elodie.constants.location_db', '%s/location.json-name-index' % gettempdir())
+def test_get_location_coordinates_with_place_name_dict():
+    with open(constants.location_db, 'w') as f:
+        f.write('[]')
+    city = helper.random_string(10)
+    db = Db()
+    db.add_location(36.17, -115.14, {
+        'city': city,
+        'state': 'Nevada',
+        'country': 'United States',
+        'default': city
+    })
+    db.update_location_db()
+
+    by_default = Db().get_location_coordinates(city.lower())
+    by_city_and_state = Db().get_location_coordinates('%s, nevada' % city)
+    by_state = Db().get_location_coordinates('Nevada')
+    os.remove(constants.location_db)
+
+    assert by_default == (36.17, -115.14), by_default
+    assert by_city_and_state == (36.17, -115.14), by_city_and_state
+    assert by_state is None, by_state
+
+def test_location_name_index_first_location_wins():
+    index = LocationNameIndex([
+        {'lat': 1.0, 'long': 2.0, 'name': 'Springfield'},
+        {'lat': 3.0, 'long': 4.0, 'name': 'springfield'},
+    ])
+
+    assert len(index) == 1, len(index)
+    assert index.get('SPRINGFIELD') == (1.0, 2.0), index.get('SPRINGFIELD')
+
+def test_location_name_index_normalize_without_casefold():
+    # Python 2 strings have no casefold().
+    class Name(str):
+        def __getattribute__(self, attribute):
+            if attribute == 'casefold':
+                raise AttributeError(attribute)
+            return str.__getattribute__(self, attribute)
+
+    normalized = LocationNameIndex.normalize(Name('  Las   VEGAS '))
+
+    assert normalized == 'las vegas', normalized
+
+def write_sqlite_config(name):
+    with open('%s/%s' % (gettempdir(), name), 'w') as f:
+        f.write("""
+[Database]
+backend=sqlite
+        """)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+def remove_sqlite_hash_db(name):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.isfile('%s/%s%s' % (gettempdir(), name, suffix)):
+            os.remove('%s/%s%s' % (gettempdir(), name, suffix))
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-sqlite-add-hash' % gettempdir())
+@mock.patch('elodie.constants.hash_db_sqlite', '%s/hash.db-add-hash' % gettempdir())
+def test_sqlite_add_hash_and_update_hash_db():
+    write_sqlite_config('config.ini-sqlite-add-hash')
+    remove_sqlite_hash_db('hash.db-add-hash')
+
+    db = Db()
+
+    random_key = helper.random_string(10)
+    random_value = helper.random_string(12)
+    db.add_hash(random_key, random_value)
+
+    db2 = Db()
+    exists_before_update = db2.check_hash(random_key)
+
+    db.update_hash_db()
+
+    db3 = Db()
+    value_after_update = db3.get_hash(random_key)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_sqlite_hash_db('hash.db-add-hash')
+
+    assert isinstance(db.hash_db, SqliteHashDb), db.hash_db
+    assert db.check_hash(random_key) == True
+    assert exists_before_update == False
+    assert value_after_update == random_value, value_after_update
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-sqlite-all' % gettempdir())
+@mock.patch('elodie.constants.hash_db_sqlite', '%s/hash.db-all' % gettempdir())
+def test_sqlite_get_all_and_reset_hash_db():
+    write_sqlite_config('config.ini-sqlite-all')
+    remove_sqlite_hash_db('hash.db-all')
+
+    db = Db()
+    db.reset_hash_db()
+
+    entries = {}
+    for _ in range(10):
+        entries[helper.random_string(10)] = helper.random_string(12)
+    for key, value in entries.items():
+        db.add_hash(key, value)
+
+    all_entries = dict(db.all())
+    db.reset_hash_db()
+    all_entries_after_reset = list(db.all())
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_sqlite_hash_db('hash.db-all')
+
+    assert all_entries == entries, all_entries
+    assert all_entries_after_reset == [], all_entries_after_reset
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-sqlite-migrate' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-migrate' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-migrate.journal' % gettempdir())
+@mock.patch('elodie.constants.hash_db_sqlite', '%s/hash.db-migrate' % gettempdir())
+def test_sqlite_migrates_hash_json():
+    write_sqlite_config('config.ini-sqlite-migrate')
+    remove_sqlite_hash_db('hash.db-migrate')
+
+    random_key = helper.random_string(10)
+    random_value = helper.random_string(12)
+    with open(constants.hash_db, 'w') as f:
+        json.dump({random_key: random_value}, f)
+
+    db = Db()
+    value = db.get_hash(random_key)
+
+    # A second open must not migrate again.
+    db.reset_hash_db()
+    db.update_hash_db()
+    db2 = Db()
+    value_after_reset = db2.get_hash(random_key)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_sqlite_hash_db('hash.db-migrate')
+    os.remove(constants.hash_db)
+
+    assert value == random_value, value
+    assert value_after_reset is None, value_after_reset
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-sqlite-migrate-journal' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-migrate-journal' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-migrate-journal.journal' % gettempdir())
+@mock.patch('elodie.constants.hash_db_sqlite', '%s/hash.db-migrate-journal' % gettempdir())
+def test_sqlite_migrates_hash_json_journal():
+    write_sqlite_config('config.ini-sqlite-migrate-journal')
+    remove_sqlite_hash_db('hash.db-migrate-journal')
+
+    flushed_key = helper.random_string(10)
+    journaled_key = helper.random_string(10)
+    with open(constants.hash_db, 'w') as f:
+        json.dump({flushed_key: 'flushed'}, f)
+    with open(constants.hash_db_journal, 'w') as f:
+        f.write('%s\n' % json.dumps({journaled_key: 'journaled'}))
+
+    db = Db()
+    flushed_value = db.get_hash(flushed_key)
+    journaled_value = db.get_hash(journaled_key)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_sqlite_hash_db('hash.db-migrate-journal')
+    os.remove(constants.hash_db)
+    os.remove(constants.hash_db_journal)
+
+    assert flushed_value == 'flushed', flushed_value
+    assert journaled_value == 'journaled', journaled_value
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-sqlite-migrate-again' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-migrate-again' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-migrate-again.journal' % gettempdir())
+@mock.patch('elodie.constants.hash_db_sqlite', '%s/hash.db-migrate-again' % gettempdir())
+def test_sqlite_migrates_again_after_interrupted_migration():
+    write_sqlite_config('config.ini-sqlite-migrate-again')
+    remove_sqlite_hash_db('hash.db-migrate-again')
+
+    random_key = helper.random_string(10)
+    newer_key = helper.random_string(10)
+    with open(constants.hash_db, 'w') as f:
+        json.dump({random_key: 'from-json', newer_key: 'from-json'}, f)
+
+    with mock.patch.object(SqliteHashDb, 'update', side_effect=KeyboardInterrupt):
+        try:
+            Db()
+        except KeyboardInterrupt:
+            pass
+
+    # hash.db exists now but holds neither the entries nor the marker.
+    interrupted = SqliteHashDb(constants.hash_db_sqlite)
+    migrated_after_interrupt = interrupted.get_meta('migrated')
+    interrupted[newer_key] = 'from-sqlite'
+    interrupted.commit()
+    interrupted.connection.close()
+
+    db = Db()
+    value = db.get_hash(random_key)
+    newer_value = db.get_hash(newer_key)
+    migrated = db.hash_db.get_meta('migrated')
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_sqlite_hash_db('hash.db-migrate-again')
+    os.remove(constants.hash_db)
+
+    assert migrated_after_interrupt is None, migrated_after_interrupt
+    assert value == 'from-json', value
+    assert newer_value == 'from-sqlite', newer_value
+    assert migrated == '1', migrated
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-sqlite-backup' % gettempdir())
+@mock.patch('elodie.constants.hash_db_sqlite', '%s/hash.db-backup' % gettempdir())
+def test_sqlite_backup_hash_db():
+    write_sqlite_config('config.ini-sqlite-backup')
+    remove_sqlite_hash_db('hash.db-backup')
+
+    random_key = helper.random_string(10)
+    db = Db()
+    db.add_hash(random_key, helper.random_string(12), True)
+    backup_file_name = db.backup_hash_db()
+
+    backup = SqliteHashDb(backup_file_name)
+    backup_has_key = random_key in backup
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_sqlite_hash_db('hash.db-backup')
+    os.remove(backup_file_name)
+
+    assert backup_has_key, backup_file_name
+
+def write_group_commit_config(name, settings):
+    with open('%s/%s' % (gettempdir(), name), 'w') as f:
+        f.write("""
+[Database]
+%s
+        """ % settings)
+    if hasattr(load_config, 'config'):
+        del load_config.config
+
+def remove_json_hash_db(name):
+    for suffix in ('', '.journal'):
+        if os.path.isfile('%s/%s%s' % (gettempdir(), name, suffix)):
+            os.remove('%s/%s%s' % (gettempdir(), name, suffix))
+
+def read_json_hash_db():
+    with open(constants.hash_db, 'r') as f:
+        contents = f.read()
+    return json.loads(contents) if contents else {}
+
+group_commit_patches = [
+    mock.patch('elodie.localstorage.__hash_db__', None),
+    mock.patch('elodie.localstorage.__hash_db_pending__', 0),
+    mock.patch('elodie.localstorage.__hash_db_last_flush__', None),
+    mock.patch('elodie.localstorage.__hash_db_flushes__', []),
+    mock.patch('elodie.localstorage.__exit_handlers_registered__', True),
+]
+
+def with_group_commit_patches(function):
+    for patch in reversed(group_commit_patches):
+        function = patch(function)
+    return function
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-group-commit' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-group-commit' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-group-commit.journal' % gettempdir())
+@with_group_commit_patches
+def test_update_hash_db_group_commit():
+    write_group_commit_config('config.ini-group-commit', 'flush_every=3')
+    remove_json_hash_db('hash.json-group-commit')
+
+    keys = [helper.random_string(10) for _ in range(3)]
+    for key in keys[:2]:
+        db = Db()
+        db.add_hash(key, helper.random_string(12))
+        db.update_hash_db()
+
+    on_disk_before_flush = read_json_hash_db()
+    journal_before_flush = os.path.isfile(constants.hash_db_journal)
+    visible_before_flush = Db().check_hash(keys[1])
+
+    db = Db()
+    db.add_hash(keys[2], helper.random_string(12))
+    db.update_hash_db()
+
+    on_disk_after_flush = read_json_hash_db()
+    journal_after_flush = os.path.isfile(constants.hash_db_journal)
+    stats = get_hash_db_flush_stats()
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_json_hash_db('hash.json-group-commit')
+
+    assert on_disk_before_flush == {}, on_disk_before_flush
+    assert journal_before_flush == True
+    assert visible_before_flush == True
+    assert sorted(on_disk_after_flush.keys()) == sorted(keys), on_disk_after_flush
+    assert journal_after_flush == False
+    assert stats['flushes'] == 1, stats
+    assert stats['bytes'][0] > 0, stats
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-group-commit-exit' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-group-commit-exit' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-group-commit-exit.journal' % gettempdir())
+@with_group_commit_patches
+def test_flush_hash_db_writes_pending_entries():
+    write_group_commit_config('config.ini-group-commit-exit', 'flush_interval=3600')
+    remove_json_hash_db('hash.json-group-commit-exit')
+
+    random_key = helper.random_string(10)
+    db = Db()
+    db.add_hash(random_key, helper.random_string(12), True)
+
+    on_disk_before_flush = read_json_hash_db()
+    written = flush_hash_db()
+    on_disk_after_flush = read_json_hash_db()
+    written_again = flush_hash_db()
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_json_hash_db('hash.json-group-commit-exit')
+
+    assert random_key not in on_disk_before_flush, on_disk_before_flush
+    assert random_key in on_disk_after_flush, on_disk_after_flush
+    assert written > 0, written
+    assert written_again == 0, written_again
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-group-commit-journal' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-group-commit-journal' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-group-commit-journal.journal' % gettempdir())
+@with_group_commit_patches
+def test_init_replays_hash_db_journal():
+    write_group_commit_config('config.ini-group-commit-journal', 'flush_every=100')
+    remove_json_hash_db('hash.json-group-commit-journal')
+
+    random_key = helper.random_string(10)
+    random_value = helper.random_string(12)
+    with open(constants.hash_db_journal, 'w') as f:
+        f.write('%s\n' % json.dumps({random_key: random_value}))
+        # A torn write from a crash.
+        f.write('{"abc')
+
+    db = Db()
+    value = db.get_hash(random_key)
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_json_hash_db('hash.json-group-commit-journal')
+
+    assert value == random_value, value
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-group-commit-atomic' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-group-commit-atomic' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-group-commit-atomic.journal' % gettempdir())
+@with_group_commit_patches
+def test_flush_hash_db_failure_keeps_hash_db_and_journal():
+    write_group_commit_config('config.ini-group-commit-atomic', 'flush_interval=3600')
+    remove_json_hash_db('hash.json-group-commit-atomic')
+
+    first_key = helper.random_string(10)
+    db = Db()
+    db.add_hash(first_key, helper.random_string(12), True)
+    flush_hash_db()
+
+    second_key = helper.random_string(10)
+    db = Db()
+    db.add_hash(second_key, helper.random_string(12), True)
+
+    with mock.patch('elodie.localstorage.os.fsync', side_effect=OSError('disk full')):
+        try:
+            flush_hash_db()
+            raised = False
+        except OSError:
+            raised = True
+
+    on_disk = read_json_hash_db()
+    journal_exists = os.path.isfile(constants.hash_db_journal)
+    temporary_files = [name for name in os.listdir(gettempdir())
+        if name.startswith('hash.json-group-commit-atomic.') and name.endswith('.tmp')]
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_json_hash_db('hash.json-group-commit-atomic')
+
+    assert raised == True
+    assert first_key in on_disk, on_disk
+    assert second_key not in on_disk, on_disk
+    assert journal_exists == True
+    assert temporary_files == [], temporary_files
+
+def test_verify_state_commits_every_n_files():
+    path = '%s/verify.db-commit-every' % gettempdir()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.isfile(path + suffix):
+            os.remove(path + suffix)
+
+    state = VerifyState(path, 100)
+    for index in range(150):
+        state.set(helper.random_string(10), '/a/%d.jpg' % index, True, None)
+    uncommitted = state.uncommitted
+    # Another connection only sees what was committed.
+    committed = VerifyState(path).connection.execute(
+        'SELECT COUNT(*) FROM verified'
+    ).fetchone()[0]
+    state.connection.close()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.isfile(path + suffix):
+            os.remove(path + suffix)
+
+    assert uncommitted == 50, uncommitted
+    assert committed == 100, committed
+
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-format' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-format.journal' % gettempdir())
+def test_write_hash_db_keeps_format():
+    hash_db = {'b-checksum': '/b.jpg', 'a-checksum': '/a.jpg'}
+
+    written = write_hash_db(hash_db)
+    with open(constants.hash_db, 'r') as f:
+        contents = f.read()
+
+    remove_json_hash_db('hash.json-format')
+
+    assert contents == json.dumps(hash_db, indent=0), contents
+    assert written == len(contents), written
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-group-commit-threads' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-group-commit-threads' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-group-commit-threads.journal' % gettempdir())
+@with_group_commit_patches
+def test_db_while_hash_db_is_updated_by_another_thread():
+    write_group_commit_config('config.ini-group-commit-threads', 'flush_every=1000000')
+    remove_json_hash_db('hash.json-group-commit-threads')
+    with open(constants.hash_db, 'w') as f:
+        json.dump(dict(('%d' % i, '/%d.jpg' % i) for i in range(20000)), f)
+
+    errors = []
+    done = threading.Event()
+    def add_hashes():
+        try:
+            for i in range(100):
+                db = Db()
+                db.add_hash(helper.random_string(20), '/new.jpg', True)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    thread = threading.Thread(target=add_hashes)
+    thread.start()
+    try:
+        while not done.is_set():
+            Db()
+    except Exception as e:
+        errors.append(e)
+    thread.join()
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_json_hash_db('hash.json-group-commit-threads')
+
+    assert errors == [], errors
+
+@mock.patch('elodie.config.config_file', '%s/config.ini-group-commit-shared' % gettempdir())
+@mock.patch('elodie.constants.hash_db', '%s/hash.json-group-commit-shared' % gettempdir())
+@mock.patch('elodie.constants.hash_db_journal', '%s/hash.json-group-commit-shared.journal' % gettempdir())
+@with_group_commit_patches
+def test_db_shares_the_json_hash_db():
+    write_group_commit_config('config.ini-group-commit-shared', '')
+    remove_json_hash_db('hash.json-group-commit-shared')
+    with open(constants.hash_db, 'w') as f:
+        json.dump({'existing': '/existing.jpg'}, f)
+
+    first = Db()
+    second = Db()
+    shared = first.hash_db.shared is second.hash_db.shared
+
+    first.add_hash('added', '/added.jpg')
+    visible_before_update = second.check_hash('added')
+    first.update_hash_db()
+    visible_after_update = Db().get_hash('added')
+    visible_to_open_db = second.get_hash('added')
+
+    second.reset_hash_db()
+    second.add_hash('after-reset', '/after-reset.jpg')
+    entries_after_reset = dict(second.all())
+    entries_before_update = dict(first.all())
+    second.update_hash_db()
+    entries_after_update = dict(Db().all())
+
+    if hasattr(load_config, 'config'):
+        del load_config.config
+    remove_json_hash_db('hash.json-group-commit-shared')
+
+    assert shared == True
+    assert visible_before_update == False
+    assert visible_after_update == '/added.jpg', visible_after_update
+    assert visible_to_open_db == '/added.jpg', visible_to_open_db
+    assert entries_after_reset == {'after-reset': '/after-reset.jpg'}, entries_after_reset
+    assert entries_before_update == {'existing': '/existing.jpg', 'added': '/added.jpg'}, entries_before_update
+    assert entries_after_update == {'after-reset': '/after-reset.jpg'}, entries_after_update
@@ -1,4 +1,5 @@
 # Project imports
+import mock
 import os
 import sys
 
@@ -17,6 +18,7 @@ sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.realp
 
 import helper
 from elodie.media.audio import Audio
+from elodie.media import media as media_module
 from elodie.media.media import Media
 from elodie.media.photo import Photo
 from elodie.media.video import Video
@@ -169,6 +171,255 @@ def test_set_original_name():
         assert metadata['original_name'] is None, metadata['original_name']
         assert metadata_updated['original_name'] == random_file_name, metadata_updated['original_name']
 
+def test_prefetch_exiftool_attributes():
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = '%s/plain.jpg' % folder
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+
+    Media.prefetch_exiftool_attributes([origin, '%s/notes.txt' % folder])
+
+    media = Media.get_class_by_file(origin, [Photo])
+    prefetched = media.pop_prefetched_exiftool_attributes()
+    not_prefetched = media.pop_prefetched_exiftool_attributes()
+
+    shutil.rmtree(folder)
+
+    assert prefetched is not None
+    assert prefetched['SourceFile'] == origin, prefetched['SourceFile']
+    assert not_prefetched is None, not_prefetched
+
+def test_prefetch_exiftool_attributes_dropped_after_set_tags():
+    temporary_folder, folder = helper.create_working_folder()
+
+    origin = '%s/plain.jpg' % folder
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+
+    Media.prefetch_exiftool_attributes([origin])
+
+    media = Media.get_class_by_file(origin, [Photo])
+    media.set_album('Test Album')
+    metadata = media.get_metadata()
+
+    shutil.rmtree(folder)
+
+    assert metadata['album'] == 'Test Album', metadata['album']
+
+def test_get_prefetched_coordinates():
+    temporary_folder, folder = helper.create_working_folder()
+
+    with_location = '%s/with-location.jpg' % folder
+    plain = '%s/plain.jpg' % folder
+    video = '%s/video.mov' % folder
+    shutil.copyfile(helper.get_file('with-location.jpg'), with_location)
+    shutil.copyfile(helper.get_file('plain.jpg'), plain)
+    shutil.copyfile(helper.get_file('video.mov'), video)
+
+    Media.prefetch_exiftool_attributes([with_location, plain, video])
+    prefetched = media_module.__exiftool_prefetch__.attributes
+    prefetched[os.path.normpath(with_location)] = {
+        'SourceFile': with_location,
+        'EXIF:GPSLatitude': 37.3667027222222,
+        'EXIF:GPSLatitudeRef': 'N',
+        'EXIF:GPSLongitude': 122.033383611111,
+        'EXIF:GPSLongitudeRef': 'W',
+    }
+    prefetched[os.path.normpath(plain)] = {'SourceFile': plain}
+    prefetched[os.path.normpath(video)] = {
+        'SourceFile': video,
+        'XMP:GPSLatitude': -33.8688,
+        'XMP:GPSLongitude': 151.2093,
+    }
+
+    coordinates = Media.get_prefetched_coordinates()
+    media = Media.get_class_by_file(with_location, [Photo])
+    still_prefetched = media.pop_prefetched_exiftool_attributes()
+
+    shutil.rmtree(folder)
+
+    assert sorted(coordinates) == [
+        (-33.8688, 151.2093),
+        (37.3667027222222, -122.033383611111)
+    ], coordinates
+    assert still_prefetched is not None
+
+def test_get_exiftool_params():
+    photo_params = Photo.get_exiftool_params()
+    video_params = Video.get_exiftool_params()
+
+    assert photo_params[0] == '-fast2', photo_params
+    assert '-EXIF:DateTimeOriginal' in photo_params, photo_params
+    assert '-XMP:Title' in photo_params, photo_params
+    assert '-XMP:OriginalFileName' in photo_params, photo_params
+    assert video_params[0] == '-fast', video_params
+    assert Photo.get_exiftool_params('/a/one.png')[0] == '-fast'
+    assert Photo.get_exiftool_params('/a/one.HEIC')[0] == '-fast'
+    assert Photo.get_exiftool_params('/a/one.png')[1:] == photo_params[1:]
+    assert '-H264:DateTimeOriginal' in video_params, video_params
+    assert '-XMP:DisplayName' in video_params, video_params
+    assert '-XMP:Title' not in video_params, video_params
+
+@mock.patch('elodie.constants.native_exif', False)
+@mock.patch('elodie.media.media.ExifTool.execute_json')
+def test_read_exiftool_attributes_by_speed(mock_execute_json):
+    mock_execute_json.return_value = []
+
+    Photo.read_exiftool_attributes(['/a/one.jpg', '/a/two.png', '/a/three.heic', '/a/four.nef'])
+
+    calls = [call[0] for call in mock_execute_json.call_args_list]
+    assert len(calls) == 2, calls
+    assert tuple(Photo.get_exiftool_params() + ['/a/one.jpg', '/a/four.nef']) in calls, calls
+    assert tuple(Photo.get_exiftool_params('/a/two.png') + ['/a/two.png', '/a/three.heic']) in calls, calls
+
+def test_get_exiftool_params_from_constructor():
+    class Screencast(Video):
+        extensions = ()
+
+        def __init__(self, source=None):
+            super(Screencast, self).__init__(source)
+            self.software_keys = ['QuickTime:Software']
+
+    params = Screencast.get_exiftool_params()
+
+    assert '-QuickTime:Software' in params, params
+    assert '-QuickTime:Software' not in Video.get_exiftool_params()
+
+@mock.patch('elodie.media.media.ExifTool.execute_json')
+def test_prefetch_exiftool_attributes_reads_tags_by_type(mock_execute_json):
+    mock_execute_json.return_value = []
+
+    Media.prefetch_exiftool_attributes(['/a/one.jpg', '/a/two.mov', '/a/three.JPG', '/a/notes.txt'])
+
+    calls = [call[0] for call in mock_execute_json.call_args_list]
+    assert len(calls) == 2, calls
+    assert tuple(Photo.get_exiftool_params() + ['/a/one.jpg', '/a/three.JPG']) in calls, calls
+    assert tuple(Video.get_exiftool_params() + ['/a/two.mov']) in calls, calls
+
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+@mock.patch.object(Photo, 'read_exiftool_attributes')
+def test_get_exiftool_attributes_uses_metadata_cache(mock_read, mock_set_tags):
+    temporary_folder, folder = helper.create_working_folder()
+    origin = '%s/photo.jpg' % folder
+    shutil.copyfile(helper.get_file('plain.jpg'), origin)
+    mock_read.side_effect = lambda sources: [
+        {'SourceFile': source, 'XMP:Title': 'Cached'} for source in sources
+    ]
+    mock_set_tags.return_value = '1 image files updated'
+
+    first = Photo(origin).get_title()
+    second = Photo(origin).get_title()
+    reads_before_write = mock_read.call_count
+    Photo(origin).set_title('New')
+    Photo(origin).get_title()
+
+    shutil.rmtree(folder)
+
+    assert first == 'Cached', first
+    assert second == 'Cached', second
+    assert reads_before_write == 1, reads_before_write
+    assert mock_read.call_count == 2, mock_read.call_count
+
+def write_deferred_albums(folder, names, albums):
+    sources = []
+    for name in names:
+        sources.append('%s/%s' % (folder, name))
+        shutil.copyfile(helper.get_file('plain.jpg'), sources[-1])
+
+    media_list = [Photo(source) for source in sources]
+    for media, album in zip(media_list, albums):
+        if album is not None:
+            media.defer_tags()
+            media.set_album(album)
+    return sources, media_list
+
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+@mock.patch('elodie.media.media.ExifTool.set_tags_batch')
+def test_write_deferred_tags_batch_finds_failed_files(mock_set_tags_batch, mock_set_tags):
+    temporary_folder, folder = helper.create_working_folder()
+    sources, media_list = write_deferred_albums(
+        folder,
+        ('one.jpg', 'two.jpg', 'three.jpg', 'four.jpg'),
+        ('Album', 'Album', 'Other', None)
+    )
+
+    def set_tags_batch(tags, paths, error_file=None):
+        if sources[1] not in paths:
+            return b'    1 image files updated\n'
+        with open(error_file, 'a') as f:
+            f.write('%s\n' % sources[1])
+        return b"    1 image files updated\n    1 files weren't updated due to errors\n"
+    mock_set_tags_batch.side_effect = set_tags_batch
+
+    statuses = Media.write_deferred_tags_batch(media_list)
+
+    shutil.rmtree(folder)
+
+    calls = [call[0] for call in mock_set_tags_batch.call_args_list]
+    assert statuses == [True, False, True, None], statuses
+    assert ({'XMP-xmpDM:Album': 'Album'}, sources[:2]) in calls, calls
+    assert ({'XMP-xmpDM:Album': 'Other'}, sources[2:3]) in calls, calls
+    assert mock_set_tags.called is False, mock_set_tags.call_args_list
+    assert media_list[0].deferred_tags is None
+
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+@mock.patch('elodie.media.media.ExifTool.set_tags_batch')
+def test_write_deferred_tags_batch_writes_one_at_a_time_when_failures_are_unknown(mock_set_tags_batch, mock_set_tags):
+    temporary_folder, folder = helper.create_working_folder()
+    sources, media_list = write_deferred_albums(
+        folder,
+        ('one.jpg', 'two.jpg'),
+        ('Album', 'Album')
+    )
+
+    error = b"    1 image files updated\n    1 files weren't updated due to errors\n"
+    mock_set_tags_batch.return_value = error
+    mock_set_tags.side_effect = lambda tags, source: error if source == sources[1] else b'    1 image files updated\n'
+
+    statuses = Media.write_deferred_tags_batch(media_list)
+
+    shutil.rmtree(folder)
+
+    assert statuses == [True, False], statuses
+    assert mock_set_tags.call_count == 2, mock_set_tags.call_args_list
+
+@mock.patch('elodie.media.media.ExifTool.set_tags')
+@mock.patch('elodie.media.media.ExifTool.set_tags_batch')
+def test_write_deferred_tags_batch_writes_one_at_a_time_after_timeout(mock_set_tags_batch, mock_set_tags):
+    temporary_folder, folder = helper.create_working_folder()
+    sources, media_list = write_deferred_albums(
+        folder,
+        ('one.jpg', 'two.jpg', 'three.jpg'),
+        ('Album', 'Album', 'Album')
+    )
+
+    exiftool = media_module.ExifTool()
+    timeout = exiftool.timeout
+    batch_timeouts = []
+    def set_tags_batch(tags, paths, error_file=None):
+        batch_timeouts.append(exiftool.timeout)
+        raise media_module.ExifToolTimeout('exiftool took longer than 60 seconds.')
+    def set_tags(tags, source):
+        if source == sources[2]:
+            raise media_module.ExifToolTimeout('exiftool took longer than 20 seconds.')
+        return b'    1 image files updated\n'
+    mock_set_tags_batch.side_effect = set_tags_batch
+    mock_set_tags.side_effect = set_tags
+
+    exiftool.timeout = 20
+    try:
+        statuses = Media.write_deferred_tags_batch(media_list)
+        timeout_after = exiftool.timeout
+    finally:
+        exiftool.timeout = timeout
+
+    shutil.rmtree(folder)
+
+    assert batch_timeouts == [60], batch_timeouts
+    assert timeout_after == 20, timeout_after
+    assert statuses == [True, True, False], statuses
+    assert mock_set_tags.call_count == 3, mock_set_tags.call_args_list
+    assert [media.deferred_tags for media in media_list] == [None, None, None]
+
 def is_valid():
     media = Media()
 
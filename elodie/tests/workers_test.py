@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+# Project imports
+import os
+import sys
+import threading
+
+from nose.tools import assert_raises
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
+
+from . import helper
+from elodie.external.pyexiftool import ExifTool, ExifToolPool, ExifToolTimeout
+from elodie.workers import ProcessPool, WorkerPool
+
+os.environ['TZ'] = 'GMT'
+
+setup_module = helper.setup_module
+teardown_module = helper.teardown_module
+
+def test_map_returns_results_in_order():
+    pool = WorkerPool(4)
+    results = pool.map(lambda x: x * 2, range(50))
+
+    assert results == [x * 2 for x in range(50)], results
+
+def test_map_with_no_items():
+    pool = WorkerPool(4)
+    results = pool.map(lambda x: x, [])
+
+    assert results == [], results
+
+def test_map_raises_worker_exception():
+    def fail_on_three(x):
+        if x == 3:
+            raise ValueError('three')
+        return x
+
+    pool = WorkerPool(2)
+    with assert_raises(ValueError):
+        pool.map(fail_on_three, range(10))
+
+def test_map_uses_exiftool_per_worker():
+    shared = ExifTool()
+    instances = {}
+    lock = threading.Lock()
+
+    def record(x):
+        with lock:
+            instances[threading.current_thread().ident] = ExifTool()
+        return x
+
+    WorkerPool(3).map(record, range(30))
+
+    assert len(instances) > 0
+    for instance in instances.values():
+        assert instance is not shared
+        assert instance.running is False
+    assert ExifTool() is shared
+
+def test_map_without_exiftool():
+    shared = ExifTool()
+    instances = []
+
+    def record(x):
+        instances.append(ExifTool())
+        return x
+
+    results = WorkerPool(3, exiftool=False).map(record, range(10))
+
+    assert results == list(range(10)), results
+    for instance in instances:
+        assert instance is shared
+
+def square(x):
+    return x * x
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError('three')
+    return x
+
+def test_process_pool_imap_returns_results_in_order():
+    pool = ProcessPool(3, in_flight=5)
+    results = list(pool.imap(square, iter(range(50))))
+
+    assert results == [x * x for x in range(50)], results
+
+def test_process_pool_imap_raises_worker_exception():
+    pool = ProcessPool(2)
+    with assert_raises(ValueError):
+        list(pool.imap(fail_on_three, range(10)))
+
+def test_execute_times_out_and_restarts():
+    exiftool = ExifTool.new_instance(
+        executable_=helper.get_stand_in_exiftool(),
+        timeout=0.5
+    )
+    exiftool.start()
+    first_process = exiftool._process
+
+    with assert_raises(ExifToolTimeout):
+        exiftool.execute_json('hang')
+    result = exiftool.execute_json('a.jpg')
+    second_process = exiftool._process
+    exiftool.terminate()
+
+    assert first_process.poll() is not None
+    assert second_process is not first_process
+    assert result == [{'SourceFile': 'ok', 'Data': ''}], result
+
+def test_execute_restarts_exited_process():
+    exiftool = ExifTool.new_instance(executable_=helper.get_stand_in_exiftool())
+    exiftool.start()
+    exiftool._process.kill()
+    exiftool._process.wait()
+
+    result = exiftool.execute_json('a.jpg')
+    exiftool.terminate()
+
+    assert result == [{'SourceFile': 'ok', 'Data': ''}], result
+
+def test_exiftool_pool_hands_out_up_to_size():
+    pool = ExifToolPool(2, executable_=helper.get_stand_in_exiftool(), timeout=5)
+    first = pool.acquire()
+    second = pool.acquire()
+    pool.release(first)
+    third = pool.acquire()
+    pool.release(second)
+    pool.release(third)
+    instances = list(pool.instances)
+    pool.terminate()
+
+    assert first is not second
+    assert third is first
+    assert len(instances) == 2, instances
+    for instance in instances:
+        assert instance.running is False
+        assert instance.timeout == 5
+
+def test_map_with_hanging_exiftool():
+    shared = ExifTool()
+    executable, timeout = shared.executable, shared.timeout
+    shared.executable = helper.get_stand_in_exiftool()
+    shared.timeout = 0.5
+
+    def read(x):
+        try:
+            return ExifTool().execute_json(x)[0]['SourceFile']
+        except ExifToolTimeout:
+            return None
+
+    try:
+        results = WorkerPool(2).map(read, ['a', 'hang', 'b', 'hang', 'c'])
+    finally:
+        shared.executable, shared.timeout = executable, timeout
+
+    assert results == ['ok', None, 'ok', None, 'ok'], results
+
+def test_execute_strips_sentinel_from_large_output():
+    exiftool = ExifTool.new_instance(executable_=helper.get_stand_in_exiftool())
+    exiftool.start()
+    output = exiftool.execute(b'size=1000000')
+    result = exiftool.execute_json('size=1000000')
+    exiftool.terminate()
+
+    assert output.startswith(b'[{"SourceFile": "ok"'), output[:32]
+    assert output.endswith(b'"}]\n'), output[-32:]
+    assert len(result[0]['Data']) == 1000000, len(result[0]['Data'])
+
+def test_execute_json_falls_back_to_latin1_without_running_again():
+    exiftool = ExifTool.new_instance(executable_=helper.get_stand_in_exiftool())
+    exiftool.start()
+    result = exiftool.execute_json('latin1')
+    count = exiftool.execute_json('count')
+    exiftool.terminate()
+
+    assert result[0]['Data'] == u'caf\xe9', result
+    assert count[0]['Data'] == '1', count
+
@@ -0,0 +1,170 @@
+"""
+Run the work for many files on several workers at the same time.
+
+:class:`WorkerPool` runs threads which take a long-lived
+``exiftool -stay_open`` process from an
+:class:`~elodie.external.pyexiftool.ExifToolPool` for every item. Hashing, copying and exiftool all spend
+their time outside of the Python interpreter so threads are enough to keep
+several cores busy while importing.
+
+:class:`ProcessPool` runs worker processes for work which only reads files,
+like hashing a whole library.
+"""
+from __future__ import print_function
+from builtins import object, range
+
+import multiprocessing
+import signal
+import sys
+import threading
+
+from collections import deque
+from queue import Empty, Queue
+from six import reraise
+
+from elodie import constants
+from elodie import log
+from elodie.external.pyexiftool import ExifTool, ExifToolPool
+
+
+class WorkerPool(object):
+    """A pool of worker threads which each use their own ExifTool process.
+
+    The processes borrow the executable, arguments and timeout of the shared
+    :class:`~elodie.external.pyexiftool.ExifTool` instance so every worker
+    runs exiftool the same way the main thread does. A process which hangs
+    or dies is replaced before the next item.
+
+    :param int workers: Number of workers to run.
+    :param bool exiftool: Start an ExifTool process for every worker. Work
+        which doesn't read metadata, like network requests, can skip it.
+    """
+
+    def __init__(self, workers, exiftool=True):
+        self.workers = max(1, workers)
+        self.exiftool = exiftool
+
+    def map(self, function, items):
+        """Call `function` once for every item using all workers.
+
+        If `function` raises an exception then the remaining items are
+        skipped and the exception is raised again once the workers have
+        stopped.
+
+        :param function: Callable which takes a single item.
+        :param items: Iterable of items to process.
+        :returns: list of return values in the same order as `items`.
+        """
+        items = list(items)
+        results = [None] * len(items)
+        errors = []
+
+        work = Queue()
+        for index, item in enumerate(items):
+            work.put((index, item))
+
+        exiftools = None
+        if self.exiftool:
+            shared = ExifTool()
+            exiftools = ExifToolPool(
+                self.workers,
+                executable_=shared.executable,
+                addedargs=shared.addedargs,
+                timeout=shared.timeout
+            )
+
+        threads = []
+        for _ in range(min(self.workers, len(items))):
+            thread = threading.Thread(
+                target=self._run,
+                args=(function, work, results, errors, exiftools)
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        if exiftools is not None:
+            exiftools.terminate()
+
+        if errors:
+            reraise(*errors[0])
+
+        return results
+
+    def _run(self, function, work, results, errors, exiftools):
+        while not errors:
+            try:
+                index, item = work.get_nowait()
+            except Empty:
+                break
+
+            try:
+                if exiftools is None:
+                    results[index] = function(item)
+                    continue
+
+                with exiftools.borrow() as exiftool:
+                    ExifTool.bind_thread(exiftool)
+                    try:
+                        results[index] = function(item)
+                    finally:
+                        ExifTool.bind_thread(None)
+            except BaseException:
+                log.error('Worker failed on %s' % (item,))
+                errors.append(sys.exc_info())
+
+
+def _init_process(debug, rehash):
+    # Settings from the command line aren't inherited by spawned processes.
+    constants.debug = debug
+    constants.rehash = rehash
+    # Ctrl-C is handled by the parent which stops the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ProcessPool(object):
+    """A pool of worker processes.
+
+    Only a bounded number of items are handed to the processes at a time so
+    that items can come from a generator which walks a large library.
+
+    :param int jobs: Number of processes to run.
+    :param int in_flight: Number of items which may be waiting for a result.
+        Defaults to four per process.
+    """
+
+    def __init__(self, jobs, in_flight=None):
+        self.jobs = max(1, jobs)
+        self.in_flight = in_flight or self.jobs * 4
+
+    def imap(self, function, items):
+        """Call `function` once for every item in the worker processes.
+
+        `function` has to be defined at the top level of a module so it can
+        be sent to the processes. An exception raised by `function` is
+        raised again here.
+
+        :param function: Callable which takes a single item.
+        :param items: Iterable of items to process.
+        :returns: generator of return values in the same order as `items`.
+        """
+        pool = multiprocessing.Pool(
+            self.jobs,
+            _init_process,
+            (constants.debug, constants.rehash)
+        )
+        pending = deque()
+        try:
+            for item in items:
+                if len(pending) >= self.in_flight:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(function, (item,)))
+
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+            pool.join()